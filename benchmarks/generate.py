@@ -0,0 +1,67 @@
+"""Deterministic synthetic SMRT file generator for benchmarks.
+
+Can also be run as a script to write a file:
+
+    python benchmarks/generate.py OUTPUT.SMRT --rows 100000
+"""
+
+
+import argparse
+from collections import deque
+from datetime import datetime, timedelta
+import random
+
+
+START_TIME = datetime(2021, 1, 1)
+
+
+def generate(f, rows, meters=1000, days=30, duplicate_ratio=0.0, seed=0):
+    """Write a valid SMRT file.
+
+    f: text file object to write to.
+    rows: number of consumption records.
+    meters: number of distinct meter numbers.
+    days: number of days measurement times are spread over.
+    duplicate_ratio: fraction of records which repeat the meter number and
+        measurement time of a recent record.
+    seed: random seed. The same arguments always generate the same file.
+    """
+
+    rng = random.Random(seed)
+    minutes = days * 24 * 60
+
+    # Only recent keys are kept for duplicates, so memory use stays bounded.
+    recent = deque(maxlen=1000)
+
+    f.write('"HEADR","SMRT","GAZ","20210201","120000","PN000001"\n')
+    for _ in range(rows):
+        if recent and rng.random() < duplicate_ratio:
+            meter, timestamp = rng.choice(recent)
+        else:
+            meter = rng.randrange(meters)
+            timestamp = START_TIME + timedelta(minutes=rng.randrange(minutes))
+            recent.append((meter, timestamp))
+
+        consumption = rng.randrange(100000) / 100
+        f.write(
+            f'"CONSU","{meter:010d}","{timestamp:%Y%m%d}","{timestamp:%H%M}",{consumption:.2f}\n'
+        )
+    f.write('"TRAIL"\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic SMRT file.')
+    parser.add_argument('output', help='file to write')
+    parser.add_argument('--rows', type=int, default=100000, help='number of consumption records')
+    parser.add_argument('--meters', type=int, default=1000, help='number of distinct meters')
+    parser.add_argument('--days', type=int, default=30, help='days measurements are spread over')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='fraction of duplicate records')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    with open(args.output, 'w', newline='') as f:
+        generate(f, args.rows, args.meters, args.days, args.duplicate_ratio, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Loader and DB write throughput benchmarks.
+
+Generates synthetic SMRT files of each requested size, then measures loading
+and inserting them into a temporary SQLite database. Results are written as
+JSON so runs can be compared:
+
+    python benchmarks/run.py --rows 10000 100000 --output results.json
+"""
+
+
+import argparse
+from datetime import datetime, timezone
+import gc
+import json
+from pathlib import Path
+import platform
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import tracemalloc
+import warnings
+
+import sqlalchemy
+
+from generate import generate
+
+
+def _timed(function, repeat, setup=None):
+    """Return the best time in seconds of calling `function` with the result
+    of `setup`, if given.
+    """
+
+    best = None
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        gc.collect()
+        start = perf_counter()
+        function(argument)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _peak_memory(function):
+    """Return the peak memory in bytes allocated whilst calling `function`."""
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run(path, rows, repeat, chunk_size):
+    """Run all benchmarks against a single file. Returns a list of results."""
+
+    # Imported here, so the DB location can be configured first.
+    from smrt_importer import db
+    from smrt_importer.loader import SMRTLoader
+    from smrt_importer.models import DailyConsumption, File, Record, ShardFile
+
+    def load_csv(_):
+        with open(path, newline='') as f:
+            SMRTLoader().load_csv(f)
+
+    def stream_csv(_):
+        with open(path, newline='') as f:
+            for _ in SMRTLoader().stream_csv(f, chunk_size):
+                pass
+
+    def clear_db():
+        # Including the rollups, so each repeat starts from the same state.
+        for record_engine in db.record_engines():
+            with record_engine.begin() as connection:
+                connection.execute(sqlalchemy.delete(Record))
+                connection.execute(sqlalchemy.delete(DailyConsumption))
+                if db.shard_engines:
+                    connection.execute(sqlalchemy.delete(ShardFile))
+        with db.engine.begin() as connection:
+            connection.execute(sqlalchemy.delete(File))
+        db.imported_filenames.load()
+
+    def loaded_file():
+        clear_db()
+        return SMRTLoader().load_file(path)
+
+    def parsed_chunks():
+        clear_db()
+        loader = SMRTLoader()
+        chunks = list(loader.stream_file(path, chunk_size))
+        return loader.data, chunks
+
+    def bulk_insert_file(argument):
+        file, chunks = argument
+        db.bulk_insert_file(file, chunks)
+
+    results = []
+    for name, function, setup in [
+        ('loader.load_csv', load_csv, None),
+        ('loader.stream_csv', stream_csv, None),
+        ('db.insert_file', db.insert_file, loaded_file),
+        ('db.bulk_insert_file', bulk_insert_file, parsed_chunks),
+    ]:
+        seconds = _timed(function, repeat, setup)
+        results.append({
+            'name': name,
+            'rows': rows,
+            'bytes': path.stat().st_size,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds,
+        })
+
+    for name, function in [
+        ('loader.load_csv', load_csv),
+        ('loader.stream_csv', stream_csv),
+    ]:
+        results.append({
+            'name': f'{name}.peak_memory',
+            'rows': rows,
+            'bytes': path.stat().st_size,
+            'peak_memory_bytes': _peak_memory(lambda: function(None)),
+        })
+
+    clear_db()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run SMRT importer benchmarks.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='file sizes (consumption records) to benchmark')
+    parser.add_argument('--meters', type=int, default=1000, help='number of distinct meters')
+    parser.add_argument('--days', type=int, default=30, help='days measurements are spread over')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='fraction of duplicate records')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark (best is reported)')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='records per streamed chunk')
+    parser.add_argument('--output', help='file to write JSON results to (default: stdout)')
+    args = parser.parse_args()
+
+    # The ORM warns about duplicate records within a file, which are expected
+    # when generating random measurement times.
+    warnings.filterwarnings('ignore', category=sqlalchemy.exc.SAWarning)
+
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        from smrt_importer.config import config
+        config.db_path = tmp / 'db'
+
+        results = []
+        for rows in args.rows:
+            path = tmp / f'BENCH_{rows}.SMRT'
+            with open(path, 'w', newline='') as f:
+                generate(f, rows, args.meters, args.days, args.duplicate_ratio, args.seed)
+            results.extend(run(path, rows, args.repeat, args.chunk_size))
+            path.unlink()
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'platform': platform.platform(),
+        'parameters': {
+            'meters': args.meters,
+            'days': args.days,
+            'duplicate_ratio': args.duplicate_ratio,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'chunk_size': args.chunk_size,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
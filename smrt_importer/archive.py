@@ -0,0 +1,223 @@
+"""SMRT Importer archive of processed and failed files.
+
+Files are moved into the processed or failed directory, either directly
+(the flat layout) or into a subdirectory per import date (the date layout),
+so no single directory grows without bound. Old date partitions can be
+compacted into compressed tar archives, each with a CSV index of its files.
+"""
+
+
+import csv
+from datetime import date, datetime, timedelta
+import logging
+import os
+from pathlib import Path
+import shutil
+import tarfile
+from time import time_ns
+
+from smrt_importer.loader import logical_name
+
+
+LAYOUTS = ('flat', 'date')
+
+COMPRESSIONS = ('gz', 'bz2', 'xz')
+
+_PARTITION_FORMAT = '%Y-%m-%d'
+
+
+logger = logging.getLogger(__name__)
+
+
+def partition_dir(dest: Path, layout='flat', day: date = None):
+    """Return the directory files are archived into.
+
+    dest: processed or failed directory.
+    layout: 'flat' or 'date'.
+    day: import date, for the date layout. Defaults to today.
+    """
+
+    if layout == 'flat':
+        return dest
+    if layout == 'date':
+        return dest / (day or date.today()).strftime(_PARTITION_FORMAT)
+    raise ValueError(f'unknown archive layout {layout!r}')
+
+
+def _unique_name(path: Path):
+    """Return a name for a file which collides with an archived file.
+
+    The name ends with a timestamp rather than counting up from 1, so only
+    one extra attempt is needed. Any compression suffix is kept at the end,
+    e.g. `FOO_<timestamp>.SMRT.gz`.
+    """
+
+    name = logical_name(path)
+    stem, suffix = Path(name).stem, Path(name).suffix + path.name[len(name):]
+    return f'{stem}_{time_ns():x}{suffix}'
+
+
+def move_no_replace(path: Path, newpath: Path):
+    """Move a file, raising FileExistsError rather than replacing an existing
+    file.
+    """
+
+    try:
+        # Linking fails atomically if the destination exists.
+        os.link(path, newpath)
+    except FileExistsError:
+        raise
+    except OSError:
+        # Hard links aren't supported, so check and rename instead.
+        if newpath.exists():
+            raise FileExistsError(newpath)
+        path.rename(newpath)
+    else:
+        path.unlink()
+
+
+class Archiver:
+    """Moves files into an archive directory, creating partitions as
+    needed.
+    """
+
+    def __init__(self, layout='flat'):
+        """layout: 'flat' or 'date'. See `partition_dir`."""
+
+        if layout not in LAYOUTS:
+            raise ValueError(f'unknown archive layout {layout!r}')
+        self.layout = layout
+        self._created = set()
+
+    def move(self, path: Path, dest: Path):
+        """Move a file into the archive, renaming it if the name is taken.
+
+        path: file path.
+        dest: processed or failed directory.
+
+        Returns the new path.
+        """
+
+        directory = partition_dir(dest, self.layout)
+        if directory not in self._created:
+            directory.mkdir(parents=True, exist_ok=True)
+            self._created.add(directory)
+
+        newpath = directory / path.name
+        while True:
+            try:
+                move_no_replace(path, newpath)
+                return newpath
+            except FileExistsError:
+                newpath = directory / _unique_name(path)
+
+
+def _partitions(dest: Path):
+    """Yield `(day, directory)` for each date partition in a directory."""
+
+    for directory in dest.iterdir():
+        if not directory.is_dir():
+            continue
+        try:
+            day = datetime.strptime(directory.name, _PARTITION_FORMAT).date()
+        except ValueError:
+            continue
+        yield day, directory
+
+
+def compact_partition(directory: Path, compression='gz'):
+    """Compact a date partition into a tar archive with an index, then
+    delete it.
+
+    The archive is written as `<partition>.tar.<compression>` next to the
+    partition, and the index as `<partition>.index.csv`, listing each file's
+    name, size and modification time. Both are written under temporary names
+    first, so an interrupted compaction leaves the partition intact.
+
+    directory: partition directory.
+    compression: 'gz', 'bz2' or 'xz'.
+
+    Returns the path of the archive.
+    """
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'unknown compression {compression!r}')
+    archive_path = directory.with_name(f'{directory.name}.tar.{compression}')
+    index_path = directory.with_name(f'{directory.name}.index.csv')
+    tmp_archive_path = archive_path.with_name(f'.{archive_path.name}.tmp')
+    tmp_index_path = index_path.with_name(f'.{index_path.name}.tmp')
+
+    files = sorted(p for p in directory.iterdir() if p.is_file())
+    with tarfile.open(tmp_archive_path, f'w:{compression}') as tar, \
+            open(tmp_index_path, 'w', newline='') as index:
+        writer = csv.writer(index)
+        writer.writerow(['name', 'size', 'mtime'])
+        for path in files:
+            stat = path.stat()
+            tar.add(path, arcname=f'{directory.name}/{path.name}')
+            writer.writerow([path.name, stat.st_size, int(stat.st_mtime)])
+
+    tmp_index_path.replace(index_path)
+    tmp_archive_path.replace(archive_path)
+    shutil.rmtree(directory)
+    return archive_path
+
+
+def compact(dest: Path, older_than_days, compression='gz', today: date = None):
+    """Compact date partitions older than a number of days.
+
+    dest: processed or failed directory.
+    older_than_days: partitions at least this many days old are compacted.
+        Must be at least 1, so today's partition is never compacted whilst
+        files may still be moved into it.
+    compression: 'gz', 'bz2' or 'xz'.
+    today: date to count from. Defaults to today.
+
+    Returns a list of the archives written.
+    """
+
+    if older_than_days < 1:
+        raise ValueError('older_than_days must be at least 1')
+    if not dest.is_dir():
+        return []
+
+    cutoff = (today or date.today()) - timedelta(days=older_than_days)
+    archives = []
+    for day, directory in sorted(_partitions(dest)):
+        if day > cutoff:
+            continue
+        archive_path = compact_partition(directory, compression)
+        logger.info('compacted path=%s archive=%s', directory, archive_path)
+        archives.append(archive_path)
+    return archives
+
+
+def find_archived(dest: Path, name):
+    """Find where a file was archived, by name, searching partitions and the
+    indexes of compacted partitions.
+
+    dest: processed or failed directory.
+    name: archived file name.
+
+    Returns a list of paths. Compacted files are given as a path within
+    their tar archive's directory, e.g. `<dest>/2021-01-01.tar.gz/FOO.SMRT`.
+    If a partition has more than one archive, e.g. after being recompressed,
+    each is included. An index without an archive is logged and skipped.
+    """
+
+    found = []
+    if (dest / name).is_file():
+        found.append(dest / name)
+    for _, directory in sorted(_partitions(dest)):
+        if (directory / name).is_file():
+            found.append(directory / name)
+    for index_path in sorted(dest.glob('*.index.csv')):
+        partition = index_path.name[:-len('.index.csv')]
+        with open(index_path, newline='') as f:
+            if not any(row['name'] == name for row in csv.DictReader(f)):
+                continue
+        archive_paths = sorted(dest.glob(f'{partition}.tar.*'))
+        if not archive_paths:
+            logger.warning('missing archive index=%s', index_path)
+        found.extend(archive_path / name for archive_path in archive_paths)
+    return found
@@ -0,0 +1,88 @@
+"""SMRT Importer compact record batches.
+
+Consumption records are held column-wise in arrays rather than as ORM
+`Record` objects, and only converted when written to the DB.
+"""
+
+
+from array import array
+from datetime import datetime, timedelta
+
+
+# Measurement times are naive, so are stored as seconds since this (naive)
+# epoch.
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_datetime(seconds):
+    """Convert seconds since the epoch to a naive datetime."""
+
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def to_seconds(timestamp: datetime):
+    """Convert a naive datetime to whole seconds since the epoch."""
+
+    return (timestamp - EPOCH) // timedelta(seconds=1)
+
+
+class RecordBatch:
+    """Column-oriented batch of consumption records.
+
+    Meter numbers are interned, each record storing an integer code into
+    `meters`. Measurement times are stored as seconds since the epoch.
+
+    Behaves as a sequence of `(meter_number, measurement_time, consumption)`
+    tuples, although converting records this way is relatively slow.
+    """
+
+    def __init__(self):
+        self.meters = []
+        self.meter_codes = array('q')
+        self.times = array('q')
+        self.consumptions = array('d')
+        self._codes = {}
+
+    def __getstate__(self):
+        # The code lookup can be rebuilt, so isn't worth sending between
+        # processes.
+        state = self.__dict__.copy()
+        del state['_codes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._codes = {meter: code for code, meter in enumerate(self.meters)}
+
+    def append(self, meter_number, seconds, consumption):
+        """Add a record.
+
+        meter_number: meter number string.
+        seconds: measurement time, in seconds since the epoch.
+        consumption: consumption value.
+        """
+
+        code = self._codes.get(meter_number)
+        if code is None:
+            code = self._codes[meter_number] = len(self.meters)
+            self.meters.append(meter_number)
+
+        self.meter_codes.append(code)
+        self.times.append(seconds)
+        self.consumptions.append(consumption)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return (
+            self.meters[self.meter_codes[index]],
+            to_datetime(self.times[index]),
+            self.consumptions[index]
+        )
+
+    def __iter__(self):
+        for code, seconds, consumption in zip(self.meter_codes, self.times, self.consumptions):
+            yield self.meters[code], to_datetime(seconds), consumption
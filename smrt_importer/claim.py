@@ -0,0 +1,197 @@
+"""SMRT Importer claiming of incoming files, so several instances can share
+an incoming directory.
+
+Before importing a file, an instance renames it into its own directory,
+`<incoming>/claimed/<worker id>/`. Renaming is atomic, so only one instance
+can claim each file, and files being imported are no longer seen by other
+instances.
+
+Whilst running, an instance touches its claim directory periodically, as a
+lease. If an instance dies, its lease expires, and another instance returns
+its claimed files to the incoming directory to be imported again.
+"""
+
+
+import logging
+import os
+from pathlib import Path
+import socket
+from threading import Event, Thread
+from time import time
+
+from smrt_importer.archive import move_no_replace
+
+
+CLAIMED_DIR = 'claimed'
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id():
+    """Return an ID unique to this process, across hosts sharing a volume."""
+
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _move_back(path: Path, dest: Path):
+    """Return a claimed file to the incoming directory, unless a file of the
+    same name has arrived since. Returns True if moved.
+    """
+
+    try:
+        move_no_replace(path, dest / path.name)
+    except FileExistsError:
+        logger.warning('not released path=%s reason=name_taken', path)
+        return False
+    except FileNotFoundError:
+        # Already returned by another instance.
+        return False
+    return True
+
+
+def release(path: Path):
+    """Return a file to the incoming directory if it is claimed, e.g. so it
+    can be imported again later.
+
+    path: claimed file, or file in the incoming directory.
+
+    Returns the file's path, which is unchanged if it wasn't claimed or
+    couldn't be returned.
+    """
+
+    path = Path(path)
+    claimed_dir = path.parent.parent
+    if claimed_dir.name != CLAIMED_DIR:
+        return path
+    if not _move_back(path, claimed_dir.parent):
+        return path
+    logger.info('released path=%s', path)
+    return claimed_dir.parent / path.name
+
+
+class Claimer:
+    """Claims files in an incoming directory for this instance."""
+
+    def __init__(self, incoming: Path, worker_id=None, lease_seconds=300):
+        """incoming: incoming directory.
+        worker_id: name of this instance's claim directory. Must be unique
+            amongst running instances. Defaults to the host name and PID.
+        lease_seconds: claims not renewed for this long are considered stale.
+            The lease is renewed a few times within this period.
+        """
+
+        self.incoming = Path(incoming)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.directory = self.incoming / CLAIMED_DIR / self.worker_id
+        self._stopped = Event()
+        self._heartbeat = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Create the claim directory, release any files left in it by a
+        previous run with the same ID, and start renewing the lease.
+        """
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.release_all()
+        self._stopped.clear()
+        self._heartbeat = Thread(target=self._renew, name='claim-lease', daemon=True)
+        self._heartbeat.start()
+
+    def stop(self):
+        """Stop renewing the lease, releasing any files still claimed."""
+
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self.release_all()
+        try:
+            self.directory.rmdir()
+        except OSError:
+            pass
+
+    def _renew(self):
+        while not self._stopped.wait(self.lease_seconds / 4):
+            self.renew()
+
+    def renew(self):
+        """Renew the lease on this instance's claims."""
+
+        # Recreated if another instance wrongly took this one for dead.
+        self.directory.mkdir(parents=True, exist_ok=True)
+        os.utime(self.directory)
+
+    def claim(self, path: Path):
+        """Claim a file by moving it into the claim directory.
+
+        path: file in the incoming directory.
+
+        Returns the claimed path, or None if the file has been claimed by
+        another instance (or this instance is still importing a file of the
+        same name).
+        """
+
+        path = Path(path)
+        newpath = self.directory / path.name
+        # Only this instance writes to its directory, so this can't race.
+        if newpath.exists():
+            return None
+        try:
+            os.rename(path, newpath)
+        except FileNotFoundError:
+            if not path.exists() or self.directory.exists():
+                return None
+            # Claims were reclaimed whilst this instance was unresponsive.
+            self.renew()
+            return self.claim(path)
+        return newpath
+
+    def release_all(self):
+        """Return all files claimed by this instance to the incoming
+        directory.
+        """
+
+        if not self.directory.is_dir():
+            return
+        for path in sorted(self.directory.iterdir()):
+            if _move_back(path, self.incoming):
+                logger.info('released path=%s', path)
+
+    def reclaim_stale(self):
+        """Return files claimed by instances whose lease has expired to the
+        incoming directory.
+
+        Returns a list of the paths they were returned to.
+        """
+
+        claimed_dir = self.incoming / CLAIMED_DIR
+        expiry = time() - self.lease_seconds
+        released = []
+        for directory in claimed_dir.iterdir():
+            if directory == self.directory or not directory.is_dir():
+                continue
+            try:
+                if directory.stat().st_mtime >= expiry:
+                    continue
+                paths = sorted(directory.iterdir())
+            except FileNotFoundError:
+                continue  # Removed by another instance.
+
+            for path in paths:
+                if _move_back(path, self.incoming):
+                    logger.warning('reclaimed path=%s worker=%s', path.name, directory.name)
+                    released.append(self.incoming / path.name)
+            try:
+                directory.rmdir()
+            except OSError:
+                pass
+        return released
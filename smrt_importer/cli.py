@@ -0,0 +1,256 @@
+"""SMRT Importer command line interface."""
+
+
+import argparse
+import asyncio
+from datetime import datetime
+import json
+import logging
+from pathlib import Path
+import sys
+
+
+logger = logging.getLogger(__name__)
+
+
+def _add_workers_argument(parser, default):
+    parser.add_argument(
+        '--workers', type=int, default=default(None),
+        help='number of processes used to parse files '
+        '(default: 1, or the number of CPUs for validate)'
+    )
+
+
+def _add_common_arguments(parser, default):
+    _add_workers_argument(parser, default)
+    parser.add_argument(
+        '--pipeline', action='store_true', default=default(False),
+        help='overlap parsing, writing and moving files using an asyncio pipeline'
+    )
+    parser.add_argument(
+        '--profile', action='store_true', default=default(False),
+        help='profile importing files, saving profiles next to the processed or failed '
+        'files and printing a summary on exit'
+    )
+    parser.add_argument(
+        '--profile-fraction', type=float, default=default(None), metavar='FRACTION',
+        help='profile a sampled fraction of files, between 0 and 1 (implies --profile)'
+    )
+
+
+def _once(args):
+    """Import the files already in a directory, then return."""
+
+    from smrt_importer import processor
+
+    workers = args.workers or 1
+    if args.pipeline:
+        asyncio.run(processor.run_async(args.dir, workers))
+        return
+
+    pool = processor.ParserPool(workers) if workers > 1 else None
+    claimer = processor.create_claimer(args.dir)
+    try:
+        processor.process_dir(args.dir, pool, processor.create_commit_group(), claimer)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if claimer is not None:
+            claimer.stop()
+
+
+def _watch(args):
+    """Import files as they arrive, until killed."""
+
+    from smrt_importer import metrics, processor
+    from smrt_importer.config import config
+
+    if config.metrics_port is not None:
+        metrics.serve(config.metrics_port, config.metrics_host)
+        logger.info('serving metrics host=%s port=%d', config.metrics_host, config.metrics_port)
+
+    if args.pipeline:
+        try:
+            asyncio.run(processor.run_async(args.dir, args.workers or 1, watch=True))
+        # Hide keyboard interrupt exception message and silently exit.
+        except KeyboardInterrupt:
+            pass
+    else:
+        processor.watch_dir(args.dir, args.workers or 1)
+
+
+def _compact(args):
+    """Compact old archive partitions of processed and failed files."""
+
+    from smrt_importer import archive
+    from smrt_importer.config import config
+
+    days = args.days if args.days is not None else config.compact_after_days
+    if days is None:
+        logger.info('compaction not configured')
+        return
+    for dest in [config.processed_dir, config.failed_dir]:
+        archive.compact(dest, days, config.archive_compression)
+
+
+def _validate(args):
+    """Check the files in a directory would import, without importing them."""
+
+    from smrt_importer import validate
+
+    report = validate.validate_dir(args.dir, args.workers)
+    logger.info(
+        'validated files=%d invalid=%d rows=%d seconds=%.3f',
+        report['files'], report['invalid'], report['rows'], report['seconds']
+    )
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if report['invalid']:
+        raise SystemExit(1)
+
+
+def _export(args):
+    """Export records to a CSV or Parquet file."""
+
+    from smrt_importer import export
+
+    since = args.since
+    state = None if args.state is None else Path(args.state)
+    if since is None and state is not None and state.exists():
+        since = datetime.fromisoformat(state.read_text().strip())
+
+    try:
+        result = export.export_records(
+            args.output, args.format, args.meter_from, args.meter_to, args.start, args.end, since
+        )
+    except RuntimeError as e:
+        raise SystemExit(f'smrt-importer export: error: {e}')
+    logger.info('exported path=%s rows=%d imported_until=%s', args.output, *result)
+
+    # Only recorded once the export is complete, so a failed export is
+    # retried from the same point.
+    if state is not None and result.imported_until is not None:
+        tmp_state = state.with_name(f'.{state.name}.tmp')
+        tmp_state.write_text(result.imported_until.isoformat() + '\n')
+        tmp_state.replace(state)
+
+
+def main(argv=None):
+    """Command line entry point.
+
+    The importer's modules are only imported once the arguments have been
+    parsed, and the DB is only set up once it is used, to keep start up fast
+    for short-lived runs.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog='smrt-importer',
+        description='Import SMRT files into a database.'
+    )
+    _add_common_arguments(parser, lambda value: value)
+    # Without a command, watch the configured incoming directory.
+    parser.set_defaults(command=_watch, dir=None)
+
+    subparsers = parser.add_subparsers(title='commands', metavar='COMMAND')
+    for name, command, help in [
+        ('once', _once, 'import the files in a directory, then exit'),
+        ('watch', _watch, 'import files as they arrive, until killed (default)'),
+    ]:
+        subparser = subparsers.add_parser(name, help=help, description=help.capitalize() + '.')
+        # Suppressed defaults, so options given before the command are kept.
+        _add_common_arguments(subparser, lambda value: argparse.SUPPRESS)
+        subparser.add_argument(
+            'dir', nargs='?',
+            help='directory containing SMRT files (default: configured incoming directory)'
+        )
+        subparser.set_defaults(command=command)
+
+    compact_help = 'compact date partitions of the archive into tar files, then exit'
+    subparser = subparsers.add_parser(
+        'compact', help=compact_help, description=compact_help.capitalize() + '.'
+    )
+    subparser.add_argument(
+        '--days', type=int,
+        help='compact partitions at least this many days old (default: configured compact_after_days)'
+    )
+    subparser.set_defaults(command=_compact)
+
+    validate_help = 'check the files in a directory are valid without importing them, then exit'
+    subparser = subparsers.add_parser(
+        'validate', help=validate_help, description=validate_help.capitalize() + '.'
+    )
+    _add_workers_argument(subparser, lambda value: argparse.SUPPRESS)
+    subparser.add_argument(
+        'dir', nargs='?',
+        help='directory containing SMRT files (default: configured incoming directory)'
+    )
+    subparser.add_argument(
+        '--output', metavar='PATH',
+        help='write the JSON report to this file (default: standard output)'
+    )
+    subparser.set_defaults(command=_validate)
+
+    export_help = 'export records to a CSV or Parquet file, then exit'
+    subparser = subparsers.add_parser(
+        'export', help=export_help, description=export_help.capitalize() + '.'
+    )
+    subparser.add_argument('output', help="output file, or '-' for standard output (CSV only)")
+    subparser.add_argument(
+        '--format', choices=['csv', 'parquet'],
+        help='output format (default: parquet if OUTPUT ends with .parquet, otherwise csv)'
+    )
+    subparser.add_argument('--meter-from', help='first meter number to export')
+    subparser.add_argument('--meter-to', help='last meter number to export')
+    subparser.add_argument(
+        '--start', type=datetime.fromisoformat, help='earliest measurement time to export'
+    )
+    subparser.add_argument(
+        '--end', type=datetime.fromisoformat, help='latest measurement time to export'
+    )
+    subparser.add_argument(
+        '--since', type=datetime.fromisoformat,
+        help='only export records from files imported after this time'
+    )
+    subparser.add_argument(
+        '--state', metavar='PATH',
+        help='file holding the import time reached by the last export, used as --since '
+        'if not given, and updated after exporting'
+    )
+    subparser.set_defaults(command=_export)
+
+    args = parser.parse_args(argv)
+
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.profile_fraction is not None and not 0 < args.profile_fraction <= 1:
+        parser.error('--profile-fraction must be between 0 and 1')
+    if getattr(args, 'days', None) is not None and args.days < 1:
+        parser.error('--days must be at least 1')
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s level=%(levelname)s logger=%(name)s %(message)s'
+    )
+
+    if not args.profile and args.profile_fraction is None:
+        args.command(args)
+        return
+
+    from smrt_importer import profiling
+
+    profiling.enable(1.0 if args.profile_fraction is None else args.profile_fraction)
+    try:
+        args.command(args)
+    finally:
+        summary = profiling.profiler.summary()
+        if summary is not None:
+            print(summary)
+
+
+if __name__ == '__main__':
+    main()
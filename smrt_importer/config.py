@@ -5,15 +5,34 @@ from pathlib import Path
 
 _BASE = Path(__file__).parent.parent
 
+# SQLite pragmas which may be set in the DB section, applied to every
+# connection.
+DB_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout')
+
 
 class Config:
-    """Hold application configuration."""
+    """Hold application configuration.
+
+    The config file is loaded when a setting is first read, so importing
+    this module is cheap.
+    """
 
     def __init__(self):
-        self.db_path = None
-        self.incoming_dir = None
-        self.processed_dir = None
-        self.failed_dir = None
+        self._loaded = False
+
+    def __getattr__(self, name):
+        # Only called for attributes which haven't been set, so settings
+        # before loading.
+        if name.startswith('_') or self._loaded:
+            raise AttributeError(f'{type(self).__name__!r} object has no attribute {name!r}')
+        self.load()
+        return getattr(self, name)
+
+    def __setattr__(self, name, value):
+        # Load first, so settings changed before loading aren't overwritten.
+        if not name.startswith('_') and not self._loaded:
+            self.load()
+        super().__setattr__(name, value)
 
     @staticmethod
     def _make_absolute(path):
@@ -24,15 +43,46 @@ class Config:
     def load(self):
         """Loads config from config file."""
 
+        # Marked as loaded first, so settings can be assigned below.
+        self._loaded = True
+
         config_path = _BASE / 'config.ini'
         parser = ConfigParser()
         parser.read(config_path)
 
         self.db_path = self._make_absolute(Path(parser['DB']['path']))
+        self.db_pragmas = {
+            name: parser['DB'][name] for name in DB_PRAGMAS if name in parser['DB']
+        }
+        self.shards = parser.getint('DB', 'shards', fallback=1)
         self.incoming_dir = self._make_absolute(Path(parser['Folders']['incoming']))
         self.processed_dir = self._make_absolute(Path(parser['Folders']['processed']))
         self.failed_dir = self._make_absolute(Path(parser['Folders']['failed']))
+        self.bulk_insert = parser.getboolean('Import', 'bulk', fallback=False)
+        self.batch_size = parser.getint('Import', 'batch_size', fallback=10000)
+        self.stream = parser.getboolean('Import', 'stream', fallback=False)
+        self.mmap_min_size = parser.getint('Import', 'mmap_min_size', fallback=None)
+        self.worker_max_size = parser.getint('Import', 'worker_max_size', fallback=67108864)
+        self.group_files = parser.getint('Import', 'group_files', fallback=1)
+        self.group_ms = parser.getint('Import', 'group_ms', fallback=1000)
+        self.resumable = parser.getboolean('Import', 'resumable', fallback=False)
+        self.checkpoint_rows = parser.getint('Import', 'checkpoint_rows', fallback=100000)
+        self.watch_backend = parser.get('Watch', 'backend', fallback='auto')
+        self.poll_interval = parser.getfloat('Watch', 'poll_interval', fallback=0.5)
+        self.max_poll_interval = parser.getfloat('Watch', 'max_poll_interval', fallback=5.0)
+        self.claim_files = parser.getboolean('Watch', 'claim', fallback=False)
+        self.worker_id = parser.get('Watch', 'worker_id', fallback=None) or None
+        self.claim_lease = parser.getfloat('Watch', 'claim_lease', fallback=300.0)
+        self.queue_policy = parser.get('Queue', 'policy', fallback='oldest')
+        self.small_file_size = parser.getint('Queue', 'small_file_size', fallback=1048576)
+        self.small_file_slo = parser.getfloat('Queue', 'small_file_slo', fallback=60.0)
+        self.archive_layout = parser.get('Archive', 'layout', fallback='flat')
+        self.compact_after_days = parser.getint('Archive', 'compact_after_days', fallback=None)
+        self.archive_compression = parser.get('Archive', 'compression', fallback='gz')
+        self.metrics_host = parser.get('Metrics', 'host', fallback='127.0.0.1')
+        self.metrics_port = parser.getint('Metrics', 'port', fallback=None)
+        textfile = parser.get('Metrics', 'textfile', fallback=None)
+        self.metrics_textfile = self._make_absolute(Path(textfile)) if textfile else None
 
 
 config = Config()
-config.load()
@@ -1,29 +1,1270 @@
 """SMRT Importer database functionality."""
 
 
-from sqlalchemy import create_engine
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from threading import Lock
+import zlib
+
+from sqlalchemy import create_engine, event, insert, inspect, orm, select
 from sqlalchemy.orm import sessionmaker
 
+from smrt_importer import metrics
+from smrt_importer.batch import RecordBatch, to_datetime
 from smrt_importer.config import config
-from smrt_importer.models import Base, File
+from smrt_importer.loader import DecodingError
+from smrt_importer.models import (
+    Base, DailyConsumption, File, ImportCheckpoint, Record, ShardFile
+)
+
+
+# Conflicts on the record primary key update the existing row in place, but
+# only if the consumption has changed, to avoid rewriting the row and its
+# index entry. Executed directly by the driver, so values must already be
+# converted for storage.
+_UPSERT_RECORD = (
+    'INSERT INTO record (file_id, meter_number, measurement_time, consumption) '
+    'VALUES (?, ?, ?, ?) '
+    'ON CONFLICT (meter_number, measurement_time) DO UPDATE SET '
+    'file_id = excluded.file_id, consumption = excluded.consumption '
+    'WHERE consumption IS NOT excluded.consumption'
+)
+
+
+# Daily rollups are updated with deltas. Minimum and maximum can only be
+# updated this way when readings are added, so are recalculated for any day
+# where an existing reading changes.
+_UPSERT_ROLLUP = (
+    'INSERT INTO daily_consumption (meter_number, day, total, count, minimum, maximum) '
+    'VALUES (?, ?, ?, ?, ?, ?) '
+    'ON CONFLICT (meter_number, day) DO UPDATE SET '
+    'total = total + excluded.total, '
+    'count = count + excluded.count, '
+    'minimum = min(coalesce(minimum, excluded.minimum), coalesce(excluded.minimum, minimum)), '
+    'maximum = max(coalesce(maximum, excluded.maximum), coalesce(excluded.maximum, maximum))'
+)
+
+# Parameters: meter number, first and last possible time of day, day.
+_RECALCULATE_ROLLUP = (
+    'UPDATE daily_consumption SET (minimum, maximum) = ('
+    'SELECT min(consumption), max(consumption) FROM record '
+    'WHERE meter_number = ?1 AND measurement_time BETWEEN ?2 AND ?3'
+    ') WHERE meter_number = ?1 AND day = ?4'
+)
+
+_REBUILD_ROLLUPS = (
+    'INSERT INTO daily_consumption (meter_number, day, total, count, minimum, maximum) '
+    'SELECT meter_number, date(measurement_time), total(consumption), count(consumption), '
+    'min(consumption), max(consumption) '
+    'FROM record GROUP BY meter_number, date(measurement_time)'
+)
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    """Apply configured pragmas to each new DB connection."""
+
+    # The busy timeout is set first, as changing the journal mode needs a
+    # lock, which another instance may hold.
+    pragmas = sorted(config.db_pragmas.items(), key=lambda item: item[0] != 'busy_timeout')
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+    # Stop the driver beginning transactions itself, as it only does so
+    # before DML, which breaks savepoints. See `_begin`.
+    dbapi_connection.isolation_level = None
+
+
+def _begin(connection):
+    if connection.get_execution_options().get('immediate'):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+    else:
+        connection.exec_driver_sql('BEGIN')
+
+
+def _create_engine(path):
+    engine = create_engine(f'sqlite+pysqlite:///{path}')
+    event.listen(engine, 'connect', _set_pragmas)
+    event.listen(engine, 'begin', _begin)
+    return engine
+
+
+# Tables holding records, which are split between shards if sharding is
+# enabled, and the other tables, which are always in the main DB.
+RECORD_TABLES = [Record.__table__, DailyConsumption.__table__]
+CATALOG_TABLES = [File.__table__, ImportCheckpoint.__table__]
+# Shards also hold the creation times of the files whose records they hold.
+SHARD_TABLES = RECORD_TABLES + [ShardFile.__table__]
+
+
+def shard_path(index):
+    """Return the path of a shard's database file."""
+
+    return config.db_path.with_name(f'{config.db_path.name}.shard{index}')
+
+
+def create_shard_engine(path, catalog_engine=None):
+    """Create an engine for a shard, creating its tables if necessary.
+
+    catalog_engine: engine for the main DB, from which the creation times of
+        the files with records in an existing shard are copied, if the shard
+        predates them being stored.
+    """
+
+    shard_engine = _create_engine(path)
+    _create_record_tables(shard_engine, SHARD_TABLES, catalog_engine)
+    return shard_engine
+
+
+def _write_connection(db_engine):
+    """Connect to a DB for writing.
+
+    Its transactions take the write lock as they begin, waiting for other
+    instances (up to `busy_timeout`) if necessary. Otherwise, a transaction
+    which reads before writing fails immediately if another instance writes
+    in between.
+    """
+
+    return db_engine.connect().execution_options(immediate=True)
+
+
+@contextmanager
+def _schema_transaction(db_engine):
+    """Yield a connection in a transaction holding the DB's write lock, so
+    instances starting at the same time don't both create or migrate the
+    schema.
+    """
+
+    with _write_connection(db_engine) as connection:
+        with connection.begin():
+            yield connection
+
+
+def _schema_current(db_engine, tables):
+    """Return True if a DB already has the given tables, with all their
+    columns and indexes, so the schema needn't be created or migrated.
+
+    Only reads the schema, so doesn't wait for the write lock, which another
+    instance may hold for a while.
+    """
+
+    with db_engine.connect() as connection:
+        inspector = inspect(connection)
+        for table in tables:
+            if not inspector.has_table(table.name):
+                return False
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            if not set(table.columns.keys()) <= columns \
+                    or not {index.name for index in table.indexes} <= indexes:
+                return False
+    return True
+
+
+def _create_record_tables(record_engine, tables=RECORD_TABLES, catalog_engine=None):
+    if _schema_current(record_engine, tables):
+        return
+
+    with _schema_transaction(record_engine) as connection:
+        inspector = inspect(connection)
+        has_rollups = inspector.has_table(DailyConsumption.__tablename__)
+        has_files = inspector.has_table(ShardFile.__tablename__)
+        Base.metadata.create_all(connection, tables=tables)
+
+        # Records imported before rollups existed need adding to them.
+        if not has_rollups:
+            _rebuild_rollups(connection)
+        # Likewise for the creation times of shards' files.
+        if ShardFile.__table__ in tables and not has_files and catalog_engine is not None:
+            _copy_creation_times(connection, catalog_engine)
+
+
+def _copy_creation_times(shard_connection, catalog_engine):
+    """Copy the creation times of the files with records in a shard from the
+    main DB.
+    """
+
+    with catalog_engine.connect() as catalog_connection:
+        result = catalog_connection.exec_driver_sql('SELECT id, creation_time FROM file')
+        for rows in _batched(map(tuple, result), config.batch_size):
+            shard_connection.exec_driver_sql(
+                'INSERT INTO shard_file (id, creation_time) VALUES (?, ?)', rows
+            )
+    shard_connection.exec_driver_sql(
+        'DELETE FROM shard_file WHERE id NOT IN (SELECT file_id FROM record)'
+    )
+
+
+def _rebuild_rollups(connection):
+    connection.exec_driver_sql('DELETE FROM daily_consumption')
+    connection.exec_driver_sql(_REBUILD_ROLLUPS)
+
+
+def rebuild_rollups():
+    """Recalculate all daily rollups from the record table."""
+
+    for record_engine in record_engines():
+        with record_engine.begin() as connection:
+            _rebuild_rollups(connection)
+
+
+def _add_content_hash(connection):
+    """Add the content hash column to a file table created before it
+    existed.
+    """
+
+    columns = inspect(connection).get_columns(File.__tablename__)
+    if any(column['name'] == 'content_hash' for column in columns):
+        return
+
+    connection.exec_driver_sql('ALTER TABLE file ADD COLUMN content_hash CHAR(64)')
+    connection.exec_driver_sql('CREATE INDEX ix_file_content_hash ON file (content_hash)')
+
+
+# The module attributes `engine`, `shard_engines` and `shard_writers` are
+# created on first use by `_setup`, so importing this module does not touch
+# the config or DB.
+_LAZY_ATTRIBUTES = ('engine', 'shard_engines', 'shard_writers')
+_setup_lock = Lock()
+
+
+def _setup():
+    """Create the engines and schema, if not already done."""
+
+    global engine, shard_engines, shard_writers
+
+    # `engine` is assigned last, so marks setup as complete.
+    if 'engine' in globals():
+        return
+
+    with _setup_lock:
+        if 'engine' in globals():
+            return
+
+        config.db_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        catalog_engine = _create_engine(config.db_path)
+
+        # If sharding, `engine` is the catalog, holding only the file table.
+        # Records are held in the shards, partitioned by meter number.
+        if not _schema_current(catalog_engine, CATALOG_TABLES):
+            with _schema_transaction(catalog_engine) as connection:
+                Base.metadata.create_all(connection, tables=CATALOG_TABLES)
+                _add_content_hash(connection)
+        if config.shards > 1:
+            shard_engines = [
+                create_shard_engine(shard_path(i), catalog_engine) for i in range(config.shards)
+            ]
+        else:
+            shard_engines = []
+            _create_record_tables(catalog_engine)
+        shard_writers = [ShardWriter(shard_engine) for shard_engine in shard_engines]
+
+        engine = catalog_engine
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        _setup()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def get_engine():
+    """Return the engine for the main DB, creating it and the schema on
+    first use.
+    """
+
+    _setup()
+    return engine
+
+
+class _Session(orm.Session):
+    """Session bound to the main DB by default, which is set up when the
+    first session is created.
+    """
+
+    def __init__(self, bind=None, **kwargs):
+        super().__init__(get_engine() if bind is None else bind, **kwargs)
+
+
+Session = sessionmaker(class_=_Session)
+
+
+def record_engines():
+    """Return the engines for all databases holding records."""
+
+    _setup()
+    return shard_engines or [engine]
+
+
+def shard_index(meter_number):
+    """Return the index of the shard holding a meter's records.
+
+    Uses a stable hash, so a meter always maps to the same shard.
+    """
+
+    _setup()
+    return zlib.crc32(meter_number.encode()) % len(shard_engines)
+
+
+def record_engine_for(meter_number):
+    """Return the engine for the database holding a meter's records."""
+
+    _setup()
+    if not shard_engines:
+        return engine
+    return shard_engines[shard_index(meter_number)]
+
+
+class FilenameIndex:
+    """In-memory index of the filenames of imported files.
+
+    Loaded from the DB on first use, then kept up to date as files are
+    inserted. The unique constraint on `File.filename` remains the
+    authoritative check.
+    """
+
+    def __init__(self):
+        self._filenames = None
+
+    def load(self):
+        """(Re)load the index from the DB."""
+
+        # Files with a checkpoint are still being imported.
+        statement = select(File.filename).where(
+            File.id.not_in(select(ImportCheckpoint.file_id))
+        )
+        with Session() as session:
+            self._filenames = set(session.execute(statement).scalars())
+
+    def add(self, filename):
+        """Record that a file has been imported."""
+
+        if self._filenames is not None:
+            self._filenames.add(filename)
+
+    def __contains__(self, filename):
+        if self._filenames is None:
+            self.load()
+        return filename in self._filenames
+
+
+imported_filenames = FilenameIndex()
+
+
+class DuplicateFileError(Exception):
+    """Raised when a file's contents are identical to a file already
+    imported under another name.
+    """
+
+    def __init__(self, filename, original):
+        super().__init__(f'same contents as {original}')
+        self.filename = filename
+        self.original = original
+
+
+def _check_content_hash(connection, file: File, file_id=None):
+    """Raise DuplicateFileError if a file with the same content hash has
+    been imported.
+
+    file_id: ID of the file's own row, if already inserted, which is ignored.
+    """
+
+    statement = select(File.filename).where(File.content_hash == file.content_hash)
+    if file_id is not None:
+        statement = statement.where(File.id != file_id)
+    original = connection.execute(statement.limit(1)).scalar()
+    if original is not None:
+        raise DuplicateFileError(file.filename, original)
+
+
+def _save_content_hash(connection, file: File, file_id):
+    """Check and store the content hash of a file whose row was inserted
+    before it had been read to the end, as when streaming.
+    """
+
+    _check_content_hash(connection, file, file_id)
+    connection.execute(
+        File.__table__.update().where(File.id == file_id)
+            .values(content_hash=file.content_hash)
+    )
+
+
+def _batched(iterable, size):
+    """Split an iterable into lists of at most `size` items."""
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _format_datetime(timestamp):
+    """Format a datetime as stored by SQLAlchemy's SQLite DateTime type."""
+
+    return timestamp.isoformat(' ', 'microseconds')
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    """Return the numpy module, or None if not installed. Imported on first
+    use, as it is slow to import.
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _format_times(batch: RecordBatch):
+    """Return the measurement times of a batch formatted for storage."""
+
+    numpy = _numpy()
+    if numpy is not None:
+        times = numpy.frombuffer(batch.times, dtype=numpy.int64).astype('datetime64[s]')
+        strings = numpy.datetime_as_string(times, unit='us')
+        return numpy.char.replace(strings, 'T', ' ').tolist()
+
+    # Many records share the same time, so only convert and format each once.
+    formatted = {}
+    result = []
+    for seconds in batch.times:
+        string = formatted.get(seconds)
+        if string is None:
+            string = formatted[seconds] = _format_datetime(to_datetime(seconds))
+        result.append(string)
+    return result
+
+
+def _record_params(file_id, chunk):
+    """Convert a chunk of records into parameters for `_UPSERT_RECORD`.
+
+    chunk: RecordBatch, or list of `(meter_number, measurement_time,
+        consumption)` tuples.
+    """
+
+    if isinstance(chunk, RecordBatch):
+        meters = chunk.meters
+        return [
+            (file_id, meters[code], time, consumption)
+            for code, time, consumption
+            in zip(chunk.meter_codes, _format_times(chunk), chunk.consumptions)
+        ]
+
+    return [
+        (file_id, meter_number, _format_datetime(measurement_time), consumption)
+        for meter_number, measurement_time, consumption in chunk
+    ]
+
+
+# Number of records written as new rows, written over changed values, and
+# skipped as they matched the stored value.
+RecordCounts = namedtuple('RecordCounts', 'inserted updated unchanged')
+
+
+def _existing_records(connection, keys, creation_time=None, file_table=File.__tablename__):
+    """Return a dict of the stored consumption and file ID of each existing
+    record, and whether the file it came from has a later header creation
+    time.
+
+    keys: `(meter_number, measurement_time)` tuples, with times formatted for
+        storage.
+    creation_time: creation time of the file being written, or None if no
+        stored record is newer.
+    file_table: table holding the creation times of the files, `file` in the
+        main DB or `shard_file` in a shard.
+    """
+
+    if not keys:
+        # E.g. a file with no records, which executemany can't insert.
+        return {}
+
+    connection.exec_driver_sql(
+        'CREATE TEMP TABLE IF NOT EXISTS record_key '
+        '(meter_number TEXT NOT NULL, measurement_time TEXT NOT NULL)'
+    )
+    connection.exec_driver_sql('DELETE FROM record_key')
+    connection.exec_driver_sql('INSERT INTO record_key VALUES (?, ?)', list(keys))
+    result = connection.exec_driver_sql(
+        'SELECT r.meter_number, r.measurement_time, r.consumption, r.file_id, '
+        'f.creation_time > ? '
+        'FROM record_key AS k JOIN record AS r '
+        'ON r.meter_number = k.meter_number AND r.measurement_time = k.measurement_time '
+        f'LEFT JOIN {file_table} AS f ON f.id = r.file_id',
+        (None if creation_time is None else _format_datetime(creation_time),)
+    )
+    return {
+        (meter_number, time): (consumption, file_id, bool(newer))
+        for meter_number, time, consumption, file_id, newer in result
+    }
+
+
+def _prepare_write(connection, params, creation_time=None, file_table=File.__tablename__):
+    """Work out which records need writing, and the resulting changes to the
+    daily rollups.
+
+    Records repeated within `params` are deduplicated, the last one winning.
+    Records whose consumption matches the stored value, or whose stored value
+    came from a file with a later `creation_time`, are dropped. Records
+    already written by the same file, from an earlier chunk, are written
+    again if changed, but not counted again. Must be called before the
+    records are written, as it reads the stored values.
+
+    params: list of `_UPSERT_RECORD` parameters.
+    creation_time: header creation time of the file being written, or None
+        to overwrite records whatever file they came from.
+    file_table: see `_existing_records`.
+
+    Returns a `(params, rollups, counts)` tuple, where `params` are the
+    parameters to write, `rollups` is passed to `_apply_rollups` and `counts`
+    is a RecordCounts.
+    """
+
+    # Later records for the same meter and time overwrite earlier ones.
+    new = {(row[1], row[2]): row for row in params}
+    old = _existing_records(connection, new.keys(), creation_time, file_table)
+
+    changed = []
+    inserted = updated = unchanged = 0
+    deltas = {}
+    recalculate = set()
+    for key, row in new.items():
+        meter_number, time = key
+        consumption = row[3]
+        group = meter_number, time[:10]
+
+        existing = key in old
+        if existing:
+            old_consumption, old_file_id, newer = old[key]
+            # Written by an earlier chunk of the same file, so already counted.
+            repeated = old_file_id == row[0]
+            # So files can be imported in any order, and newer readings win.
+            if old_consumption == consumption or newer:
+                unchanged += not repeated
+                continue
+        changed.append(row)
+
+        delta = deltas.get(group)
+        if delta is None:
+            delta = deltas[group] = [0.0, 0, None, None]
+
+        if existing:
+            updated += not repeated
+            recalculate.add(group)
+            if old_consumption is not None:
+                delta[0] -= old_consumption
+                delta[1] -= 1
 
+        else:
+            inserted += 1
 
-config.db_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
-engine = create_engine(f'sqlite+pysqlite:///{config.db_path}')
-Session = sessionmaker(engine)
+        if consumption is not None:
+            delta[0] += consumption
+            delta[1] += 1
+            delta[2] = consumption if delta[2] is None else min(delta[2], consumption)
+            delta[3] = consumption if delta[3] is None else max(delta[3], consumption)
 
-Base.metadata.create_all(engine)
+    return changed, (deltas, recalculate), RecordCounts(inserted, updated, unchanged)
+
+
+def _apply_rollups(connection, rollups):
+    """Apply changes from `_prepare_write`, once the records are written."""
+
+    deltas, recalculate = rollups
+    if deltas:
+        connection.exec_driver_sql(_UPSERT_ROLLUP, [
+            (meter_number, day, *delta) for (meter_number, day), delta in deltas.items()
+        ])
+    if recalculate:
+        connection.exec_driver_sql(_RECALCULATE_ROLLUP, [
+            (meter_number, f'{day} 00:00:00.000000', f'{day} 23:59:59.999999', day)
+            for meter_number, day in recalculate
+        ])
+
+
+def _write_records(connection, params, creation_time=None, file_table=File.__tablename__):
+    """Write new and changed records and update the daily rollups.
+
+    params: list of `_UPSERT_RECORD` parameters.
+    creation_time, file_table: see `_prepare_write`.
+
+    Returns a RecordCounts.
+    """
+
+    changed, rollups, counts = _prepare_write(connection, params, creation_time, file_table)
+    if changed:
+        connection.exec_driver_sql(_UPSERT_RECORD, changed)
+    _apply_rollups(connection, rollups)
+    return counts
+
+
+class ShardWriter:
+    """Writes records to a shard within a transaction.
+
+    All work happens on a dedicated thread, which owns the shard's
+    connection, so shards can be written to concurrently.
+    """
+
+    def __init__(self, shard_engine):
+        self.engine = shard_engine
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shard-writer')
+        self._connection = None
+        self._transaction = None
+        self._savepoint = None
+
+    def _begin(self):
+        self._connection = _write_connection(self.engine)
+        self._transaction = self._connection.begin()
+
+    def _write(self, params, creation_time):
+        if self._connection is None:
+            self._begin()
+        # All rows are for the same file.
+        self._connection.exec_driver_sql(
+            'INSERT OR REPLACE INTO shard_file (id, creation_time) VALUES (?, ?)',
+            (params[0][0], _format_datetime(creation_time))
+        )
+        return _write_records(
+            self._connection, params, creation_time, ShardFile.__tablename__
+        )
+
+    def _begin_savepoint(self):
+        if self._connection is None:
+            self._begin()
+        self._savepoint = self._connection.begin_nested()
+
+    def _end_savepoint(self, release):
+        savepoint, self._savepoint = self._savepoint, None
+        if savepoint is None:
+            return
+        if release:
+            savepoint.commit()
+        else:
+            savepoint.rollback()
+
+    def _end(self, commit):
+        if self._connection is None:
+            return
+        try:
+            if commit:
+                self._transaction.commit()
+            else:
+                self._transaction.rollback()
+        finally:
+            self._connection.close()
+            self._connection = self._transaction = self._savepoint = None
+
+    def write(self, params, creation_time):
+        """Start writing a file's records, as `_write_records`, storing the
+        file's creation time in the shard. Returns a Future for a
+        RecordCounts.
+        """
+
+        return self._executor.submit(self._write, params, creation_time)
+
+    def commit(self):
+        """Commit any records written. Returns a Future."""
+
+        return self._executor.submit(self._end, True)
+
+    def rollback(self):
+        """Roll back any records written. Returns a Future."""
+
+        return self._executor.submit(self._end, False)
+
+    def savepoint(self):
+        """Begin a savepoint within the transaction. Returns a Future."""
+
+        return self._executor.submit(self._begin_savepoint)
+
+    def release_savepoint(self):
+        """Keep records written since the savepoint. Returns a Future."""
+
+        return self._executor.submit(self._end_savepoint, True)
+
+    def rollback_savepoint(self):
+        """Roll back records written since the savepoint. Returns a Future."""
+
+        return self._executor.submit(self._end_savepoint, False)
+
+
+def _wait(futures):
+    """Wait for all futures to complete, then raise the first exception, if
+    any.
+    """
+
+    exceptions = [future.exception() for future in futures]
+    for exception in exceptions:
+        if exception is not None:
+            raise exception
+
+
+def _add_counts(counts):
+    """Total an iterable of RecordCounts."""
+
+    return RecordCounts(*map(sum, zip(RecordCounts(0, 0, 0), *counts)))
+
+
+def _write_sharded(params, creation_time):
+    """Write a file's records to their shards, concurrently. Returns a
+    RecordCounts.
+    """
+
+    partitions = [[] for _ in shard_writers]
+    for row in params:
+        partitions[shard_index(row[1])].append(row)
+
+    futures = [
+        writer.write(partition, creation_time)
+        for writer, partition in zip(shard_writers, partitions)
+        if partition
+    ]
+    _wait(futures)
+    return _add_counts(future.result() for future in futures)
+
+
+def _total_records(counts: RecordCounts):
+    """Total the results of writing a file's records, for its log line."""
+
+    for result, count in counts._asdict().items():
+        metrics.total_file_records(result, count)
+
+
+def _count_records(counts: RecordCounts):
+    """Record the results of writing records, once committed."""
+
+    for result, count in counts._asdict().items():
+        metrics.count_records(result, count)
 
 
 def insert_file(file: File):
-    """Inserts a file (potentially containing records) into the DB.
+    """Inserts a file (potentially containing records) into the DB, updating
+    the daily rollups.
+
+    If sharding is enabled, this uses `bulk_insert_file`.
+
+    Raises DuplicateFileError, before writing anything, if a file with the
+    same `content_hash` has already been imported.
     
     Returns the ID of the newly inserted row.
     """
 
+    _setup()
+    if shard_engines:
+        return bulk_insert_file(file)
+
+    rows = [
+        (record.meter_number, record.measurement_time, record.consumption)
+        for record in file.records
+    ]
+
     with Session() as session:
-        session.add(file)
-        session.commit()
-        file_id = file.id
+        with metrics.stage('insert'):
+            connection = session.connection(execution_options={'immediate': True})
+            if file.content_hash is not None:
+                _check_content_hash(connection, file)
+            params = _record_params(None, rows)
+            changed, rollups, counts = _prepare_write(connection, params, file.creation_time)
+
+            # Only save the last record for each new or changed value, using
+            # copies so the caller's file and records are left unchanged.
+            keys = {(row[1], row[2]) for row in changed}
+            records = {}
+            for record, row in zip(file.records, params):
+                if (row[1], row[2]) in keys:
+                    records[row[1], row[2]] = record
+            saved = File(
+                filename=file.filename,
+                creation_time=file.creation_time,
+                imported_time=file.imported_time,
+                gen_num=file.gen_num,
+                content_hash=file.content_hash,
+                records=[
+                    Record(
+                        meter_number=record.meter_number,
+                        measurement_time=record.measurement_time,
+                        consumption=record.consumption
+                    )
+                    for record in records.values()
+                ]
+            )
+
+            session.add(saved)
+            session.flush()
+            _apply_rollups(connection, rollups)
+            # As `_stamp_imported`.
+            saved.imported_time = file.imported_time = datetime.now()
+        with metrics.stage('commit'):
+            session.commit()
+        file_id = saved.id
+
+    _total_records(counts)
+    _count_records(counts)
+    imported_filenames.add(file.filename)
+    return file_id
+
+
+def _insert_file_row(connection, file: File):
+    """Insert the row for a file (without records) and return its ID."""
+
+    result = connection.execute(
+        insert(File.__table__).values(
+            filename=file.filename,
+            creation_time=file.creation_time,
+            imported_time=file.imported_time,
+            gen_num=file.gen_num,
+            content_hash=file.content_hash
+        )
+    )
+    file_id, = result.inserted_primary_key
+    return file_id
+
+
+def _stamp_imported(connection, file: File, file_id):
+    """Set a file's imported time to now, just before its transaction is
+    committed. Write transactions are serialised, so files are stamped in
+    the order they are committed, and the times can be used as a watermark
+    by incremental exports.
+    """
+
+    file.imported_time = datetime.now()
+    connection.execute(
+        File.__table__.update().where(File.id == file_id)
+            .values(imported_time=file.imported_time)
+    )
+
+
+def _write_file(connection, file: File, chunks, batch_size):
+    """Write a file row and its records within the current transaction (and
+    those of the shard writers). See `bulk_insert_file`.
+
+    Returns a tuple of the ID of the new file row and a RecordCounts, which
+    is only recorded by the caller once committed.
+    """
+
+    if chunks is None:
+        if batch_size is None:
+            batch_size = config.batch_size
+        rows = (
+            (record.meter_number, record.measurement_time, record.consumption)
+            for record in file.records
+        )
+        chunks = _batched(rows, batch_size)
+
+    content_hash = file.content_hash
+    if content_hash is not None:
+        # Known up front if the file was loaded in full, so a duplicate is
+        # found before any records are written.
+        _check_content_hash(connection, file)
+
+    file_id = None
+    counts = []
+    for chunk in chunks:
+        with metrics.stage('insert'):
+            if file_id is None:
+                # Once the first chunk is read, the header has been too.
+                file_id = _insert_file_row(connection, file)
+            params = _record_params(file_id, chunk)
+            if shard_writers:
+                counts.append(_write_sharded(params, file.creation_time))
+            else:
+                counts.append(_write_records(connection, params, file.creation_time))
+
+    if file_id is None:
+        if content_hash is None and file.content_hash is not None:
+            _check_content_hash(connection, file)
+        file_id = _insert_file_row(connection, file)
+    elif content_hash is None and file.content_hash is not None:
+        # A streamed file is only hashed once read to the end, so the records
+        # of a duplicate are rolled back rather than never written.
+        _save_content_hash(connection, file, file_id)
+
+    return file_id, _add_counts(counts)
+
+
+def _commit_catalog(transaction, file_ids):
+    """Commit a transaction on the catalog DB, once the shards have been
+    committed. If the commit fails, the records just committed to the shards
+    for the files are deleted, so they aren't left without a file row, or
+    attributed to a later file given the same ID.
+    """
+
+    try:
+        transaction.commit()
+    except Exception:
+        for shard_engine in shard_engines:
+            with _write_connection(shard_engine) as shard_connection, shard_connection.begin():
+                for file_id in file_ids:
+                    _delete_shard_records(shard_connection, file_id)
+        raise
+
+
+def bulk_insert_file(file: File, chunks=None, batch_size=None):
+    """Inserts a file and its records into the DB, bypassing the ORM.
+
+    The file row is inserted first, then records are written using batched
+    upserts, updating the daily rollups. Records repeated within a chunk are
+    written once (the last one winning), and records matching the stored
+    value are skipped. Records written by a file with a later header creation
+    time are kept, so newer readings win whatever order files are imported
+    in. Everything is written in a single transaction.
+
+    If a file with the same `content_hash` has already been imported,
+    DuplicateFileError is raised and nothing is saved. The hash is checked
+    before any records are written if it is set when this is called,
+    otherwise once `chunks` is exhausted.
+
+    If sharding is enabled, records are written to each shard concurrently,
+    in a transaction per shard. The shards are committed before the file row,
+    so the file is only recorded as imported once all its records are saved.
+    If the file row then fails to commit, its records are deleted from the
+    shards.
+
+    file: File object.
+    chunks: iterable of RecordBatch objects or lists of `(meter_number,
+        measurement_time, consumption)` tuples, one statement being executed
+        per chunk. This may be produced lazily whilst `file` is loaded (see
+        `SMRTLoader.stream_file`): the file row is inserted once the first
+        chunk is available, and any exception raised whilst iterating rolls
+        back everything written so far. Defaults to the records attached to
+        `file`.
+    batch_size: number of records per statement when `chunks` is not given.
+        Defaults to the configured batch size.
+
+    Returns the ID of the newly inserted row.
+    """
+
+    _setup()
+    with _write_connection(engine) as connection, connection.begin() as transaction:
+        try:
+            file_id, counts = _write_file(connection, file, chunks, batch_size)
+            _stamp_imported(connection, file, file_id)
+            with metrics.stage('commit'):
+                _wait([writer.commit() for writer in shard_writers])
+                _commit_catalog(transaction, [file_id])
+
+        except BaseException:
+            _wait([writer.rollback() for writer in shard_writers])
+            raise
+
+    _total_records(counts)
+    _count_records(counts)
+    imported_filenames.add(file.filename)
+    return file_id
+
+
+class FileGroup:
+    """Inserts several files into the DB in a single transaction, so they
+    share one commit.
+
+    Each file is written within a savepoint, so a file which fails is rolled
+    back on its own without affecting the rest of the group. Nothing is saved
+    until `commit` is called.
+
+    Can be used as a context manager, rolling back anything not committed on
+    exit. If sharding is enabled, the shard writers are shared, so no other
+    files may be inserted whilst a group is open.
+    """
+
+    def __init__(self):
+        self.filenames = []
+        self._files = []
+        self._file_ids = []
+        self._counts = []
+        self._connection = _write_connection(get_engine())
+        # Begun by the first file added, so waiting for the write lock, or
+        # failing to get it, happens whilst importing that file.
+        self._transaction = None
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, file: File, chunks=None, batch_size=None):
+        """Write a file and its records, as `bulk_insert_file`.
+
+        Any exception rolls back this file only, then is re-raised.
+
+        Returns the ID of the newly inserted row.
+        """
+
+        if self._transaction is None:
+            self._transaction = self._connection.begin()
+        savepoint = self._connection.begin_nested()
+        try:
+            _wait([writer.savepoint() for writer in shard_writers])
+            file_id, counts = _write_file(self._connection, file, chunks, batch_size)
+        except BaseException:
+            _wait([writer.rollback_savepoint() for writer in shard_writers])
+            savepoint.rollback()
+            raise
+
+        _wait([writer.release_savepoint() for writer in shard_writers])
+        savepoint.commit()
+        self.filenames.append(file.filename)
+        self._files.append(file)
+        self._file_ids.append(file_id)
+        # Totalled for the file now, but only counted once committed.
+        _total_records(counts)
+        self._counts.append(counts)
+        return file_id
+
+    def commit(self):
+        """Commit all files added. Shards are committed first, as for
+        `bulk_insert_file`.
+        """
+
+        if self._transaction is None:
+            return
+
+        try:
+            for file, file_id in zip(self._files, self._file_ids):
+                _stamp_imported(self._connection, file, file_id)
+            with metrics.stage('commit'):
+                _wait([writer.commit() for writer in shard_writers])
+                _commit_catalog(self._transaction, self._file_ids)
+        except BaseException:
+            self.rollback()
+            raise
+
+        _count_records(_add_counts(self._counts))
+        for filename in self.filenames:
+            imported_filenames.add(filename)
+
+    def rollback(self):
+        """Roll back all files added."""
+
+        _wait([writer.rollback() for writer in shard_writers])
+        if self._transaction is not None and self._transaction.is_active:
+            self._transaction.rollback()
+
+    def close(self):
+        if self._transaction is not None and self._transaction.is_active:
+            self.rollback()
+        self._connection.close()
+
+
+def _delete_file_records(connection, file_id):
+    """Delete a file's records, recalculating the daily rollups they were
+    part of.
+    """
+
+    connection.exec_driver_sql(
+        'CREATE TEMP TABLE IF NOT EXISTS rollup_key '
+        '(meter_number TEXT NOT NULL, day TEXT NOT NULL)'
+    )
+    connection.exec_driver_sql('DELETE FROM rollup_key')
+    connection.exec_driver_sql(
+        'INSERT INTO rollup_key SELECT DISTINCT meter_number, date(measurement_time) '
+        'FROM record WHERE file_id = ?',
+        (file_id,)
+    )
+    connection.exec_driver_sql('DELETE FROM record WHERE file_id = ?', (file_id,))
+    connection.exec_driver_sql(
+        'DELETE FROM daily_consumption '
+        'WHERE (meter_number, day) IN (SELECT meter_number, day FROM rollup_key)'
+    )
+    connection.exec_driver_sql(
+        'INSERT INTO daily_consumption (meter_number, day, total, count, minimum, maximum) '
+        'SELECT r.meter_number, k.day, total(r.consumption), count(r.consumption), '
+        'min(r.consumption), max(r.consumption) '
+        'FROM rollup_key AS k JOIN record AS r ON r.meter_number = k.meter_number '
+        "AND r.measurement_time BETWEEN k.day || ' 00:00:00.000000' AND k.day || ' 23:59:59.999999' "
+        'GROUP BY r.meter_number, k.day'
+    )
+
+
+def _delete_shard_records(shard_connection, file_id):
+    """Delete a file's records from a shard, as `_delete_file_records`, and
+    its creation time.
+    """
+
+    _delete_file_records(shard_connection, file_id)
+    shard_connection.exec_driver_sql('DELETE FROM shard_file WHERE id = ?', (file_id,))
+
+
+def _discard_file(connection, file_id):
+    """Delete a partially imported file, its records and its checkpoint."""
+
+    checkpoint = ImportCheckpoint.__table__
+
+    # If interrupted part way through, resuming restarts from the beginning.
+    with connection.begin():
+        connection.execute(
+            checkpoint.update().where(checkpoint.c.file_id == file_id)
+                .values(offset=0, record_count=0)
+        )
+
+    for shard_engine in shard_engines:
+        with shard_engine.begin() as shard_connection:
+            _delete_shard_records(shard_connection, file_id)
+
+    with connection.begin():
+        if not shard_engines:
+            _delete_file_records(connection, file_id)
+        connection.execute(checkpoint.delete().where(checkpoint.c.file_id == file_id))
+        connection.execute(File.__table__.delete().where(File.id == file_id))
+
+
+def _save_checkpoint(connection, file_id, offset, record_count):
+    connection.exec_driver_sql(
+        'INSERT OR REPLACE INTO import_checkpoint '
+        '(file_id, "offset", record_count, updated_time) VALUES (?, ?, ?, ?)',
+        (file_id, offset, record_count, _format_datetime(datetime.now()))
+    )
+
+
+def get_checkpoint(filename):
+    """Return the ImportCheckpoint of a file partially imported by
+    `insert_file_resumable`, or None.
+
+    filename: name the file is recorded under.
+    """
+
+    statement = select(ImportCheckpoint).join(File, File.id == ImportCheckpoint.file_id) \
+        .where(File.filename == filename)
+    with Session() as session:
+        return session.execute(statement).scalar()
+
+
+def discard_import(checkpoint: ImportCheckpoint):
+    """Delete a file partially imported by `insert_file_resumable`, with its
+    records and checkpoint, so it can be imported again from the start. Any
+    older values its records replaced are not restored.
+
+    checkpoint: the file's checkpoint, from `get_checkpoint`.
+    """
+
+    _setup()
+    with _write_connection(engine) as connection:
+        _discard_file(connection, checkpoint.file_id)
+
+
+def insert_file_resumable(file: File, chunks, checkpoint: ImportCheckpoint = None,
+                          checkpoint_rows=None):
+    """Inserts a file and its records into the DB, committing in chunks so
+    the import can be resumed if the process is killed.
+
+    Records are written as by `bulk_insert_file`. Each time at least
+    `checkpoint_rows` records have been written, they are committed along
+    with a checkpoint of the offset reached. The file only counts as imported
+    once all chunks have been written (so its trailer has been validated) and
+    the checkpoint is deleted.
+
+    If an exception is raised, everything written for the file is deleted,
+    although any older values its records replaced are not restored. If the
+    process is killed (or interrupted), the checkpoint is kept. If the file
+    has a `content_hash` once all chunks have been read, it is checked as by
+    `bulk_insert_file`.
+
+    file: File object.
+    chunks: iterable of `(chunk, offset)` tuples, as yielded by
+        `SMRTLoader.stream_file_resumable`, starting from `checkpoint`.
+    checkpoint: checkpoint to resume from, from `get_checkpoint`.
+    checkpoint_rows: number of records per commit. Defaults to the
+        configured number.
+
+    Returns the ID of the file row.
+    """
+
+    _setup()
+    if checkpoint_rows is None:
+        checkpoint_rows = config.checkpoint_rows
+
+    if checkpoint is None:
+        file_id = None
+        record_count = 0
+    else:
+        file_id = checkpoint.file_id
+        record_count = checkpoint.record_count
+
+    def check_header():
+        # A different file may have arrived with the same name.
+        stored = connection.execute(
+            select(File.creation_time, File.gen_num).where(File.id == file_id)
+        ).one()
+        if tuple(stored) != (file.creation_time, file.gen_num):
+            raise DecodingError('file header changed since checkpoint')
+
+    with _write_connection(engine) as connection:
+        transaction = connection.begin()
+        try:
+            # The header is only read once the first chunk is requested.
+            header_checked = file_id is None
+            counts = []
+            uncommitted = 0
+            for chunk, offset in chunks:
+                with metrics.stage('insert'):
+                    if not header_checked:
+                        check_header()
+                        header_checked = True
+                    if file_id is None:
+                        file_id = _insert_file_row(connection, file)
+                    params = _record_params(file_id, chunk)
+                    if shard_writers:
+                        counts.append(_write_sharded(params, file.creation_time))
+                    else:
+                        counts.append(_write_records(connection, params, file.creation_time))
+
+                record_count += len(chunk)
+                uncommitted += len(chunk)
+                if uncommitted >= checkpoint_rows:
+                    with metrics.stage('commit'):
+                        _save_checkpoint(connection, file_id, offset, record_count)
+                        _wait([writer.commit() for writer in shard_writers])
+                        _commit_catalog(transaction, [file_id])
+                    transaction = connection.begin()
+                    uncommitted = 0
+
+            if not header_checked:
+                check_header()
+            if file_id is None:
+                if file.content_hash is not None:
+                    _check_content_hash(connection, file)
+                file_id = _insert_file_row(connection, file)
+            elif file.content_hash is not None:
+                _save_content_hash(connection, file, file_id)
+            connection.execute(
+                ImportCheckpoint.__table__.delete()
+                    .where(ImportCheckpoint.file_id == file_id)
+            )
+            _stamp_imported(connection, file, file_id)
+            with metrics.stage('commit'):
+                _wait([writer.commit() for writer in shard_writers])
+                _commit_catalog(transaction, [file_id])
+
+        except BaseException as e:
+            _wait([writer.rollback() for writer in shard_writers])
+            if transaction.is_active:
+                transaction.rollback()
+            # Discard anything already committed, unless interrupted.
+            if isinstance(e, Exception) and file_id is not None:
+                committed = connection.execute(
+                    select(ImportCheckpoint.file_id).where(ImportCheckpoint.file_id == file_id)
+                ).first() is not None
+                connection.rollback()
+                if committed:
+                    _discard_file(connection, file_id)
+            raise
 
+    counts = _add_counts(counts)
+    _total_records(counts)
+    _count_records(counts)
+    imported_filenames.add(file.filename)
     return file_id
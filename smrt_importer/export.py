@@ -0,0 +1,239 @@
+"""SMRT Importer record export.
+
+Records are streamed from the DB in batches, in meter number and measurement
+time order, and written as CSV or, if pyarrow is installed, Parquet, so
+memory use does not grow with the number of records exported.
+
+Exports can be incremental: given the `imported_until` of the previous
+export, only records written by files imported since are included. Records
+overwritten by a later file belong to that file, so are exported again with
+their new value.
+"""
+
+
+from collections import namedtuple
+import csv
+from datetime import datetime, timedelta
+from functools import lru_cache
+import heapq
+import sys
+
+from sqlalchemy import column, func, select, table
+
+from smrt_importer.config import config
+from smrt_importer.db import get_engine, record_engines
+from smrt_importer.models import File, ImportCheckpoint, Record
+from smrt_importer.query import Reading
+
+
+FORMATS = ('csv', 'parquet')
+
+ExportResult = namedtuple('ExportResult', 'rows imported_until')
+
+# Temporary table of the files being exported incrementally.
+_EXPORT_FILE = table('export_file', column('id'))
+
+
+@lru_cache(maxsize=None)
+def _pyarrow():
+    """Return the pyarrow module, or None if not installed."""
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def _imported_files(since: datetime = None):
+    """Return the IDs of files imported after `since` (None if `since` is
+    None, meaning all files), and the import time to pass as `since` next
+    time.
+
+    Imported times are set as files are committed, in commit order, so no
+    file committed later can have an earlier time. Files still being imported
+    in resumable mode are left for a later export, so the returned time is
+    kept before they were imported.
+    """
+
+    in_progress = File.id.in_(select(ImportCheckpoint.file_id))
+    with get_engine().connect() as connection:
+        if since is None:
+            file_ids = None
+            imported_until = connection.execute(
+                select(func.max(File.imported_time)).where(~in_progress)
+            ).scalar()
+        else:
+            rows = connection.execute(
+                select(File.id, File.imported_time)
+                    .where(File.imported_time > since, ~in_progress)
+            ).all()
+            file_ids = [file_id for file_id, _ in rows]
+            imported_until = max((t for _, t in rows), default=since)
+
+        earliest_in_progress = connection.execute(
+            select(func.min(File.imported_time)).where(in_progress)
+        ).scalar()
+
+    if earliest_in_progress is not None and imported_until is not None:
+        imported_until = min(imported_until, earliest_in_progress - timedelta(microseconds=1))
+    return file_ids, imported_until
+
+
+def _stream(engine, statement, file_ids, batch_size):
+    """Yield the rows of a statement from one DB, fetching `batch_size` rows
+    at a time.
+
+    file_ids: if not None, only rows with these file IDs, which are loaded
+        into the temporary table `export_file`.
+    """
+
+    with engine.connect() as connection:
+        if file_ids is not None:
+            # A temporary table, rather than a list of parameters, so any
+            # number of files can be exported.
+            connection.exec_driver_sql(
+                'CREATE TEMP TABLE IF NOT EXISTS export_file (id INTEGER PRIMARY KEY)'
+            )
+            connection.exec_driver_sql('DELETE FROM export_file')
+            if file_ids:
+                connection.exec_driver_sql(
+                    'INSERT INTO export_file (id) VALUES (?)', [(i,) for i in file_ids]
+                )
+
+        result = connection.execution_options(yield_per=batch_size).execute(statement)
+        for partition in result.partitions():
+            yield from map(tuple, partition)
+
+        if file_ids is not None:
+            connection.exec_driver_sql('DROP TABLE export_file')
+        connection.commit()
+
+
+def stream_readings(meter_from=None, meter_to=None, start: datetime = None, end: datetime = None,
+                    file_ids=None, batch_size=None):
+    """Yield readings, without loading them all into memory.
+
+    meter_from: first meter number to include. Defaults to the lowest.
+    meter_to: last meter number to include. Defaults to the highest.
+    start: earliest measurement time to include. Defaults to the earliest.
+    end: latest measurement time to include. Defaults to the latest.
+    file_ids: only include records last written by these files. Defaults
+        to all files.
+    batch_size: number of rows fetched from each DB at a time. Defaults to
+        the configured batch size.
+
+    Yields Reading tuples, ordered by meter number and measurement time.
+    """
+
+    if batch_size is None:
+        batch_size = config.batch_size
+
+    statement = select(
+        Record.meter_number,
+        Record.measurement_time,
+        Record.consumption,
+        Record.file_id
+    ).order_by(Record.meter_number, Record.measurement_time)
+    if meter_from is not None:
+        statement = statement.where(Record.meter_number >= meter_from)
+    if meter_to is not None:
+        statement = statement.where(Record.meter_number <= meter_to)
+    if start is not None:
+        statement = statement.where(Record.measurement_time >= start)
+    if end is not None:
+        statement = statement.where(Record.measurement_time <= end)
+    if file_ids is not None:
+        statement = statement.where(Record.file_id.in_(select(_EXPORT_FILE.c.id)))
+
+    streams = [_stream(engine, statement, file_ids, batch_size) for engine in record_engines()]
+    for row in heapq.merge(*streams):
+        yield Reading(*row)
+
+
+def _batches(readings, batch_size):
+    batch = []
+    for reading in readings:
+        batch.append(reading)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _write_csv(f, batches):
+    writer = csv.writer(f)
+    writer.writerow(Reading._fields)
+    for batch in batches:
+        writer.writerows(batch)
+
+
+def _write_parquet(path, batches):
+    pyarrow = _pyarrow()
+    schema = pyarrow.schema([
+        ('meter_number', pyarrow.string()),
+        ('measurement_time', pyarrow.timestamp('us')),
+        ('consumption', pyarrow.float64()),
+        ('file_id', pyarrow.int64()),
+    ])
+    # Each batch is written as a row group, so only one is held in memory.
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(values, type) for values, type in zip(zip(*batch), schema.types)],
+                schema=schema
+            ))
+
+
+def export_records(path, format=None, meter_from=None, meter_to=None, start: datetime = None,
+                   end: datetime = None, imported_since: datetime = None, batch_size=None):
+    """Export records to a file, streaming them from the DB in batches.
+
+    path: output path (string or Path object), or '-' for standard output
+        (CSV only).
+    format: 'csv' or 'parquet'. Defaults to 'parquet' if `path` ends with
+        `.parquet`, otherwise 'csv'. Parquet requires pyarrow.
+    meter_from, meter_to, start, end: filters, see `stream_readings`.
+    imported_since: only export records written by files imported after
+        this time, e.g. the `imported_until` of the previous export.
+        Defaults to exporting all records.
+    batch_size: number of records fetched and written at a time. Defaults to
+        the configured batch size.
+
+    Returns an ExportResult of the number of rows written and the latest
+    import time of the files exported, to pass as `imported_since` next time.
+    Records may be exported again by the next export, but none are missed.
+    """
+
+    if format is None:
+        format = 'parquet' if str(path).endswith('.parquet') else 'csv'
+    if format not in FORMATS:
+        raise ValueError(f'unknown export format {format!r}')
+    if format == 'parquet' and _pyarrow() is None:
+        raise RuntimeError('pyarrow must be installed to export Parquet files')
+    if batch_size is None:
+        batch_size = config.batch_size
+
+    file_ids, imported_until = _imported_files(imported_since)
+
+    rows = 0
+
+    def counted(batches):
+        nonlocal rows
+        for batch in batches:
+            rows += len(batch)
+            yield batch
+
+    readings = stream_readings(meter_from, meter_to, start, end, file_ids, batch_size)
+    batches = counted(_batches(readings, batch_size))
+    if format == 'parquet':
+        _write_parquet(str(path), batches)
+    elif str(path) == '-':
+        _write_csv(sys.stdout, batches)
+    else:
+        with open(path, 'w', newline='') as f:
+            _write_csv(f, batches)
+
+    return ExportResult(rows, imported_until)
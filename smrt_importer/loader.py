@@ -1,10 +1,20 @@
+import bz2
 from collections import namedtuple
+from contextlib import contextmanager
 import csv
-from datetime import datetime
+from datetime import datetime, time
 from enum import Enum
+from functools import lru_cache
+import gzip
+import hashlib
+import io
+import lzma
+import mmap
 from pathlib import Path
 import re
+import zlib
 
+from smrt_importer.batch import RecordBatch, to_datetime, to_seconds
 from smrt_importer.models import File, Record
 
 
@@ -42,12 +52,107 @@ class Field:
         otherwise raises a DecodingError.
         """
 
-        if self.format is not None and re.fullmatch(self.format, value) is None:
+        if self.format is not None and self.format.fullmatch(value) is None:
             raise DecodingError(f'invalid {self.name} value: {value}')
 
 
 class DecodingError(Exception):
-    pass
+    """Raised when a SMRT file is invalid."""
+
+    def __init__(self, message, line=None):
+        """message: description of the problem, optionally followed by a
+            colon and the offending value.
+        line: number of the offending line, if known.
+        """
+
+        super().__init__(message)
+        self.line = line
+
+    def __reduce__(self):
+        # Keep the line number when sent between processes.
+        return type(self), (str(self), self.line)
+
+    @property
+    def reason(self):
+        """Short, low-cardinality reason, without any offending value."""
+
+        return str(self).split(':', 1)[0]
+
+
+class RecordSchema:
+    """Validates all values of a record in one go.
+
+    The field formats are compiled into a single regular expression, matched
+    against the record's values joined by a separator. Only if that fails are
+    the fields validated individually, to find the offending field.
+    """
+
+    SEPARATOR = '\x00'
+
+    def __init__(self, fields):
+        """fields: list of `Field` objects."""
+
+        self.fields = fields
+
+        patterns = []
+        for field in fields:
+            if field.format is None:
+                patterns.append(f'[^{self.SEPARATOR}]*')
+            else:
+                patterns.append(f'(?:{field.format.pattern})')
+        self._pattern = re.compile(self.SEPARATOR.join(patterns))
+
+    def validate(self, values: list) -> list:
+        """Validate a list of values against the fields, raising a
+        DecodingError if they are invalid.
+
+        Returns the values.
+        """
+
+        if len(values) != len(self.fields):
+            raise DecodingError('invalid number of fields')
+
+        if self._pattern.fullmatch(self.SEPARATOR.join(values)) is None:
+            # Either a value is invalid, or a value contains the separator.
+            for field, value in zip(self.fields, values):
+                field.validate(value)
+
+        return values
+
+
+@lru_cache(maxsize=4096)
+def _parse_date(date_str):
+    """Parse an 8-digit date string (YYYYMMDD) into seconds since the epoch
+    at midnight.
+
+    Cached, as many records share the same date.
+    """
+
+    try:
+        date = datetime(int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]))
+    except ValueError as e:
+        raise DecodingError(f'failed to parse timestamp: {e}')
+
+    return to_seconds(date)
+
+
+@lru_cache(maxsize=4096)
+def _parse_time(time_str):
+    """Parse a 6- or 4-digit time string (HHMMSS or HHMM) into seconds since
+    midnight.
+    """
+
+    hour = int(time_str[0:2])
+    minute = int(time_str[2:4])
+    second = int(time_str[4:6] if len(time_str) > 4 else 0)
+
+    # Raises the same errors as the datetime constructor.
+    try:
+        time(hour, minute, second)
+    except ValueError as e:
+        raise DecodingError(f'failed to parse timestamp: {e}')
+
+    return hour * 3600 + minute * 60 + second
 
 
 HEADER_FIELDS = [
@@ -74,8 +179,186 @@ TRAIL_FIELDS = [
 ]
 
 
+HEADER_SCHEMA = RecordSchema(HEADER_FIELDS)
+CONSUMPTION_SCHEMA = RecordSchema(CONSUMPTION_FIELDS)
+TRAIL_SCHEMA = RecordSchema(TRAIL_FIELDS)
+
+
+# Compression modules, by file suffix and by leading magic bytes.
+COMPRESSION_SUFFIXES = {'.gz': gzip, '.bz2': bz2, '.xz': lzma}
+_COMPRESSION_MAGIC = {b'\x1f\x8b': gzip, b'BZh': bz2, b'\xfd7zXZ\x00': lzma}
+
+# Encoding of SMRT files, whichever way they are read.
+ENCODING = 'utf-8'
+
+# Errors raised when reading corrupt or truncated compressed data. bz2 has no
+# error class of its own; see `_decompression_errors`.
+_DECOMPRESSION_ERRORS = (EOFError, gzip.BadGzipFile, lzma.LZMAError, zlib.error)
+
+
+def logical_name(filename):
+    """Return the name of a file without any compression suffix, e.g.
+    `FOO.SMRT` for `FOO.SMRT.gz`.
+
+    filename: file path (string or Path object).
+    """
+
+    filename = Path(filename)
+    if filename.suffix in COMPRESSION_SUFFIXES:
+        return filename.stem
+    return filename.name
+
+
+def _compression(filename: Path):
+    """Return the module used to decompress a file, or None if it is not
+    compressed. Detected by suffix, falling back to magic bytes.
+    """
+
+    try:
+        return COMPRESSION_SUFFIXES[filename.suffix]
+    except KeyError:
+        pass
+
+    with open(filename, 'rb') as f:
+        start = f.read(max(map(len, _COMPRESSION_MAGIC)))
+    for magic, module in _COMPRESSION_MAGIC.items():
+        if start.startswith(magic):
+            return module
+    return None
+
+
+class _HashingReader(io.RawIOBase):
+    """Binary stream updating a hash with the raw bytes read through it."""
+
+    def __init__(self, f, content_hash):
+        """f: binary file object.
+        content_hash: hashlib object.
+        """
+
+        self._f = f
+        self._content_hash = content_hash
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._f.read(len(buffer))
+        buffer[:len(data)] = data
+        self._content_hash.update(data)
+        return len(data)
+
+
+def _text(f, content_hash=None):
+    """Return a text file object reading a binary file object, hashing the
+    bytes read if `content_hash` is given.
+    """
+
+    if content_hash is not None:
+        f = io.BufferedReader(_HashingReader(f, content_hash), io.DEFAULT_BUFFER_SIZE * 8)
+    return io.TextIOWrapper(f, encoding=ENCODING, newline='')
+
+
+def _decoded_lines(lines, content_hash=None):
+    for line in lines:
+        if content_hash is not None:
+            content_hash.update(line)
+        yield line.decode(ENCODING)
+
+
+@contextmanager
+def _decompression_errors():
+    """Raise DecodingError for errors caused by corrupt or truncated
+    compressed data. Other errors, such as failing to read the file, are
+    raised unchanged.
+    """
+
+    try:
+        yield
+    except _DECOMPRESSION_ERRORS as e:
+        raise DecodingError(f'error decompressing file: {e}')
+    except OSError as e:
+        # bz2 reports corrupt data as an OSError without an errno.
+        if e.errno is not None:
+            raise
+        raise DecodingError(f'error decompressing file: {e}')
+
+
+def _decompressed_lines(f):
+    with _decompression_errors():
+        yield from f
+
+
+def _rows_with_offsets(f, offset, content_hash=None):
+    """Read CSV rows from a binary file, tracking the position in the file.
+
+    f: binary file object, positioned at `offset`.
+    offset: starting position.
+    content_hash: optional hashlib object, updated with each line read.
+
+    Yields `(row, end)` tuples, where `end` is the offset just after the row.
+    """
+
+    end = offset
+
+    def lines():
+        nonlocal end
+        with _decompression_errors():
+            for line in iter(f.readline, b''):
+                end += len(line)
+                if content_hash is not None:
+                    content_hash.update(line)
+                yield line.decode(ENCODING)
+
+    try:
+        for row in csv.reader(lines(), strict=True):
+            yield row, end
+    except csv.Error as e:
+        raise DecodingError(f'error decoding CSV: {e}')
+
+
+@contextmanager
+def open_smrt(filename, mmap_min_size=None, content_hash=None):
+    """Open a SMRT file for reading as UTF-8 text, transparently
+    decompressing gzip, bzip2 or xz files.
+
+    filename: file path (string or Path object).
+    mmap_min_size: uncompressed files of at least this many bytes are read
+        through a memory map rather than buffered reads. Defaults to never
+        memory mapping.
+    content_hash: optional hashlib object, updated with the raw bytes of the
+        file as they are read, after decompression. A file has the same hash
+        whether or not it is compressed, and however it is read (including
+        by `SMRTLoader.stream_file_resumable`).
+
+    Yields an iterable of lines, suitable for `csv.reader`.
+    """
+
+    filename = Path(filename)
+    module = _compression(filename)
+    if module is not None:
+        with module.open(filename, 'rb') as f, _text(f, content_hash) as text:
+            yield _decompressed_lines(text)
+        return
+
+    if mmap_min_size is not None and filename.stat().st_size >= max(mmap_min_size, 1):
+        with open(filename, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield _decoded_lines(iter(mapped.readline, b''), content_hash)
+        return
+
+    if content_hash is None:
+        with open(filename, encoding=ENCODING, newline='') as f:
+            yield f
+        return
+
+    with open(filename, 'rb', buffering=0) as f, _text(f, content_hash) as text:
+        yield text
+
+
 class SMRTLoader:
-    def __init__(self):
+    def __init__(self, mmap_min_size=None):
+        """mmap_min_size: see `open_smrt`."""
+
         # Create map of field types to method.
         # Can't be done at declaration time, as the object doesn't exist yet.
         self._field_type_method_map = {
@@ -84,28 +367,15 @@ class SMRTLoader:
             FieldType.TRAIL: self.load_trail
         }
 
+        self.mmap_min_size = mmap_min_size
         self.data = File()
+        self.record_count = 0
+        # SHA-256 of the (decompressed) file, stored in `self.data` once the
+        # whole file has been read.
+        self._content_hash = hashlib.sha256()
         self._received_header = False
         self._received_trail = False
 
-    def _convert_values(self, fields, values):
-        """Validates a list of values and converts them into a dict of
-        `{field_name: value}`.
-
-        fields: list of `Field` objects.
-        values: list of values to process. Must be the same length as `fields`.
-        """
-
-        if len(values) != len(fields):
-            raise DecodingError('invalid number of fields')
-
-        items = {}
-        for field, value in zip(fields, values):
-            field.validate(value)
-            items[field.name] = value
-
-        return items
-
     def _parse_timestamp(self, date_str, time_str):
         """Parse a date and time string into a datetime object.
         
@@ -115,19 +385,7 @@ class SMRTLoader:
 
         # It's still possible to fail at this point - we haven't validated
         # the date and time fields represent a valid timestamp.
-        try:
-            timestamp = datetime(
-                year=int(date_str[0:4]),
-                month=int(date_str[4:6]),
-                day=int(date_str[6:8]),
-                hour=int(time_str[0:2]),
-                minute=int(time_str[2:4]),
-                second=int(time_str[4:6] if len(time_str) > 4 else 0)
-            )
-        except ValueError as e:
-            raise DecodingError(f'failed to parse timestamp: {e}')
-        
-        return timestamp
+        return to_datetime(_parse_date(date_str) + _parse_time(time_str))
 
     def is_complete(self):
         """Return True if a complete file has been loaded, else False."""
@@ -160,33 +418,47 @@ class SMRTLoader:
         if self._received_header:
             raise DecodingError('out of sequence header record received')
 
-        items = self._convert_values(HEADER_FIELDS, header_values)
-        timestamp = self._parse_timestamp(items['date_str'], items['time_str'])
+        _, _, _, date_str, time_str, gen_num = HEADER_SCHEMA.validate(header_values)
+        timestamp = self._parse_timestamp(date_str, time_str)
         self.data.creation_time = timestamp
-        self.data.gen_num=items['gen_num']
+        self.data.gen_num = gen_num
         self._received_header = True
 
-    def load_consumption(self, consumption_values: list):
-        """Load a single consumption record.
+    def _parse_consumption(self, consumption_values: list):
+        """Parse a single consumption record.
 
         consumption_values: list of consumption record values.
+
+        Returns a `(meter_number, measurement_time, consumption)` tuple, with
+        the measurement time in seconds since the epoch.
         """
-        
+
         if not self._received_header or self._received_trail:
             raise DecodingError('out of sequence consumption record received')
 
-        items = self._convert_values(CONSUMPTION_FIELDS, consumption_values)
-        timestamp = self._parse_timestamp(items['date_str'], items['time_str'])
+        _, meter_number, date_str, time_str, consumption = \
+            CONSUMPTION_SCHEMA.validate(consumption_values)
+        seconds = _parse_date(date_str) + _parse_time(time_str)
 
         # Cast consumption to float.
         try:
-            consumption = float(items['consumption'])
+            consumption = float(consumption)
         except ValueError:
             raise DecodingError('failed to parse consumption value')
-        
+
+        self.record_count += 1
+        return meter_number, seconds, consumption
+
+    def load_consumption(self, consumption_values: list):
+        """Load a single consumption record.
+
+        consumption_values: list of consumption record values.
+        """
+
+        meter_number, seconds, consumption = self._parse_consumption(consumption_values)
         record = Record(
-            meter_number=items['meter_number'], 
-            measurement_time=timestamp, 
+            meter_number=meter_number, 
+            measurement_time=to_datetime(seconds), 
             consumption=consumption
         )
         self.data.records.append(record)
@@ -200,7 +472,7 @@ class SMRTLoader:
         if not self._received_header or self._received_trail:
             raise DecodingError('out of sequence trail record received')
 
-        self._convert_values(TRAIL_FIELDS, trail_values)
+        TRAIL_SCHEMA.validate(trail_values)
         self._received_trail = True
 
     def load_record(self, values):
@@ -227,31 +499,187 @@ class SMRTLoader:
         f: file object or list of strings containing CSV data.
         """
 
+        reader = csv.reader(f, strict=True)
         try:
-            reader = csv.reader(f, strict=True)
             for row in reader:
                 self.load_record(row)
         except csv.Error as e:
-            raise DecodingError(f'error decoding CSV: {e}')
+            raise DecodingError(f'error decoding CSV: {e}', reader.line_num)
+        except DecodingError as e:
+            if e.line is None:
+                e.line = reader.line_num
+            raise
 
         # Check file has been fully read in.
         if not self.is_complete():
-            raise DecodingError('incomplete file received')
+            raise DecodingError('incomplete file received', reader.line_num)
     
     def load_file(self, filename):
-        """Load all lines of a CSV file.
+        """Load all lines of a CSV file, which may be compressed (see
+        `open_smrt`). The file is recorded by its name without any
+        compression suffix.
         
         filename: file path (string or Path object) to CSV file.
 
         Returns the new File object created.
         """
 
-        filename = Path(filename)
-
-        self.data.filename = filename.name
+        self.data.filename = logical_name(filename)
         self.data.imported_time = datetime.now()
 
-        with open(filename, newline='') as f:
+        with open_smrt(filename, self.mmap_min_size, self._content_hash) as f:
             self.load_csv(f)
 
+        self.data.content_hash = self._content_hash.hexdigest()
+        return self.data
+
+    def load_file_header(self, filename):
+        """Load only the header record of a CSV file.
+
+        filename: file path (string or Path object) to CSV file.
+
+        Returns the File object, with header information populated.
+        """
+
+        self.data.filename = logical_name(filename)
+
+        try:
+            with open_smrt(filename) as f:
+                row = next(csv.reader(f, strict=True), None)
+        except csv.Error as e:
+            raise DecodingError(f'error decoding CSV: {e}')
+
+        if not row:
+            raise DecodingError('incomplete file received')
+
+        self.load_header(row)
         return self.data
+
+    def stream_csv(self, f, chunk_size):
+        """Load all lines of CSV file, yielding consumption records in compact
+        chunks rather than storing them as `Record` objects in
+        `self.data.records`.
+
+        Header information is stored in `self.data` as the file is read.
+        Chunks are yielded before the rest of the file has been validated, so
+        a DecodingError may still be raised after some chunks have been
+        consumed.
+
+        f: file object or list of strings containing CSV data.
+        chunk_size: maximum number of records in each chunk.
+
+        Yields RecordBatch objects.
+        """
+
+        consumption_type = FieldType.CONSUMPTION.value
+        chunk = RecordBatch()
+        reader = csv.reader(f, strict=True)
+        try:
+            for row in reader:
+                if row and row[0] == consumption_type:
+                    chunk.append(*self._parse_consumption(row))
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = RecordBatch()
+                else:
+                    self.load_record(row)
+        except csv.Error as e:
+            raise DecodingError(f'error decoding CSV: {e}', reader.line_num)
+        except DecodingError as e:
+            if e.line is None:
+                e.line = reader.line_num
+            raise
+
+        # Check file has been fully read in.
+        if not self.is_complete():
+            raise DecodingError('incomplete file received', reader.line_num)
+
+        if chunk:
+            yield chunk
+
+    def stream_file(self, filename, chunk_size):
+        """Load all lines of a CSV file, yielding consumption records in
+        chunks. See `stream_csv`.
+
+        filename: file path (string or Path object) to CSV file.
+        chunk_size: maximum number of records in each chunk.
+
+        Returns a generator of record chunks. The file is opened when the
+        first chunk is requested. `self.data.content_hash` is set once the
+        generator is exhausted.
+        """
+
+        self.data.filename = logical_name(filename)
+        self.data.imported_time = datetime.now()
+
+        return self._stream_path(filename, chunk_size)
+
+    def stream_file_resumable(self, filename, chunk_size, offset=0, record_count=0):
+        """Load all lines of a CSV file, as `stream_file`, tracking the byte
+        offset reached so loading can be resumed later.
+
+        The header is always read from the start of the file, then reading
+        continues from `offset`, if it is beyond the header. For compressed
+        files, offsets are into the decompressed data.
+
+        filename: file path (string or Path object) to CSV file.
+        chunk_size: maximum number of records in each chunk.
+        offset: byte offset to resume from, as yielded previously.
+        record_count: number of consumption records already loaded before
+            `offset`.
+
+        Returns a generator of `(chunk, offset)` tuples, where `offset` is
+        just after the last row in the chunk. The file is opened when the
+        first chunk is requested. `self.data.content_hash` is set once the
+        generator is exhausted, unless loading was resumed, as the skipped
+        part of the file is not read.
+        """
+
+        self.data.filename = logical_name(filename)
+        self.data.imported_time = datetime.now()
+        self.record_count = record_count
+
+        return self._stream_path_resumable(Path(filename), chunk_size, offset)
+
+    def _stream_path_resumable(self, filename, chunk_size, offset):
+        module = _compression(filename)
+        with (open if module is None else module.open)(filename, 'rb') as f:
+            content_hash = self._content_hash
+            header, header_end = next(_rows_with_offsets(f, 0, content_hash), (None, 0))
+            if header is None:
+                raise DecodingError('incomplete file received')
+            self.load_record(header)
+
+            if offset > header_end:
+                f.seek(offset)
+                content_hash = None
+            else:
+                offset = header_end
+
+            consumption_type = FieldType.CONSUMPTION.value
+            chunk = RecordBatch()
+            for row, offset in _rows_with_offsets(f, offset, content_hash):
+                if row and row[0] == consumption_type:
+                    chunk.append(*self._parse_consumption(row))
+                    if len(chunk) >= chunk_size:
+                        yield chunk, offset
+                        chunk = RecordBatch()
+                else:
+                    self.load_record(row)
+
+        # Check file has been fully read in.
+        if not self.is_complete():
+            raise DecodingError('incomplete file received')
+
+        if chunk:
+            yield chunk, offset
+
+        # Only once all chunks are written, so the file row isn't inserted
+        # with the hash already set.
+        if content_hash is not None:
+            self.data.content_hash = content_hash.hexdigest()
+
+    def _stream_path(self, filename, chunk_size):
+        with open_smrt(filename, self.mmap_min_size, self._content_hash) as f:
+            yield from self.stream_csv(f, chunk_size)
+        self.data.content_hash = self._content_hash.hexdigest()
@@ -0,0 +1,334 @@
+"""SMRT Importer metrics.
+
+Metrics are held in memory and can be exposed in the Prometheus text format,
+either over HTTP or by writing a file for the node exporter's textfile
+collector.
+"""
+
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from pathlib import Path
+from threading import Lock, Thread
+from time import perf_counter
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    """Base class for metrics, optionally with labels."""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} requires labels {self.labels}')
+        return tuple(labels[name] for name in self.labels)
+
+    @abstractmethod
+    def _samples(self):
+        """Yield `(suffix, label values, extra labels, value)` tuples."""
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        with self._lock:
+            samples = list(self._samples())
+        for suffix, key, extra, value in samples:
+            labels = _format_labels(self.labels, key, extra)
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield '_total', key, (), value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """Call `function` to get the (unlabelled) value whenever rendered."""
+
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            yield '', (), (), self._function()
+            return
+        for key, value in sorted(self._values.items()):
+            yield '', key, (), value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = counts, total + value
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', key, (('le', _format_value(bound)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), cumulative
+
+
+class Registry:
+    """Collection of metrics to be exposed together."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+
+        return ''.join(metric.render() for metric in self._metrics)
+
+
+REGISTRY = Registry()
+
+_DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+_ROWS_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000, 10000000)
+_BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10)
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'smrt_importer_stage_seconds',
+    'Time spent in each stage of importing a file.',
+    _DURATION_BUCKETS,
+    labels=('stage',)
+))
+FILE_ROWS = REGISTRY.register(Histogram(
+    'smrt_importer_file_rows',
+    'Consumption records per imported file.',
+    _ROWS_BUCKETS
+))
+FILE_BYTES = REGISTRY.register(Histogram(
+    'smrt_importer_file_bytes',
+    'Size of each processed file.',
+    _BYTES_BUCKETS
+))
+FILES = REGISTRY.register(Counter(
+    'smrt_importer_files',
+    'Files processed, by result.',
+    labels=('result',)
+))
+FAILURES = REGISTRY.register(Counter(
+    'smrt_importer_failures',
+    'Failed files, by reason.',
+    labels=('reason',)
+))
+RECORDS = REGISTRY.register(Counter(
+    'smrt_importer_records',
+    'Consumption records written, by result (inserted, updated or unchanged).',
+    labels=('result',)
+))
+INCOMING_FILES = REGISTRY.register(Gauge(
+    'smrt_importer_incoming_files',
+    'Files waiting in the incoming directory.'
+))
+QUEUED_FILES = REGISTRY.register(Gauge(
+    'smrt_importer_queued_files',
+    'Files queued to be imported, by size (small or large).',
+    labels=('size',)
+))
+QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    'smrt_importer_queue_wait_seconds',
+    'Time files waited in the queue before being imported, by size (small or large).',
+    _DURATION_BUCKETS,
+    labels=('size',)
+))
+
+
+# Stage timings and record counts for the file currently being processed, if
+# any.
+_file_timings = ContextVar('file_timings', default=None)
+_file_records = ContextVar('file_records', default=None)
+
+
+def add_stage_time(name, seconds):
+    """Record time spent in a stage. If within `file_timings`, times are
+    totalled and recorded once the file is complete.
+    """
+
+    timings = _file_timings.get()
+    if timings is None:
+        STAGE_SECONDS.observe(seconds, stage=name)
+    else:
+        timings[name] = timings.get(name, 0) + seconds
+
+
+@contextmanager
+def stage(name):
+    """Context manager recording the time spent in a stage."""
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        add_stage_time(name, perf_counter() - start)
+
+
+def timed_iter(iterable, name):
+    """Wrap an iterable, recording the time spent producing each item as the
+    given stage.
+    """
+
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextmanager
+def file_timings():
+    """Context manager totalling stage times whilst processing a file.
+
+    Yields the dict of stage totals.
+    """
+
+    timings = {}
+    token = _file_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _file_timings.reset(token)
+        for name, seconds in timings.items():
+            STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def count_records(result, count):
+    """Record the result of writing records, once they have been committed."""
+
+    RECORDS.inc(count, result=result)
+
+
+def total_file_records(result, count):
+    """Total the result of writing records for the file being processed, if
+    within `file_records`.
+    """
+
+    totals = _file_records.get()
+    if totals is not None:
+        totals[result] = totals.get(result, 0) + count
+
+
+@contextmanager
+def file_records():
+    """Context manager totalling record results whilst processing a file.
+
+    Yields the dict of counts by result.
+    """
+
+    totals = {}
+    token = _file_records.set(totals)
+    try:
+        yield totals
+    finally:
+        _file_records.reset(token)
+
+
+def write_textfile(path, registry=REGISTRY):
+    """Atomically write metrics to a file for the textfile collector."""
+
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_text(registry.render())
+    tmp_path.replace(path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't log every scrape.
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve metrics over HTTP from a background thread.
+
+    Returns the server, which can be stopped with `shutdown()`.
+    """
+
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,7 +1,7 @@
 """SMART Importer models."""
 
 
-from sqlalchemy import CHAR, Column, DateTime, Float, ForeignKey, Integer, String, PrimaryKeyConstraint
+from sqlalchemy import CHAR, Column, Date, DateTime, Float, ForeignKey, Integer, String, PrimaryKeyConstraint
 from sqlalchemy.orm import declarative_base, relationship
 
 
@@ -16,13 +16,16 @@ class File(Base):
     creation_time = Column(DateTime, nullable=False)
     imported_time = Column(DateTime, nullable=False)
     gen_num = Column(CHAR(8), nullable=False)
+    # SHA-256 of the file's (decompressed) contents, used to detect files
+    # resent under a new name. Null for files imported before it was added.
+    content_hash = Column(CHAR(64), nullable=True, index=True)
 
     records = relationship('Record', back_populates='file')
 
     def __repr__(self) -> str:
         return f'File(id={self.id!r}, filename={self.filename!r}, ' \
             f'creation_time={self.creation_time!r}, imported_time={self.imported_time!r}, ' \
-            f'gen_num={self.gen_num!r})'
+            f'gen_num={self.gen_num!r}, content_hash={self.content_hash!r})'
 
 
 class Record(Base):
@@ -46,3 +49,53 @@ class Record(Base):
         return f'Record(id={self.id!r}, file_id={self.file_id!r}, ' \
             f'meter_number={self.meter_number!r}, timestamp={self.measurement_time!r}, ' \
             f'consumption={self.consumption!r})'
+
+
+class DailyConsumption(Base):
+    __tablename__ = 'daily_consumption'
+
+    # Aggregate of the records for each meter and day, maintained as records
+    # are imported (including when they are overwritten).
+
+    meter_number = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)
+    total = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+    minimum = Column(Float, nullable=True)
+    maximum = Column(Float, nullable=True)
+
+    def __repr__(self) -> str:
+        return f'DailyConsumption(meter_number={self.meter_number!r}, day={self.day!r}, ' \
+            f'total={self.total!r}, count={self.count!r}, ' \
+            f'minimum={self.minimum!r}, maximum={self.maximum!r})'
+
+
+class ShardFile(Base):
+    __tablename__ = 'shard_file'
+
+    # Creation time of each file with records in a shard, copied from the
+    # file table in the main DB, so a shard can tell whether a stored record
+    # came from a newer file without querying the main DB.
+
+    id = Column(Integer, primary_key=True)
+    creation_time = Column(DateTime, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'ShardFile(id={self.id!r}, creation_time={self.creation_time!r})'
+
+
+class ImportCheckpoint(Base):
+    __tablename__ = 'import_checkpoint'
+
+    # Progress of a file being imported in resumable mode, committed with
+    # each chunk of records. A file with a checkpoint has not been fully
+    # imported; the checkpoint is deleted once its trailer is validated.
+
+    file_id = Column(Integer, ForeignKey('file.id'), primary_key=True)
+    offset = Column(Integer, nullable=False)
+    record_count = Column(Integer, nullable=False)
+    updated_time = Column(DateTime, nullable=False)
+
+    def __repr__(self) -> str:
+        return f'ImportCheckpoint(file_id={self.file_id!r}, offset={self.offset!r}, ' \
+            f'record_count={self.record_count!r}, updated_time={self.updated_time!r})'
@@ -1,98 +1,915 @@
 """SMRT Importer directory processor."""
 
 
+import asyncio
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import logging
 from pathlib import Path
-from sqlalchemy.exc import IntegrityError
-from time import sleep
+from sqlalchemy.exc import IntegrityError, OperationalError
+from time import monotonic, perf_counter
 
+from smrt_importer import metrics, profiling
+from smrt_importer.archive import Archiver
+from smrt_importer.claim import Claimer, release
 from smrt_importer.config import config
-from smrt_importer.loader import SMRTLoader
-from smrt_importer.db import insert_file
+from smrt_importer.loader import COMPRESSION_SUFFIXES, DecodingError, logical_name, SMRTLoader
+from smrt_importer.db import (
+    bulk_insert_file,
+    discard_import,
+    DuplicateFileError,
+    FileGroup,
+    get_checkpoint,
+    imported_filenames,
+    insert_file,
+    insert_file_resumable
+)
+from smrt_importer.models import File
+from smrt_importer.schedule import IncomingQueue
+from smrt_importer.watcher import create_watcher, PollingWatcher
+
+
+FILE_PATTERNS = ('*.SMRT',) + tuple(f'*.SMRT{suffix}' for suffix in COMPRESSION_SUFFIXES)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Loaded file, in a compact form which can be sent between processes.
+# `chunks` is a list of RecordBatch objects.
+ParsedFile = namedtuple(
+    'ParsedFile',
+    'filename creation_time imported_time gen_num content_hash chunks record_count '
+    'parse_seconds'
+)
+
+
+_archivers = {}
 
 
 def move_file(path: Path, dest: Path):
-    """Move a file, adding a suffix if necessary.
+    """Move a file into the archive, using the configured layout. Adds a
+    suffix if the name is already taken.
     
     path: file path
     dest: destination directory
+
+    Returns the new path.
+    """
+
+    archiver = _archivers.get(config.archive_layout)
+    if archiver is None:
+        archiver = _archivers[config.archive_layout] = Archiver(config.archive_layout)
+    return archiver.move(path, dest)
+
+
+def _discard_partial_import(path: Path):
+    """Discard anything committed by an interrupted resumable import of a
+    file, as it is being imported again without resuming. Must not be called
+    whilst a FileGroup is open, as the discard is committed on its own.
     """
 
-    newpath = dest / path.name
-    i=1
-    while newpath.exists():
-        newpath = dest / f'{path.stem}_{i}{path.suffix}'
-        i+=1
+    checkpoint = get_checkpoint(logical_name(path))
+    if checkpoint is not None:
+        logger.warning(
+            'discarding partial import path=%s rows=%d', path, checkpoint.record_count
+        )
+        discard_import(checkpoint)
+
+
+def _import_file(path: Path, group: FileGroup = None):
+    """Load a single file and insert it into the DB, using the configured
+    import mode.
+
+    group: optional FileGroup to add the file to, rather than committing it
+        on its own. Records are always written in bulk, without checkpoints.
+
+    Returns the number of consumption records loaded.
+    """
+
+    loader = SMRTLoader(config.mmap_min_size)
+    if group is None and config.resumable:
+        # Records are committed in chunks, with a checkpoint to resume from.
+        checkpoint = get_checkpoint(logical_name(path))
+        if checkpoint is None:
+            chunks = loader.stream_file_resumable(path, config.batch_size)
+        else:
+            logger.info(
+                'resuming path=%s offset=%d rows=%d',
+                path, checkpoint.offset, checkpoint.record_count
+            )
+            chunks = loader.stream_file_resumable(
+                path, config.batch_size, checkpoint.offset, checkpoint.record_count
+            )
+        insert_file_resumable(loader.data, metrics.timed_iter(chunks, 'parse'), checkpoint)
+        return loader.record_count
+
+    if group is None:
+        # E.g. if interrupted before resumable imports were disabled. Files
+        # with a checkpoint aren't added to groups.
+        _discard_partial_import(path)
+
+    if config.stream:
+        # Records are written as they are read, so memory use does not grow
+        # with file size. Any error rolls back the whole file.
+        chunks = loader.stream_file(path, config.batch_size)
+        insert = bulk_insert_file if group is None else group.add
+        insert(loader.data, metrics.timed_iter(chunks, 'parse'))
+        return loader.record_count
+
+    with metrics.stage('parse'):
+        file = loader.load_file(path)
+    if group is not None:
+        group.add(file)
+    elif config.bulk_insert:
+        bulk_insert_file(file)
+    else:
+        insert_file(file)
+    return loader.record_count
+
+
+def parse_file(path):
+    """Load a single file without saving it. Used by worker processes. The
+    whole file is held in memory.
+
+    path: path (string or Path object) to a SMRT file.
+
+    Returns a ParsedFile.
+    """
+
+    start = perf_counter()
+    loader = SMRTLoader(config.mmap_min_size)
+    chunks = list(loader.stream_file(path, config.batch_size))
+    data = loader.data
+    return ParsedFile(
+        data.filename,
+        data.creation_time,
+        data.imported_time,
+        data.gen_num,
+        data.content_hash,
+        chunks,
+        loader.record_count,
+        perf_counter() - start
+    )
+
+
+def _save_parsed_file(parsed: ParsedFile, group: FileGroup = None):
+    """Insert a file loaded by `parse_file` into the DB.
+
+    group: optional FileGroup to add the file to, rather than committing it
+        on its own.
+
+    Returns the number of consumption records.
+    """
+
+    metrics.add_stage_time('parse', parsed.parse_seconds)
+    file = File(
+        filename=parsed.filename,
+        creation_time=parsed.creation_time,
+        imported_time=parsed.imported_time,
+        gen_num=parsed.gen_num,
+        content_hash=parsed.content_hash
+    )
+    if group is None:
+        _discard_partial_import(Path(parsed.filename))
+        bulk_insert_file(file, parsed.chunks)
+    else:
+        group.add(file, parsed.chunks)
+    return parsed.record_count
+
+
+def _parsed_importer(parsing):
+    """Return a function, as taken by `process_file` and
+    `CommitGroup.process_file`, which saves a file parsed by a worker.
+
+    parsing: Future for the file's ParsedFile.
+    """
+
+    def import_file(path, group=None):
+        return _save_parsed_file(parsing.result(), group)
+
+    return import_file
+
+
+def _parse_in_worker(path: Path):
+    """Return True if a file should be parsed by a worker process.
+
+    A file parsed by a worker is held in memory in full until it is written,
+    so files larger than the configured maximum are streamed by the writing
+    process instead. Files already imported are not parsed.
+    """
+
+    if logical_name(path) in imported_filenames:
+        return False
+    try:
+        return path.stat().st_size <= config.worker_max_size
+    except FileNotFoundError:
+        # Fails when imported.
+        return False
 
-    path.rename(newpath)
 
+class ParserPool:
+    """Pool of worker processes used to parse files."""
 
-def process_file(path):
+    def __init__(self, workers):
+        """workers: number of worker processes."""
+
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(workers)
+
+    def submit(self, path):
+        """Start parsing a file. Returns a Future for its ParsedFile."""
+
+        return self._executor.submit(parse_file, path)
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+def _failure_reason(e: Exception):
+    """Return a short, low-cardinality reason for a failure."""
+
+    if isinstance(e, DecodingError):
+        return e.reason
+    return type(e).__name__
+
+
+def _database_locked(e: Exception):
+    """Return True if an import failed as another connection (e.g. another
+    instance) held the DB's write lock for longer than the busy timeout.
+    """
+
+    return isinstance(e, OperationalError) and 'database is locked' in str(e.orig)
+
+
+def _find_files(path: Path):
+    """Return the SMRT files in a directory."""
+
+    filepaths = []
+    for pattern in FILE_PATTERNS:
+        filepaths.extend(path.glob(pattern))
+    return filepaths
+
+
+def _write_metrics():
+    if config.metrics_textfile is not None:
+        metrics.write_textfile(config.metrics_textfile)
+
+
+def _import_and_route(path: Path, import_file):
+    """Import a file, logging and recording metrics for the result.
+
+    Returns the directory the file should be moved to, or None if it should
+    be left to import again later, as the DB was locked.
+    """
+
+    size = path.stat().st_size
+    metrics.FILE_BYTES.observe(size)
+    logger.info('processing path=%s bytes=%d', path, size)
+    start = perf_counter()
+
+    try:
+        if logical_name(path) in imported_filenames:
+            logger.warning('skipped path=%s reason=already_imported', path)
+            metrics.FILES.inc(result='duplicate')
+            return config.failed_dir
+
+        with metrics.file_records() as records:
+            rows = import_file(path)
+    except IntegrityError:  # Most likely a unique constraint on File failed.
+        logger.warning('skipped path=%s reason=already_imported', path)
+        metrics.FILES.inc(result='duplicate')
+        return config.failed_dir
+    except DuplicateFileError as e:
+        logger.warning(
+            'skipped path=%s reason=duplicate_content original=%s', path, e.original
+        )
+        metrics.FILES.inc(result='duplicate')
+        return config.failed_dir
+    except Exception as e:
+        if _database_locked(e):
+            # Not the file's fault, so it is tried again rather than failed.
+            logger.warning('deferred path=%s reason=database_locked', path)
+            metrics.FILES.inc(result='deferred')
+            return None
+        reason = _failure_reason(e)
+        logger.error(
+            'failed path=%s reason="%s" line=%s error="%s"',
+            path, reason, getattr(e, 'line', None), e
+        )
+        metrics.FILES.inc(result='failed')
+        metrics.FAILURES.inc(reason=reason)
+        return config.failed_dir
+
+    logger.info(
+        'imported path=%s rows=%d inserted=%d updated=%d unchanged=%d seconds=%.3f',
+        path,
+        rows,
+        records.get('inserted', 0),
+        records.get('updated', 0),
+        records.get('unchanged', 0),
+        perf_counter() - start
+    )
+    metrics.FILES.inc(result='processed')
+    metrics.FILE_ROWS.observe(rows)
+    return config.processed_dir
+
+
+def process_file(path, import_file=None):
     """Load data from a single file, save to DB, then move to processed dir
     (if successful) or failed dir.
     
     path: path (string or Path object) to a SMRT file.
+    import_file: function which is passed the path and loads and saves the
+        file, returning the number of records. Defaults to doing so in this
+        process, using the configured import mode. Also see
+        `CommitGroup.process_file`.
+
+    Returns True if the file was imported or failed, or False if the DB was
+    locked, in which case the file is left in (or returned to) the incoming
+    dir.
     """
 
+    if import_file is None:
+        import_file = _import_file
+
     path = Path(path)
 
     # Ensure processed and failed directories exist.
     config.processed_dir.mkdir(parents=True, exist_ok=True)
     config.failed_dir.mkdir(parents=True, exist_ok=True)
 
-    print(f'Processing {path}...')
-    try:
-        loader = SMRTLoader()
-        file = loader.load_file(path)
-        insert_file(file)
-    except IntegrityError:  # Most likely a unique constraint on File failed.
-        print(f'    Already imported, skipping')
-        dest = config.failed_dir
-    except Exception as e:
-        print(f'    Failed: {e}')
-        dest = config.failed_dir
-    else:
-        print('    OK')
-        dest = config.processed_dir
-    finally:
-        move_file(path, dest)
+    with metrics.file_timings():
+        with profiling.profile_file() as profile:
+            dest = _import_and_route(path, import_file)
+        if dest is None:
+            release(path)
+            return False
+        with metrics.stage('move'):
+            newpath = move_file(path, dest)
+
+    profiling.save(profile, newpath)
+    _write_metrics()
+    return True
+
+
+class CommitGroup:
+    """Processes files into a shared transaction, committing them together.
+
+    Files are imported as by `process_file`, each within its own savepoint,
+    so a file which fails is still rolled back on its own and moved to the
+    failed dir. Files are only moved once the group has been committed. If
+    the group fails to commit, its files are imported again one at a time.
+
+    Files which couldn't be imported as the DB was locked are left to import
+    again later, as for `process_file`.
+    """
+
+    def __init__(self, max_files, max_seconds):
+        """max_files: commit once this many files have been imported.
+        max_seconds: commit once this many seconds have passed since the
+            first file was imported.
+        """
+
+        self.max_files = max_files
+        self.max_seconds = max_seconds
+        self._group = None
+        self._started = None
+        self._pending = []
+        self._deferred = []
+
+    def __contains__(self, path):
+        return any(path == pending for pending, *_ in self._pending)
+
+    def take_deferred(self):
+        """Return the paths of files left in the incoming dir whilst
+        committing the group, as the DB was locked, and forget them.
+        """
+
+        deferred, self._deferred = self._deferred, []
+        return deferred
+
+    def remaining(self):
+        """Return the seconds until the group is due to be committed, or None
+        if it is empty.
+        """
 
+        if self._group is None:
+            return None
+        return max(0, self._started + self.max_seconds - monotonic())
 
-def process_dir(path=config.incoming_dir):
+    def process_file(self, path, import_file=None):
+        """Import a file into the group, committing the group if it is full
+        or due.
+
+        path: path (string or Path object) to a SMRT file.
+        import_file: function which is passed the path and the FileGroup,
+            and loads and adds the file to the group, returning the number
+            of records. Defaults to doing so in this process. If the group
+            fails to commit, it is called again without the group, so must
+            then commit the file on its own, as for `process_file`.
+
+        Returns True if the file was added to the group or failed, or False
+        if the DB was locked, as for `process_file`.
+        """
+
+        if import_file is None:
+            import_file = _import_file
+
+        path = Path(path)
+
+        if get_checkpoint(logical_name(path)) is not None:
+            # Partially imported on its own, so resumed or discarded on its
+            # own, once the files already in the group are committed.
+            self.commit()
+            return process_file(path, import_file)
+
+        config.processed_dir.mkdir(parents=True, exist_ok=True)
+        config.failed_dir.mkdir(parents=True, exist_ok=True)
+
+        if self._group is None:
+            self._group = FileGroup()
+            self._started = monotonic()
+
+        group = self._group
+        with metrics.file_timings(), profiling.profile_file() as profile:
+            dest = _import_and_route(path, partial(import_file, group=group))
+        if dest is None:
+            release(path)
+        else:
+            self._pending.append((path, dest, profile, import_file))
+
+        if len(self._pending) >= self.max_files or self.remaining() == 0:
+            self.commit()
+        return dest is not None
+
+    def commit(self):
+        """Commit the files imported so far, then move them."""
+
+        group, pending = self._group, self._pending
+        self._group, self._started, self._pending = None, None, []
+        if group is None:
+            return
+
+        with group:
+            try:
+                group.commit()
+            except Exception as e:
+                logger.error('failed group commit files=%d error="%s"', len(pending), e)
+                metrics.FAILURES.inc(reason=type(e).__name__)
+                retry = True
+            else:
+                logger.info('committed files=%d', len(group))
+                retry = False
+
+        for path, dest, profile, import_file in pending:
+            if retry and dest == config.processed_dir:
+                # Committed on its own, so one file can't fail the rest.
+                with metrics.file_timings():
+                    dest = _import_and_route(path, import_file)
+                if dest is None:
+                    self._deferred.append(release(path))
+                    continue
+            with metrics.stage('move'):
+                newpath = move_file(path, dest)
+            profiling.save(profile, newpath)
+        _write_metrics()
+
+
+def create_commit_group():
+    """Return a CommitGroup using the configured limits, or None if files
+    are committed individually.
+    """
+
+    if config.group_files <= 1:
+        return None
+    return CommitGroup(config.group_files, config.group_ms / 1000)
+
+
+def create_claimer(path=None):
+    """Return a started Claimer for an incoming directory, or None if files
+    are not claimed.
+
+    path: path (string or Path object) to the incoming directory. Defaults to
+          configured incoming directory.
+    """
+
+    if not config.claim_files:
+        return None
+    path = Path(config.incoming_dir if path is None else path)
+    claimer = Claimer(path, config.worker_id, config.claim_lease)
+    claimer.start()
+    return claimer
+
+
+def create_queue():
+    """Return an IncomingQueue using the configured policy."""
+
+    return IncomingQueue(config.queue_policy, config.small_file_size, config.small_file_slo)
+
+
+def _next_file(queue: IncomingQueue, group=None, claimer: Claimer = None):
+    """Take the next file to import from the queue, claiming it if claiming.
+    Files are only claimed as they are reached, so other instances can take
+    the rest.
+
+    Returns the path to import, or None if the queue is empty.
+    """
+
+    while (path := queue.pop()) is not None:
+        # Files waiting in the group are still in the incoming dir.
+        if group is not None and path in group:
+            continue
+        if claimer is not None:
+            path = claimer.claim(path)
+            if path is None:
+                continue
+        return path
+    return None
+
+
+def process_queue(queue: IncomingQueue, pool=None, group=None, claimer=None, poll=None):
+    """Import files from a queue, in the order chosen by its policy, until it
+    is empty.
+
+    queue: IncomingQueue of SMRT files.
+    pool: optional ParserPool. If given, files are parsed concurrently by its
+        workers, whilst this process saves them to the DB one at a time.
+    group: optional CommitGroup. If given, files are imported into it rather
+        than committed individually. The group is committed when full or
+        due, so may still hold uncommitted files afterwards.
+    claimer: optional Claimer. If given, each file is claimed before it is
+        parsed, and skipped if another instance has claimed it.
+    poll: optional function returning paths which have arrived since, called
+        after each file is saved, so they can be queued ahead of files
+        already waiting.
+
+    Returns a list of the paths of files left in the incoming dir as the DB
+    was locked, which should be queued again later.
+    """
+
+    process_one = process_file if group is None else group.process_file
+    # Files being parsed, which are still in the incoming dir if not claimed.
+    pending = deque()
+    deferred = []
+
+    def process(path, *args):
+        if not process_one(path, *args):
+            deferred.append(path if claimer is None else claimer.incoming / path.name)
+
+    def refill():
+        if poll is not None:
+            parsing = {path for path, _ in pending}
+            queue.extend(path for path in poll() if path not in parsing)
+
+    def done():
+        if group is not None:
+            deferred.extend(group.take_deferred())
+        return deferred
+
+    if pool is None:
+        while (path := _next_file(queue, group, claimer)) is not None:
+            process(path)
+            refill()
+        return done()
+
+    # Only parse a few files ahead of the writer, to bound memory use.
+    max_pending = 2 * pool.workers
+
+    def save_next():
+        path, future = pending.popleft()
+        if future is None:
+            process(path)
+        else:
+            process(path, _parsed_importer(future))
+        refill()
+
+    while True:
+        path = _next_file(queue, group, claimer)
+        if path is None:
+            if not pending:
+                return done()
+            save_next()
+            continue
+
+        # Skip parsing files which have already been imported.
+        if logical_name(path) in imported_filenames:
+            process(path)
+            refill()
+            continue
+
+        # Large files are kept in order, but imported by this process.
+        pending.append((path, pool.submit(path) if _parse_in_worker(path) else None))
+        if len(pending) >= max_pending:
+            save_next()
+
+
+def process_files(paths, pool=None, group=None, claimer=None):
+    """Load a number of SMRT files and save to DB, in the order chosen by the
+    configured queue policy.
+
+    paths: paths (strings or Path objects) to SMRT files.
+    pool, group, claimer: see `process_queue`.
+
+    Returns a list of the paths of files left to import later, as for
+    `process_queue`.
+    """
+
+    queue = create_queue()
+    queue.extend(paths)
+    return process_queue(queue, pool, group, claimer)
+
+
+def process_dir(path=None, pool=None, group=None, claimer=None):
     """Load all SMRT files in a directory and save to DB.
 
-    Any erroneous files will be skipped and a message printed.
+    Any erroneous files will be skipped and a message logged.
     
     path: path (string or Path object) to a directory containing SMRT files.
           Defaults to configured incoming directory.
+    pool: optional ParserPool used to parse files. See `process_files`.
+    group: optional CommitGroup, which is committed before returning. See
+        `process_files`.
+    claimer: optional Claimer for the directory. Files claimed by instances
+        which have died are returned to the directory first. See
+        `process_files`.
+
+    Returns a list of the paths of files left in the directory, as the DB was
+    locked by another instance, to import on a later run.
     """
 
-    path = Path(path)
-    for filepath in path.glob('*.SMRT'):
-        process_file(filepath)
+    path = Path(config.incoming_dir if path is None else path)
+    if claimer is not None:
+        claimer.reclaim_stale()
+
+    deferred = process_files(_find_files(path), pool, group, claimer)
+    if group is not None:
+        group.commit()
+        deferred += group.take_deferred()
+    if deferred:
+        logger.warning('left path=%s files=%d reason=database_locked', path, len(deferred))
+    return deferred
 
 
-def watch_dir(path=config.incoming_dir):
+def watch_dir(path=None, workers=1):
     """Continuously watch a directory for new SMRT files, until killed.
 
-    The directory will be created if it does not exist.
+    The directory will be created if it does not exist. Files already present
+    are processed first, then new files are processed as they arrive, using
+    the configured watcher backend. Files which arrive whilst others are being
+    imported are queued alongside those still waiting, so the queue policy
+    can put them first.
     
     path: path (string or Path object) to a directory containing SMRT files.
           Defaults to configured incoming directory.
+    workers: number of processes used to parse files. If more than 1, files
+        are parsed in a process pool and saved to the DB by this process.
     """
 
-    path = Path(path)
+    path = Path(config.incoming_dir if path is None else path)
     path.mkdir(parents=True, exist_ok=True)
 
-    print(f'Watching {path}...')
+    pool = ParserPool(workers) if workers > 1 else None
+    group = create_commit_group()
+    claimer = create_claimer(path)
+    queue = create_queue()
+
+    watcher = create_watcher(
+        path,
+        FILE_PATTERNS,
+        config.watch_backend,
+        config.poll_interval,
+        config.max_poll_interval
+    )
+
+    # Rendered after every file, so counted from the queue rather than by
+    # listing the directory.
+    metrics.INCOMING_FILES.set_function(lambda: len(queue))
+
+    # Reading inotify events is cheap, but scanning the directory after every
+    # file would make draining a large backlog quadratic, so the polling
+    # backend is scanned at most once per poll interval.
+    last_poll = monotonic()
+
+    def poll():
+        nonlocal last_poll
+        if isinstance(watcher, PollingWatcher):
+            if monotonic() - last_poll < config.poll_interval:
+                return []
+            last_poll = monotonic()
+        # Files already imported no longer exist, so aren't queued.
+        return watcher.wait(0)
+
+    logger.info('watching path=%s backend=%s', path, watcher.name)
     try:
-        while True:
-            process_dir(path)
-            sleep(0.5)
+        with watcher:
+            # The watcher is started first so no files are missed between
+            # processing existing files and waiting for new ones.
+            filepaths = _find_files(path)
+            while True:
+                if claimer is not None:
+                    filepaths += claimer.reclaim_stale()
+                queue.extend(filepaths)
+                deferred = process_queue(queue, pool, group, claimer, poll)
+                if group is not None and group.remaining() == 0:
+                    group.commit()
+                    deferred += group.take_deferred()
+
+                # Wake up in time to commit a waiting group, to check for
+                # expired claims, and to retry files deferred as the DB was
+                # locked.
+                timeouts = []
+                if group is not None and group.remaining() is not None:
+                    timeouts.append(group.remaining())
+                if claimer is not None:
+                    timeouts.append(claimer.lease_seconds / 4)
+                if deferred:
+                    timeouts.append(config.poll_interval)
+                filepaths = watcher.wait(min(timeouts, default=None)) + deferred
     
     # Hide keyboard interrupt exception message and silently exit.
     except KeyboardInterrupt:
         pass
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if claimer is not None:
+            claimer.stop()
+
+
+def _write_file(path: Path, parsing):
+    """Save a file parsed by the pipeline, or skip it if already imported.
+
+    parsing: Future for the file's ParsedFile, or None if it was not parsed.
+
+    Returns a tuple of the directory the file should be moved to and its
+    profile, if profiled.
+    """
+
+    with metrics.file_timings(), profiling.profile_file() as profile:
+        if parsing is None:
+            dest = _import_and_route(path, _import_file)
+        else:
+            dest = _import_and_route(path, _parsed_importer(parsing))
+    return dest, profile
+
+
+def _move_file(path: Path, dest: Path, profile=None):
+    with metrics.stage('move'):
+        newpath = move_file(path, dest)
+    profiling.save(profile, newpath)
+    _write_metrics()
+
+
+async def run_async(path=None, workers=1, watch=False, queue_size=None):
+    """Process SMRT files using an asyncio pipeline, so reading and parsing,
+    writing to the DB and moving files overlap.
+
+    Discovered files wait in an IncomingQueue, from which files are taken in
+    the order chosen by the configured policy. Later stages are connected by
+    bounded queues, so if files arrive faster than they can be written, only
+    a few files are parsed ahead of the writer. Files are written one at a
+    time.
+
+    path: path (string or Path object) to a directory containing SMRT files.
+          Defaults to configured incoming directory.
+    workers: number of processes used to parse files. If 1, files are parsed
+        in a thread.
+    watch: if True, keep watching the directory for new files until
+        cancelled. Otherwise, return once existing files are processed.
+    queue_size: maximum files waiting between each stage. Defaults to twice
+        the number of workers.
+    """
+
+    path = Path(config.incoming_dir if path is None else path)
+    path.mkdir(parents=True, exist_ok=True)
+    if queue_size is None:
+        queue_size = 2 * workers
+
+    config.processed_dir.mkdir(parents=True, exist_ok=True)
+    config.failed_dir.mkdir(parents=True, exist_ok=True)
+    claimer = create_claimer(path)
+
+    loop = asyncio.get_running_loop()
+    if workers > 1:
+        parse_executor = ProcessPoolExecutor(workers)
+    else:
+        parse_executor = ThreadPoolExecutor(1, thread_name_prefix='parser')
+    # All DB writes happen on one thread, one file at a time.
+    write_executor = ThreadPoolExecutor(1, thread_name_prefix='writer')
+
+    incoming = create_queue()
+    # Set when files are queued, or once discovery has finished.
+    queued = asyncio.Event()
+    discovered = False
+    write_queue = asyncio.Queue(queue_size)
+    move_queue = asyncio.Queue(queue_size)
+    # Paths taken from the queue, which may be reported again by the watcher
+    # before they are moved.
+    in_flight = set()
+
+    async def enqueue(filepaths):
+        filepaths = [filepath for filepath in filepaths if filepath not in in_flight]
+        # Reads the headers of the files, so not on the event loop.
+        if await loop.run_in_executor(None, incoming.extend, filepaths):
+            queued.set()
+
+    def scan():
+        if claimer is not None:
+            claimer.reclaim_stale()
+        return _find_files(path)
+
+    async def discover():
+        nonlocal discovered
+        if not watch:
+            await enqueue(await loop.run_in_executor(None, scan))
+            discovered = True
+            queued.set()
+            return
+
+        watcher = create_watcher(
+            path,
+            FILE_PATTERNS,
+            config.watch_backend,
+            config.poll_interval,
+            config.max_poll_interval
+        )
+        metrics.INCOMING_FILES.set_function(lambda: len(incoming))
+        logger.info('watching path=%s backend=%s', path, watcher.name)
+        with watcher:
+            # The watcher is started first so no files are missed between
+            # processing existing files and waiting for new ones.
+            await enqueue(await loop.run_in_executor(None, scan))
+            while True:
+                # Wait with a timeout so the thread is free when cancelled.
+                filepaths = await loop.run_in_executor(None, watcher.wait, 1)
+                if claimer is not None:
+                    filepaths += await loop.run_in_executor(None, claimer.reclaim_stale)
+                await enqueue(filepaths)
+
+    async def schedule():
+        while True:
+            filepath = _next_file(incoming, claimer=claimer)
+            if filepath is None:
+                if discovered:
+                    break
+                queued.clear()
+                await queued.wait()
+                continue
+            # May have been queued again whilst being processed.
+            if filepath in in_flight or not filepath.exists():
+                continue
+
+            in_flight.add(filepath)
+            if _parse_in_worker(filepath):
+                parsing = parse_executor.submit(parse_file, filepath)
+            else:
+                parsing = None
+            # Waits if the writer is behind, which stops further parsing.
+            await write_queue.put((filepath, parsing))
+        await write_queue.put(None)
+
+    async def write():
+        while (item := await write_queue.get()) is not None:
+            filepath, parsing = item
+            if parsing is not None:
+                try:
+                    await asyncio.wrap_future(parsing)
+                except Exception:
+                    pass  # Handled when the file is written.
+            dest, profile = await loop.run_in_executor(
+                write_executor, _write_file, filepath, parsing
+            )
+            await move_queue.put((filepath, dest, profile))
+        await move_queue.put(None)
+
+    async def move():
+        while (item := await move_queue.get()) is not None:
+            filepath, dest, profile = item
+            if dest is None:
+                # The DB was locked, so the file is imported again later.
+                newpath = await loop.run_in_executor(None, release, filepath)
+                in_flight.discard(filepath)
+                if watch:
+                    await enqueue([newpath])
+                continue
+            await loop.run_in_executor(None, _move_file, filepath, dest, profile)
+            in_flight.discard(filepath)
+
+    tasks = [asyncio.create_task(stage()) for stage in (discover, schedule, write, move)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        write_executor.shutdown()
+        parse_executor.shutdown(cancel_futures=True)
+        if claimer is not None:
+            claimer.stop()
 
 
 if __name__ == '__main__':
-    watch_dir()
+    from smrt_importer.cli import main
+    main()
@@ -0,0 +1,157 @@
+"""SMRT Importer profiling.
+
+When enabled, importing each file (or a sampled fraction of files) is run
+under cProfile and tracemalloc. The profile and a report of the top
+allocations are saved next to the file once it has been moved to the
+processed or failed directory, and profiles are combined into a summary of
+the hottest loader and DB functions.
+
+Only the importing process is profiled, so parsing done by worker processes
+(`--workers`) is not included. tracemalloc traces the whole process, so with
+the asyncio pipeline, allocations by other stages are included too.
+"""
+
+
+from contextlib import contextmanager
+import cProfile
+import io
+import pstats
+import random
+from threading import Lock
+import tracemalloc
+
+
+# Functions included in the summary, matched against
+# `file:line(function)`.
+SUMMARY_PATTERN = r'smrt_importer[/\\](loader|db)\.py'
+
+
+class FileProfile:
+    """Profile and memory snapshot taken whilst importing a file."""
+
+    def __init__(self, profile: cProfile.Profile, snapshot: tracemalloc.Snapshot, peak):
+        self.profile = profile
+        self.snapshot = snapshot
+        self.peak = peak
+
+    def allocation_report(self, top=20):
+        """Return a report of the lines which allocated the most memory."""
+
+        lines = [f'peak={self.peak} bytes']
+        for statistic in self.snapshot.statistics('lineno')[:top]:
+            lines.append(str(statistic))
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path, top=20):
+        """Save the profile next to a file.
+
+        The profile is written to `<path>.prof`, readable with `pstats`, and
+        the allocation report to `<path>.alloc.txt`.
+
+        path: path of the archived file.
+        top: number of allocation sites to report.
+        """
+
+        self.profile.dump_stats(f'{path}.prof')
+        with open(f'{path}.alloc.txt', 'w') as f:
+            f.write(self.allocation_report(top))
+
+
+class Profiler:
+    """Profiles a sampled fraction of files, keeping combined statistics."""
+
+    def __init__(self, sample=1.0, top=20):
+        """sample: fraction of files to profile, from 0 to 1.
+        top: number of entries in allocation reports and the summary.
+        """
+
+        self.sample = sample
+        self.top = top
+        self._stats = None
+        self._lock = Lock()
+
+    @contextmanager
+    def profile(self):
+        """Profile the enclosed block, if sampled.
+
+        Yields a FileProfile, populated once the block exits, or None if not
+        sampled or another block is already being profiled.
+        """
+
+        if random.random() >= self.sample or not self._lock.acquire(blocking=False):
+            yield None
+            return
+
+        profile = cProfile.Profile()
+        result = FileProfile(profile, None, None)
+        try:
+            tracemalloc.start()
+            profile.enable()
+            yield result
+        finally:
+            profile.disable()
+            result.snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)]
+            )
+            _, result.peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._lock.release()
+
+    def summary(self):
+        """Return the hottest loader and DB functions across all profiled
+        files, by time spent in each function, or None if nothing has been
+        profiled.
+        """
+
+        if self._stats is None:
+            return None
+
+        stream = io.StringIO()
+        self._stats.stream = stream
+        self._stats.sort_stats(pstats.SortKey.TIME).print_stats(SUMMARY_PATTERN, self.top)
+        return stream.getvalue()
+
+
+profiler = None
+
+
+def enable(sample=1.0, top=20):
+    """Start profiling files imported by this process.
+
+    sample: fraction of files to profile, from 0 to 1.
+    top: number of entries in allocation reports and the summary.
+    """
+
+    global profiler
+    profiler = Profiler(sample, top)
+
+
+@contextmanager
+def profile_file():
+    """Profile importing a file, if profiling is enabled and it is sampled.
+
+    Yields a FileProfile, or None.
+    """
+
+    if profiler is None:
+        yield None
+        return
+
+    with profiler.profile() as result:
+        yield result
+
+
+def save(result: FileProfile, path):
+    """Save a file's profile next to it, if it was profiled.
+
+    result: FileProfile yielded by `profile_file`, or None.
+    path: path of the archived file.
+    """
+
+    if result is not None:
+        result.save(path, profiler.top)
@@ -0,0 +1,138 @@
+"""SMRT Importer consumption queries.
+
+Totals are read from the daily rollups maintained as records are imported,
+rather than aggregating the record table.
+
+If records are sharded, queries for a single meter only read its shard.
+Otherwise, all shards are queried and the results merged.
+"""
+
+
+from collections import namedtuple
+from contextlib import ExitStack
+from datetime import date, datetime
+import heapq
+
+from sqlalchemy import func, select
+
+from smrt_importer.db import record_engine_for, record_engines
+from smrt_importer.models import DailyConsumption, Record
+
+
+ConsumptionTotal = namedtuple(
+    'ConsumptionTotal', 'meter_number period total count minimum maximum'
+)
+
+Reading = namedtuple('Reading', 'meter_number measurement_time consumption file_id')
+
+
+def _execute(statement, meter_number):
+    """Execute a statement against the databases which may hold a meter's
+    records, or all of them if `meter_number` is None.
+
+    The statement must be ordered by meter number first; results from each
+    database are merged in that order as they are read, rather than fetched
+    in full first.
+
+    Yields rows as tuples.
+    """
+
+    if meter_number is None:
+        engines = record_engines()
+    else:
+        engines = [record_engine_for(meter_number)]
+
+    with ExitStack() as stack:
+        results = [
+            stack.enter_context(engine.connect()).execute(statement) for engine in engines
+        ]
+        yield from heapq.merge(*(map(tuple, result) for result in results))
+
+
+def _filter(statement, meter_number, start, end):
+    if meter_number is not None:
+        statement = statement.where(DailyConsumption.meter_number == meter_number)
+    if start is not None:
+        statement = statement.where(DailyConsumption.day >= start)
+    if end is not None:
+        statement = statement.where(DailyConsumption.day <= end)
+    return statement
+
+
+def daily_totals(meter_number=None, start: date = None, end: date = None):
+    """Return daily consumption totals.
+
+    meter_number: only return totals for this meter. Defaults to all meters.
+    start: first day to include. Defaults to the earliest.
+    end: last day to include. Defaults to the latest.
+
+    Returns a list of ConsumptionTotal, ordered by meter number and day, with
+    `period` being the day.
+    """
+
+    statement = select(
+        DailyConsumption.meter_number,
+        DailyConsumption.day,
+        DailyConsumption.total,
+        DailyConsumption.count,
+        DailyConsumption.minimum,
+        DailyConsumption.maximum
+    ).order_by(DailyConsumption.meter_number, DailyConsumption.day)
+    statement = _filter(statement, meter_number, start, end)
+
+    return [ConsumptionTotal(*row) for row in _execute(statement, meter_number)]
+
+
+def monthly_totals(meter_number=None, start: date = None, end: date = None):
+    """Return monthly consumption totals.
+
+    meter_number: only return totals for this meter. Defaults to all meters.
+    start: first day to include. Defaults to the earliest.
+    end: last day to include. Defaults to the latest.
+
+    Returns a list of ConsumptionTotal, ordered by meter number and month,
+    with `period` being the first day of the month.
+    """
+
+    month = func.strftime('%Y-%m', DailyConsumption.day).label('month')
+    statement = select(
+        DailyConsumption.meter_number,
+        month,
+        func.sum(DailyConsumption.total),
+        func.sum(DailyConsumption.count),
+        func.min(DailyConsumption.minimum),
+        func.max(DailyConsumption.maximum)
+    ).group_by(DailyConsumption.meter_number, month) \
+        .order_by(DailyConsumption.meter_number, month)
+    statement = _filter(statement, meter_number, start, end)
+
+    return [
+        ConsumptionTotal(meter_number, date.fromisoformat(f'{month}-01'), *values)
+        for meter_number, month, *values in _execute(statement, meter_number)
+    ]
+
+
+def readings(meter_number=None, start: datetime = None, end: datetime = None):
+    """Return individual readings.
+
+    meter_number: only return readings for this meter. Defaults to all meters.
+    start: earliest measurement time to include. Defaults to the earliest.
+    end: latest measurement time to include. Defaults to the latest.
+
+    Returns a list of Reading, ordered by meter number and measurement time.
+    """
+
+    statement = select(
+        Record.meter_number,
+        Record.measurement_time,
+        Record.consumption,
+        Record.file_id
+    ).order_by(Record.meter_number, Record.measurement_time)
+    if meter_number is not None:
+        statement = statement.where(Record.meter_number == meter_number)
+    if start is not None:
+        statement = statement.where(Record.measurement_time >= start)
+    if end is not None:
+        statement = statement.where(Record.measurement_time <= end)
+
+    return [Reading(*row) for row in _execute(statement, meter_number)]
@@ -0,0 +1,177 @@
+"""SMRT Importer scheduling of the incoming queue.
+
+Files found in the incoming directory are queued, and the queue's policy
+decides which is imported next:
+
+* `oldest`: by the creation time in the file header, then name.
+* `smallest`: by size, so a large backfill doesn't hold up small files.
+* `fair`: alternating between small and large files (each class oldest
+  first), except that small files which have waited longer than the SLO go
+  first, so small files keep arriving promptly without starving large ones.
+
+Files don't need writing in creation time order for newer readings to win,
+as the DB never overwrites a record from a file with a newer creation time.
+"""
+
+
+from collections import deque, namedtuple
+from datetime import datetime
+import heapq
+from itertools import count
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+from smrt_importer import metrics
+from smrt_importer.loader import SMRTLoader
+
+
+POLICIES = ('oldest', 'smallest', 'fair')
+
+# path: incoming path. size: bytes. creation_time: from the header, or
+# datetime.min if unreadable. queued: monotonic time the file was queued.
+# small: whether the file is at most the small file size.
+QueuedFile = namedtuple('QueuedFile', 'path size creation_time queued small')
+
+
+def creation_time(path: Path):
+    """Return the creation time in a file's header, or datetime.min if it
+    can't be read.
+    """
+
+    try:
+        result = SMRTLoader().load_file_header(path).creation_time
+    except Exception:
+        # The file will fail properly when it is loaded in full.
+        result = None
+    return result or datetime.min
+
+
+def _size_class(small):
+    return 'small' if small else 'large'
+
+
+class IncomingQueue:
+    """Queue of files waiting to be imported, ordered by a policy.
+
+    The queue may be added to and popped from by different threads.
+    """
+
+    def __init__(self, policy='oldest', small_file_size=1048576, small_file_slo=60.0):
+        """policy: 'oldest', 'smallest' or 'fair'.
+        small_file_size: files of at most this many bytes are small.
+        small_file_slo: with the fair policy, small files which have waited
+            this many seconds are imported before any large file.
+        """
+
+        if policy not in POLICIES:
+            raise ValueError(f'unknown queue policy: {policy}')
+
+        self.policy = policy
+        self.small_file_size = small_file_size
+        self.small_file_slo = small_file_slo
+        self._files = {}
+        # Heaps of `(key, sequence, QueuedFile)`, by whether the files are
+        # small if the policy is fair, otherwise all in one. Entries for
+        # files no longer queued are skipped when reached.
+        self._heaps = {False: [], True: []}
+        # Small files in the order they were queued, for the fair policy's
+        # SLO.
+        self._arrivals = deque()
+        self._sequence = count()
+        self._counts = {False: 0, True: 0}
+        self._last_small = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def _key(self, file: QueuedFile):
+        if self.policy == 'smallest':
+            return file.size, file.creation_time, file.path.name
+        return file.creation_time, file.path.name
+
+    def _count(self, file: QueuedFile, change):
+        self._counts[file.small] += change
+        metrics.QUEUED_FILES.set(self._counts[file.small], size=_size_class(file.small))
+
+    def add(self, path):
+        """Queue a file, unless it is already queued or no longer exists.
+
+        Returns True if queued.
+        """
+
+        path = Path(path)
+        if path in self:
+            return False
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return False
+        file = QueuedFile(
+            path, size, creation_time(path), monotonic(), size <= self.small_file_size
+        )
+
+        with self._lock:
+            if path in self._files:
+                return False
+            self._files[path] = file
+            fair_small = file.small and self.policy == 'fair'
+            heapq.heappush(self._heaps[fair_small], (self._key(file), next(self._sequence), file))
+            if fair_small:
+                self._arrivals.append(file)
+            self._count(file, 1)
+        return True
+
+    def extend(self, paths):
+        """Queue a number of files. Returns the number queued."""
+
+        return sum(self.add(path) for path in paths)
+
+    def _peek(self, heap):
+        """Return the first file in a heap still queued, or None."""
+
+        while heap and self._files.get(heap[0][2].path) is not heap[0][2]:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+    def _overdue(self):
+        """Return True if a small file has waited longer than the SLO."""
+
+        arrivals = self._arrivals
+        while arrivals and self._files.get(arrivals[0].path) is not arrivals[0]:
+            arrivals.popleft()
+        return bool(arrivals) and monotonic() - arrivals[0].queued >= self.small_file_slo
+
+    def _choose(self):
+        large = self._peek(self._heaps[False])
+        if self.policy != 'fair':
+            return large
+
+        small = self._peek(self._heaps[True])
+        if small is None or large is None:
+            return small or large
+        if self._overdue() or not self._last_small:
+            return small
+        return large
+
+    def pop(self):
+        """Remove and return the path of the file to import next, or None if
+        the queue is empty.
+        """
+
+        with self._lock:
+            file = self._choose()
+            if file is None:
+                return None
+            del self._files[file.path]
+            self._last_small = file.small
+            self._count(file, -1)
+
+        metrics.QUEUE_WAIT_SECONDS.observe(
+            monotonic() - file.queued, size=_size_class(file.small)
+        )
+        return file.path
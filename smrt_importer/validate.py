@@ -0,0 +1,110 @@
+"""SMRT Importer validation of files without importing them.
+
+Files are loaded as by the importer, in parallel across processes, but
+records are discarded rather than written, and files are left where they
+are. Files which have already been imported are not detected, as the DB is
+not used.
+"""
+
+
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+from time import perf_counter
+
+from smrt_importer.config import config
+from smrt_importer.loader import DecodingError, SMRTLoader
+from smrt_importer.processor import FILE_PATTERNS
+
+
+FileResult = namedtuple('FileResult', 'path rows bytes seconds reason line error')
+
+
+def validate_file(path):
+    """Load a file, discarding its records.
+
+    path: path (string or Path object) to a SMRT file.
+
+    Returns a FileResult. If the file is valid, `reason`, `line` and `error`
+    are None.
+    """
+
+    start = perf_counter()
+    loader = SMRTLoader(config.mmap_min_size)
+    size = 0
+    reason = line = error = None
+    try:
+        size = os.path.getsize(path)
+        for _ in loader.stream_file(path, config.batch_size):
+            pass
+    except DecodingError as e:
+        reason, line, error = e.reason, e.line, str(e)
+    except Exception as e:
+        # For example, an unreadable file, or one which is not valid text.
+        reason, error = type(e).__name__, str(e)
+
+    return FileResult(str(path), loader.record_count, size, perf_counter() - start, reason, line, error)
+
+
+def _find_files(path: Path):
+    paths = []
+    for pattern in FILE_PATTERNS:
+        paths.extend(path.glob(pattern))
+    return sorted(paths)
+
+
+def validate_dir(path=None, workers=None):
+    """Validate all SMRT files in a directory, in parallel.
+
+    path: path (string or Path object) to a directory containing SMRT files.
+        Defaults to configured incoming directory.
+    workers: number of processes. Defaults to the number of CPUs.
+
+    Returns a report dictionary, suitable for writing as JSON, with counts of
+    files, records and bytes, throughput, the number of failures by reason,
+    and a list of the failures, each with the file, line number (if known),
+    reason and error message.
+    """
+
+    path = Path(config.incoming_dir if path is None else path)
+    paths = _find_files(path)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    start = perf_counter()
+    if workers > 1 and len(paths) > 1:
+        # Send files to workers in chunks, as there may be tens of thousands.
+        chunksize = max(1, len(paths) // (workers * 8))
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(validate_file, paths, chunksize=chunksize))
+    else:
+        results = [validate_file(p) for p in paths]
+    seconds = perf_counter() - start
+
+    failures = [result for result in results if result.reason is not None]
+    rows = sum(result.rows for result in results)
+    size = sum(result.bytes for result in results)
+    return {
+        'path': str(path),
+        'files': len(results),
+        'valid': len(results) - len(failures),
+        'invalid': len(failures),
+        'rows': rows,
+        'bytes': size,
+        'seconds': round(seconds, 3),
+        'workers': workers,
+        'files_per_second': round(len(results) / seconds, 1) if seconds else None,
+        'rows_per_second': round(rows / seconds) if seconds else None,
+        'bytes_per_second': round(size / seconds) if seconds else None,
+        'reasons': dict(Counter(result.reason for result in failures).most_common()),
+        'failures': [
+            {
+                'file': result.path,
+                'line': result.line,
+                'reason': result.reason,
+                'error': result.error,
+            }
+            for result in failures
+        ],
+    }
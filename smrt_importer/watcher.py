@@ -0,0 +1,223 @@
+"""SMRT Importer directory watchers.
+
+Watchers report files which have been written to (or moved into) a
+directory. On Linux, inotify is used so files are picked up as soon as they
+have been closed after writing. Elsewhere, or if inotify cannot be used, the
+directory is polled, backing off whilst it remains empty.
+"""
+
+
+import ctypes
+import ctypes.util
+import errno
+from fnmatch import fnmatch
+import os
+from pathlib import Path
+import select
+import struct
+import sys
+from time import sleep
+
+
+# Constants from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event header: wd, mask, cookie, len. Followed by `len` bytes
+# of NUL-padded name.
+_EVENT_HEADER = struct.Struct('iIII')
+
+_READ_SIZE = 64 * 1024
+
+
+def _scan(path: Path, patterns):
+    """Return files in a directory matching any of the glob patterns."""
+
+    paths = []
+    for pattern in patterns:
+        paths.extend(path.glob(pattern))
+    return paths
+
+
+def _load_libc():
+    """Return the C library if it provides inotify, else None."""
+
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+
+    if not hasattr(libc, 'inotify_init1') or not hasattr(libc, 'inotify_add_watch'):
+        return None
+
+    return libc
+
+
+class PollingWatcher:
+    """Watch a directory by periodically scanning it.
+
+    The interval between scans doubles each time nothing is found, up to
+    `max_interval`, and resets as soon as a file appears.
+    """
+
+    name = 'polling'
+
+    def __init__(self, path, patterns, min_interval=0.5, max_interval=5.0):
+        """path: directory to watch.
+        patterns: glob patterns of files to report.
+        min_interval: seconds to wait after an empty scan.
+        max_interval: maximum seconds to wait between scans.
+        """
+
+        self.path = Path(path)
+        self.patterns = patterns
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._interval = min_interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def wait(self, timeout=None):
+        """Scan the directory, waiting after the scan if nothing was found.
+
+        timeout: maximum seconds to wait. Defaults to the current interval.
+
+        Returns a list of matching paths, which may be empty.
+        """
+
+        paths = _scan(self.path, self.patterns)
+        if paths:
+            self._interval = self.min_interval
+        else:
+            sleep(self._interval if timeout is None else min(self._interval, timeout))
+            self._interval = min(self._interval * 2, self.max_interval)
+
+        return paths
+
+
+class InotifyWatcher:
+    """Watch a directory using Linux inotify.
+
+    Files are reported once they have been closed after writing or moved into
+    the directory.
+    """
+
+    name = 'inotify'
+
+    def __init__(self, path, patterns, libc=None):
+        """path: directory to watch.
+        patterns: glob patterns of files to report.
+        libc: C library providing inotify. Loaded if not given.
+
+        Raises OSError if inotify is unavailable.
+        """
+
+        self.path = Path(path)
+        self.patterns = patterns
+
+        if libc is None:
+            libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self._fd, os.fsencode(self.path), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), str(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_events(self):
+        """Read all pending events, returning a list of `(mask, name)`."""
+
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                return events
+
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((mask, os.fsdecode(name)))
+
+    def wait(self, timeout=None):
+        """Wait for files to be written to the directory.
+
+        timeout: maximum seconds to wait, or None to wait indefinitely.
+
+        Returns a list of matching paths, which may be empty.
+        """
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        paths = []
+        for mask, name in self._read_events():
+            # Events were dropped, so fall back to scanning the directory.
+            if mask & IN_Q_OVERFLOW:
+                return _scan(self.path, self.patterns)
+
+            if name and any(fnmatch(name, pattern) for pattern in self.patterns):
+                path = self.path / name
+                if path not in paths:
+                    paths.append(path)
+
+        return paths
+
+
+def create_watcher(path, patterns, backend='auto', poll_interval=0.5, max_poll_interval=5.0):
+    """Create a watcher for a directory.
+
+    path: directory to watch.
+    patterns: glob patterns of files to report.
+    backend: 'inotify', 'poll' or 'auto'. 'auto' uses inotify where available,
+        otherwise polling.
+    poll_interval: minimum polling interval in seconds.
+    max_poll_interval: maximum polling interval in seconds.
+    """
+
+    if backend not in ('auto', 'inotify', 'poll'):
+        raise ValueError(f'unknown watcher backend: {backend}')
+
+    if backend != 'poll':
+        try:
+            return InotifyWatcher(path, patterns)
+        except OSError:
+            if backend == 'inotify':
+                raise
+
+    return PollingWatcher(path, patterns, poll_interval, max_poll_interval)
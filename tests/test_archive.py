@@ -0,0 +1,98 @@
+from datetime import date
+import csv
+from pathlib import Path
+import tarfile
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from smrt_importer.archive import Archiver, compact, find_archived, partition_dir
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.dir = Path(self._tmp.name)
+        self.incoming = self.dir / 'incoming'
+        self.incoming.mkdir()
+        self.dest = self.dir / 'processed'
+
+    def write(self, name, content='data'):
+        path = self.incoming / name
+        path.write_text(content)
+        return path
+
+    def test_flat_move(self):
+        newpath = Archiver('flat').move(self.write('FOO.SMRT'), self.dest)
+        self.assertEqual(newpath, self.dest / 'FOO.SMRT')
+        self.assertEqual(newpath.read_text(), 'data')
+        self.assertEqual(list(self.incoming.iterdir()), [])
+
+    def test_date_move(self):
+        with patch('smrt_importer.archive.date') as mock_date:
+            mock_date.today.return_value = date(2021, 1, 2)
+            newpath = Archiver('date').move(self.write('FOO.SMRT'), self.dest)
+        self.assertEqual(newpath, self.dest / '2021-01-02' / 'FOO.SMRT')
+
+    def test_collision_renamed(self):
+        archiver = Archiver()
+        first = archiver.move(self.write('FOO.SMRT.gz', 'first'), self.dest)
+        second = archiver.move(self.write('FOO.SMRT.gz', 'second'), self.dest)
+        self.assertNotEqual(first, second)
+        self.assertRegex(second.name, r'^FOO_[0-9a-f]+\.SMRT\.gz$')
+        self.assertEqual(first.read_text(), 'first')
+        self.assertEqual(second.read_text(), 'second')
+
+    def test_invalid_layout(self):
+        with self.assertRaises(ValueError):
+            Archiver('monthly')
+
+    def test_compact(self):
+        for day in [date(2021, 1, 1), date(2021, 1, 9)]:
+            directory = partition_dir(self.dest, 'date', day)
+            directory.mkdir(parents=True)
+            (directory / 'FOO.SMRT').write_text(str(day))
+
+        archives = compact(self.dest, 7, today=date(2021, 1, 10))
+
+        self.assertEqual(archives, [self.dest / '2021-01-01.tar.gz'])
+        self.assertFalse((self.dest / '2021-01-01').exists())
+        self.assertTrue((self.dest / '2021-01-09' / 'FOO.SMRT').exists())
+        with tarfile.open(archives[0]) as tar:
+            self.assertEqual(tar.extractfile('2021-01-01/FOO.SMRT').read(), b'2021-01-01')
+        with open(self.dest / '2021-01-01.index.csv', newline='') as f:
+            self.assertEqual([row['name'] for row in csv.DictReader(f)], ['FOO.SMRT'])
+
+        self.assertEqual(find_archived(self.dest, 'FOO.SMRT'), [
+            self.dest / '2021-01-09' / 'FOO.SMRT',
+            self.dest / '2021-01-01.tar.gz' / 'FOO.SMRT',
+        ])
+        self.assertEqual(find_archived(self.dest, 'BAR.SMRT'), [])
+
+    def test_find_archived_without_single_archive(self):
+        directory = partition_dir(self.dest, 'date', date(2021, 1, 1))
+        directory.mkdir(parents=True)
+        (directory / 'FOO.SMRT').write_text('foo')
+        archive = compact(self.dest, 7, today=date(2021, 1, 10))[0]
+
+        recompressed = self.dest / '2021-01-01.tar.xz'
+        recompressed.write_bytes(b'')
+        self.assertEqual(find_archived(self.dest, 'FOO.SMRT'), [
+            archive / 'FOO.SMRT',
+            recompressed / 'FOO.SMRT',
+        ])
+
+        archive.unlink()
+        recompressed.unlink()
+        with self.assertLogs('smrt_importer.archive', 'WARNING'):
+            self.assertEqual(find_archived(self.dest, 'FOO.SMRT'), [])
+
+    def test_compact_today_rejected(self):
+        with self.assertRaises(ValueError):
+            compact(self.dest, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
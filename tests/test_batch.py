@@ -0,0 +1,40 @@
+from datetime import datetime
+import pickle
+import unittest
+from unittest import TestCase
+
+from smrt_importer.batch import RecordBatch, to_datetime, to_seconds
+
+
+class RecordBatchTestCase(TestCase):
+    def make_batch(self):
+        batch = RecordBatch()
+        batch.append('0000000001', to_seconds(datetime(2020, 11, 22, 8, 1)), 1.23)
+        batch.append('0000000002', to_seconds(datetime(2020, 11, 22, 8, 1)), 4.56)
+        batch.append('0000000001', to_seconds(datetime(2020, 11, 22, 8, 2)), 7.89)
+        return batch
+
+    def test_meter_numbers_interned(self):
+        batch = self.make_batch()
+        self.assertEqual(batch.meters, ['0000000001', '0000000002'])
+        self.assertEqual(list(batch.meter_codes), [0, 1, 0])
+
+    def test_sequence(self):
+        batch = self.make_batch()
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch[2], ('0000000001', datetime(2020, 11, 22, 8, 2), 7.89))
+        self.assertEqual(list(batch), batch[:])
+
+    def test_pickle(self):
+        batch = pickle.loads(pickle.dumps(self.make_batch()))
+        self.assertEqual(list(batch), list(self.make_batch()))
+        batch.append('0000000002', 0, 0.0)
+        self.assertEqual(batch.meter_codes[-1], 1)
+
+    def test_seconds_round_trip(self):
+        timestamp = datetime(2021, 1, 2, 13, 58, 21)
+        self.assertEqual(to_datetime(to_seconds(timestamp)), timestamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
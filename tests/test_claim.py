@@ -0,0 +1,67 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import time
+import unittest
+from unittest import TestCase
+
+from smrt_importer.claim import Claimer
+
+
+class ClaimerTestCase(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.incoming = Path(tmp_dir.name)
+        self.path = self.incoming / 'CLAIM.SMRT'
+        self.path.write_text('data')
+
+    def start(self, worker_id, lease_seconds=60):
+        claimer = Claimer(self.incoming, worker_id, lease_seconds)
+        claimer.start()
+        self.addCleanup(claimer.stop)
+        return claimer
+
+    def test_claimed_once(self):
+        a, b = self.start('a'), self.start('b')
+        claimed = a.claim(self.path)
+        self.assertEqual(claimed, self.incoming / 'claimed' / 'a' / 'CLAIM.SMRT')
+        self.assertEqual(claimed.read_text(), 'data')
+        self.assertIsNone(b.claim(self.path))
+
+        # A file of the same name can't be claimed until the first is done.
+        self.path.write_text('resent')
+        self.assertIsNone(a.claim(self.path))
+        self.assertIsNotNone(b.claim(self.path))
+
+    def test_stale_claims_reclaimed(self):
+        a, b = self.start('a'), self.start('b')
+        a.claim(self.path)
+        self.assertEqual(b.reclaim_stale(), [])
+
+        # Instance a has died, so its lease hasn't been renewed.
+        a.stop()
+        a.directory.mkdir()
+        os.rename(self.path, a.directory / self.path.name)
+        expired = time() - 120
+        os.utime(a.directory, (expired, expired))
+
+        self.assertEqual(b.reclaim_stale(), [self.path])
+        self.assertEqual(self.path.read_text(), 'data')
+        self.assertFalse(a.directory.exists())
+
+    def test_stop_releases_claims(self):
+        a = self.start('a')
+        a.claim(self.path)
+        a.stop()
+        self.assertTrue(self.path.exists())
+        self.assertFalse(a.directory.exists())
+
+    def test_claim_after_wrongly_reclaimed(self):
+        a = self.start('a')
+        a.directory.rmdir()
+        self.assertIsNotNone(a.claim(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+from datetime import datetime
+from pathlib import Path
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from smrt_importer.cli import main
+from smrt_importer.export import ExportResult
+
+
+class MainTestCase(TestCase):
+    def test_once(self):
+        with patch('smrt_importer.processor.process_dir') as process_dir:
+            main(['once', 'some/dir'])
+        path, pool, group, claimer = process_dir.call_args.args
+        self.assertEqual(path, 'some/dir')
+        self.assertIsNone(pool)
+        self.assertIsNone(claimer)
+
+    def test_watch_is_default(self):
+        with patch('smrt_importer.processor.watch_dir') as watch_dir:
+            main(['--workers', '3'])
+        watch_dir.assert_called_once_with(None, 3)
+
+    def test_options_before_and_after_command(self):
+        with patch('smrt_importer.processor.watch_dir') as watch_dir:
+            main(['--workers', '3', 'watch', 'some/dir'])
+        watch_dir.assert_called_once_with('some/dir', 3)
+
+        with patch('smrt_importer.processor.watch_dir') as watch_dir:
+            main(['watch', '--workers', '2'])
+        watch_dir.assert_called_once_with(None, 2)
+
+    def test_compact(self):
+        with patch('smrt_importer.archive.compact') as compact:
+            main(['compact', '--days', '7'])
+        self.assertEqual([call.args[1] for call in compact.call_args_list], [7, 7])
+
+    def test_profile(self):
+        with patch('smrt_importer.processor.process_dir'), \
+                patch('smrt_importer.profiling.enable') as enable, \
+                patch('smrt_importer.profiling.profiler') as profiler:
+            profiler.summary.return_value = None
+            main(['once', '--profile-fraction', '0.5'])
+            enable.assert_called_once_with(0.5)
+
+            enable.reset_mock()
+            main(['--profile', 'once'])
+            enable.assert_called_once_with(1.0)
+
+        with self.assertRaises(SystemExit), patch('sys.stderr'):
+            main(['once', '--profile-fraction', '2'])
+
+    def test_export_state(self):
+        with TemporaryDirectory() as tmp_dir:
+            state = Path(tmp_dir) / 'state'
+            state.write_text('2021-01-01T00:00:00\n')
+            result = ExportResult(1, datetime(2021, 1, 2))
+            with patch('smrt_importer.export.export_records', return_value=result) as export_records:
+                main(['export', 'out.csv', '--meter-from', 'A', '--state', str(state)])
+            self.assertEqual(export_records.call_args.args, (
+                'out.csv', None, 'A', None, None, None, datetime(2021, 1, 1)
+            ))
+            self.assertEqual(state.read_text(), '2021-01-02T00:00:00\n')
+
+    def test_invalid_workers(self):
+        with self.assertRaises(SystemExit), patch('sys.stderr'):
+            main(['once', '--workers', '0'])
+
+
+class LazyImportTestCase(TestCase):
+    def test_import_does_not_load_config_or_db(self):
+        code = (
+            'import smrt_importer.processor, smrt_importer.query\n'
+            'from smrt_importer import db\n'
+            'from smrt_importer.config import config\n'
+            'assert not config._loaded\n'
+            'assert "engine" not in vars(db)\n'
+        )
+        subprocess.run([sys.executable, '-c', code], check=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
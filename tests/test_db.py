@@ -1,10 +1,125 @@
 from datetime import datetime
-from sqlalchemy import select
+from pathlib import Path
+from sqlalchemy import delete, inspect, select, text
+from sqlalchemy.engine import RootTransaction
+from sqlalchemy.exc import OperationalError
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 import unittest
 
-from smrt_importer.db import insert_file, Session
-from smrt_importer.models import File, Record
+from smrt_importer.batch import RecordBatch, to_seconds
+from smrt_importer.loader import DecodingError
+from smrt_importer.config import config
+from smrt_importer import db, metrics
+from smrt_importer.db import (
+    bulk_insert_file,
+    engine,
+    FileGroup,
+    get_checkpoint,
+    imported_filenames,
+    insert_file,
+    insert_file_resumable,
+    _record_params,
+    Session
+)
+from smrt_importer.models import DailyConsumption, File, ImportCheckpoint, Record
+from smrt_importer.query import Reading, readings
+
+
+class PragmaTestCase(TestCase):
+    def test_configured_pragmas_applied(self):
+        with engine.connect() as connection:
+            for name, value in config.db_pragmas.items():
+                result = connection.execute(text(f'PRAGMA {name}')).scalar()
+                if name == 'journal_mode':
+                    self.assertEqual(result, value.lower())
+                elif value.lstrip('-').isdigit():
+                    self.assertEqual(result, int(value))
+
+
+class ContentHashTestCase(TestCase):
+    filenames = ['HASH_A.SMRT', 'HASH_B.SMRT']
+
+    def tearDown(self):
+        with Session() as session:
+            session.execute(delete(Record).where(Record.meter_number == 'HASH1'))
+            session.execute(delete(File).where(File.filename.in_(self.filenames)))
+            session.commit()
+        imported_filenames.load()
+
+    def make_file(self, filename, content_hash=None):
+        return File(
+            filename=filename,
+            creation_time=datetime(2021, 1, 1),
+            imported_time=datetime.now(),
+            gen_num='PV123456',
+            content_hash=content_hash
+        )
+
+    def test_duplicate_content_rejected(self):
+        bulk_insert_file(self.make_file('HASH_A.SMRT', 'a' * 64), [[('HASH1', datetime(2021, 1, 1), 1.0)]])
+
+        def chunks(file):
+            yield [('HASH1', datetime(2021, 1, 1), 2.0)]
+            # Streamed files are only hashed once read to the end.
+            file.content_hash = 'a' * 64
+
+        for name, insert in [
+            ('insert_file', lambda file: insert_file(file)),
+            ('bulk_insert_file', lambda file: bulk_insert_file(file)),
+            ('streamed', lambda file: bulk_insert_file(file, chunks(file))),
+        ]:
+            with self.subTest(name):
+                file = self.make_file('HASH_B.SMRT', None if name == 'streamed' else 'a' * 64)
+                file.records = [Record(meter_number='HASH1', measurement_time=datetime(2021, 1, 1), consumption=2.0)]
+                with self.assertRaises(db.DuplicateFileError) as cm:
+                    insert(file)
+                self.assertEqual(cm.exception.original, 'HASH_A.SMRT')
+                self.assertNotIn('HASH_B.SMRT', imported_filenames)
+                self.assertEqual([r.consumption for r in readings('HASH1')], [1.0])
+
+    def test_column_added_to_existing_db(self):
+        with TemporaryDirectory() as tmp_dir:
+            old_engine = db._create_engine(Path(tmp_dir) / 'old.db')
+            with old_engine.begin() as connection:
+                connection.exec_driver_sql(
+                    'CREATE TABLE file (id INTEGER PRIMARY KEY, filename VARCHAR NOT NULL UNIQUE, '
+                    'creation_time DATETIME NOT NULL, imported_time DATETIME NOT NULL, '
+                    'gen_num CHAR(8) NOT NULL)'
+                )
+
+            for _ in range(2):
+                with old_engine.begin() as connection:
+                    db._add_content_hash(connection)
+
+            inspector = inspect(old_engine)
+            self.assertIn('content_hash', [column['name'] for column in inspector.get_columns('file')])
+            self.assertEqual(
+                [index['column_names'] for index in inspector.get_indexes('file')],
+                [['content_hash']]
+            )
+            old_engine.dispose()
+
+
+class RecordParamsTestCase(TestCase):
+    def test_batch_matches_tuples(self):
+        rows = [
+            ('0000000001', datetime(2020, 11, 22, 8, 1), 1.23),
+            ('0000000002', datetime(1969, 12, 31, 23, 59, 59), 4.56),
+        ]
+        batch = RecordBatch()
+        for meter_number, measurement_time, consumption in rows:
+            batch.append(meter_number, to_seconds(measurement_time), consumption)
+
+        expected = [
+            (1, '0000000001', '2020-11-22 08:01:00.000000', 1.23),
+            (1, '0000000002', '1969-12-31 23:59:59.000000', 4.56),
+        ]
+        self.assertEqual(_record_params(1, rows), expected)
+        self.assertEqual(_record_params(1, batch), expected)
+        with patch('smrt_importer.db._numpy', lambda: None):
+            self.assertEqual(_record_params(1, batch), expected)
 
 
 class InsertFileTestCase(TestCase):
@@ -31,5 +146,419 @@ class InsertFileTestCase(TestCase):
                 session.commit()
 
 
+    def test_insert_empty_file(self):
+        for name, insert in [('insert_file', insert_file), ('bulk_insert_file', bulk_insert_file)]:
+            with self.subTest(name):
+                file = File(
+                    filename = 'EMPTY.SMRT',
+                    creation_time = datetime.now(),
+                    imported_time = datetime.now(),
+                    gen_num = 'PV123456'
+                )
+                file_id = insert(file)
+                with Session() as session:
+                    try:
+                        self.assertEqual(session.get(File, file_id).records, [])
+                    finally:
+                        session.execute(delete(File).where(File.id == file_id))
+                        session.commit()
+                imported_filenames.load()
+
+
+class BulkInsertFileTestCase(TestCase):
+    def test_bulk_insert_file_with_records(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        file = File(
+            filename = 'BULK.SMRT',
+            creation_time = datetime.now(),
+            imported_time = datetime.now(),
+            gen_num = 'PV123456',
+            records = [
+                Record(meter_number='1234', measurement_time=measurement_time, consumption=1.23),
+                Record(meter_number='5678', measurement_time=measurement_time, consumption=4.56),
+                # Duplicate meter number and time should replace the first record.
+                Record(meter_number='1234', measurement_time=measurement_time, consumption=7.89)
+            ]
+        )
+        file_id = bulk_insert_file(file, batch_size=2)
+        self.assertIsNotNone(file_id)
+        with Session() as session:
+            try:
+                statement = select(Record).where(Record.file_id == file_id) \
+                    .order_by(Record.meter_number)
+                records = session.execute(statement).scalars().all()
+                self.assertEqual(
+                    [(r.meter_number, r.consumption) for r in records],
+                    [('1234', 7.89), ('5678', 4.56)]
+                )
+                for record in records:
+                    session.delete(record)
+            finally:
+                session.delete(session.get(File, file_id))
+                session.commit()
+
+
+    def test_bulk_insert_file_rolls_back_failed_chunks(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        file = File(
+            filename = 'BULK_FAILED.SMRT',
+            creation_time = datetime.now(),
+            imported_time = datetime.now(),
+            gen_num = 'PV123456'
+        )
+
+        def chunks():
+            yield [('1234', measurement_time, 1.23)]
+            raise DecodingError('incomplete file received')
+
+        with self.assertRaises(DecodingError):
+            bulk_insert_file(file, chunks())
+        with Session() as session:
+            statement = select(File).where(File.filename == file.filename)
+            self.assertIsNone(session.execute(statement).scalar())
+
+
+class UpsertTestCase(TestCase):
+    filenames = ['UPSERT_A.SMRT', 'UPSERT_B.SMRT']
+    meters = ['UPSERT1', 'UPSERT2', 'UPSERT3']
+
+    def tearDown(self):
+        with Session() as session:
+            session.execute(delete(Record).where(Record.meter_number.in_(self.meters)))
+            session.execute(delete(File).where(File.filename.in_(self.filenames)))
+            session.commit()
+
+    def make_file(self, filename, creation_time=None):
+        return File(
+            filename = filename,
+            creation_time = creation_time or datetime.now(),
+            imported_time = datetime.now(),
+            gen_num = 'PV123456'
+        )
+
+    def test_only_changed_records_written(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        first_id = bulk_insert_file(self.make_file('UPSERT_A.SMRT'), [[
+            ('UPSERT1', measurement_time, 1.0),
+            ('UPSERT2', measurement_time, 2.0)
+        ]])
+
+        with metrics.file_records() as counts:
+            second_id = bulk_insert_file(self.make_file('UPSERT_B.SMRT'), [[
+                ('UPSERT1', measurement_time, 1.0),
+                ('UPSERT2', measurement_time, 3.0),
+                ('UPSERT3', measurement_time, 4.0),
+                ('UPSERT3', measurement_time, 5.0)
+            ]])
+
+        self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'unchanged': 1})
+        with Session() as session:
+            statement = select(Record.meter_number, Record.file_id, Record.consumption) \
+                .where(Record.meter_number.in_(self.meters)).order_by(Record.meter_number)
+            self.assertEqual(session.execute(statement).all(), [
+                ('UPSERT1', first_id, 1.0),
+                ('UPSERT2', second_id, 3.0),
+                ('UPSERT3', second_id, 5.0)
+            ])
+
+    def test_records_repeated_across_chunks_counted_once(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        with metrics.file_records() as counts:
+            bulk_insert_file(self.make_file('UPSERT_A.SMRT'), [
+                [('UPSERT1', measurement_time, 1.0)],
+                [('UPSERT1', measurement_time, 2.0)],
+                [('UPSERT1', measurement_time, 2.0)]
+            ])
+
+        self.assertEqual(counts, {'inserted': 1, 'updated': 0, 'unchanged': 0})
+        self.assertEqual([reading.consumption for reading in readings('UPSERT1')], [2.0])
+
+    def test_insert_file_leaves_records_unchanged(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        file = self.make_file('UPSERT_A.SMRT')
+        file.records = [
+            Record(meter_number='UPSERT1', measurement_time=measurement_time, consumption=consumption)
+            for consumption in (1.0, 2.0)
+        ]
+        insert_file(file)
+
+        self.assertEqual([record.consumption for record in file.records], [1.0, 2.0])
+        self.assertEqual([reading.consumption for reading in readings('UPSERT1')], [2.0])
+
+    def test_older_file_does_not_overwrite_newer(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        newer_id = bulk_insert_file(self.make_file('UPSERT_A.SMRT', datetime(2020, 1, 3)), [[
+            ('UPSERT1', measurement_time, 2.0)
+        ]])
+
+        # E.g. a backfill imported after newer files.
+        with metrics.file_records() as counts:
+            older_id = bulk_insert_file(self.make_file('UPSERT_B.SMRT', datetime(2020, 1, 2)), [[
+                ('UPSERT1', measurement_time, 1.0),
+                ('UPSERT2', measurement_time, 1.0)
+            ]])
+
+        self.assertEqual(counts, {'inserted': 1, 'updated': 0, 'unchanged': 1})
+        with Session() as session:
+            statement = select(Record.meter_number, Record.file_id, Record.consumption) \
+                .where(Record.meter_number.in_(self.meters)).order_by(Record.meter_number)
+            self.assertEqual(session.execute(statement).all(), [
+                ('UPSERT1', newer_id, 2.0),
+                ('UPSERT2', older_id, 1.0)
+            ])
+
+
+class ResumableInsertTestCase(TestCase):
+    filename = 'RESUMABLE.SMRT'
+    meter = 'RESUMABLE1'
+
+    def tearDown(self):
+        with Session() as session:
+            file_ids = select(File.id).where(File.filename == self.filename)
+            session.execute(delete(ImportCheckpoint).where(ImportCheckpoint.file_id.in_(file_ids)))
+            session.execute(delete(Record).where(Record.meter_number == self.meter))
+            session.execute(delete(File).where(File.filename == self.filename))
+            session.execute(delete(DailyConsumption).where(DailyConsumption.meter_number == self.meter))
+            session.commit()
+        imported_filenames.load()
+
+    def make_file(self):
+        return File(
+            filename = self.filename,
+            creation_time = datetime(2021, 1, 1),
+            imported_time = datetime.now(),
+            gen_num = 'PV123456'
+        )
+
+    def chunks(self, start, stop, error=None):
+        for i in range(start, stop):
+            yield [(self.meter, datetime(2020, 1, 1, i), float(i))], (i + 1) * 100
+        if error is not None:
+            raise error
+
+    def saved_consumption(self):
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == self.meter) \
+                .order_by(Record.measurement_time)
+            return session.execute(statement).scalars().all()
+
+    def test_resume_after_interruption(self):
+        with self.assertRaises(KeyboardInterrupt):
+            insert_file_resumable(
+                self.make_file(), self.chunks(0, 3, KeyboardInterrupt()), checkpoint_rows=2
+            )
+
+        checkpoint = get_checkpoint(self.filename)
+        self.assertEqual((checkpoint.offset, checkpoint.record_count), (200, 2))
+        self.assertEqual(self.saved_consumption(), [0.0, 1.0])
+        imported_filenames.load()
+        self.assertNotIn(self.filename, imported_filenames)
+
+        insert_file_resumable(self.make_file(), self.chunks(2, 4), checkpoint, checkpoint_rows=2)
+        self.assertIsNone(get_checkpoint(self.filename))
+        self.assertEqual(self.saved_consumption(), [0.0, 1.0, 2.0, 3.0])
+        imported_filenames.load()
+        self.assertIn(self.filename, imported_filenames)
+
+    def test_failed_file_discarded(self):
+        with self.assertRaises(DecodingError):
+            insert_file_resumable(
+                self.make_file(),
+                self.chunks(0, 3, DecodingError('incomplete file received')),
+                checkpoint_rows=2
+            )
+
+        self.assertIsNone(get_checkpoint(self.filename))
+        self.assertEqual(self.saved_consumption(), [])
+        with Session() as session:
+            statement = select(File).where(File.filename == self.filename)
+            self.assertIsNone(session.execute(statement).scalar())
+            statement = select(DailyConsumption).where(DailyConsumption.meter_number == self.meter)
+            self.assertIsNone(session.execute(statement).scalar())
+
+
+class FileGroupTestCase(TestCase):
+    filenames = ['GROUP_A.SMRT', 'GROUP_B.SMRT', 'GROUP_C.SMRT']
+
+    def tearDown(self):
+        with Session() as session:
+            file_ids = select(File.id).where(File.filename.in_(self.filenames))
+            session.execute(delete(Record).where(Record.file_id.in_(file_ids)))
+            session.execute(delete(File).where(File.filename.in_(self.filenames)))
+            session.commit()
+
+    def make_file(self, filename):
+        return File(
+            filename = filename,
+            creation_time = datetime.now(),
+            imported_time = datetime.now(),
+            gen_num = 'PV123456'
+        )
+
+    def saved_filenames(self):
+        with Session() as session:
+            statement = select(File.filename).where(File.filename.in_(self.filenames)) \
+                .order_by(File.filename)
+            return session.execute(statement).scalars().all()
+
+    def test_failed_file_rolled_back_alone(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+
+        def failing_chunks():
+            yield [('GROUP1', measurement_time, 2.0)]
+            raise DecodingError('incomplete file received')
+
+        with FileGroup() as group:
+            group.add(self.make_file('GROUP_A.SMRT'), [[('GROUP1', measurement_time, 1.0)]])
+            with self.assertRaises(DecodingError):
+                group.add(self.make_file('GROUP_B.SMRT'), failing_chunks())
+            group.add(self.make_file('GROUP_C.SMRT'), [])
+            self.assertEqual(self.saved_filenames(), [])
+            group.commit()
+
+        self.assertEqual(self.saved_filenames(), ['GROUP_A.SMRT', 'GROUP_C.SMRT'])
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == 'GROUP1')
+            self.assertEqual(session.execute(statement).scalars().all(), [1.0])
+
+    def test_uncommitted_group_rolled_back(self):
+        before = metrics.RECORDS.render()
+        with FileGroup() as group:
+            group.add(self.make_file('GROUP_A.SMRT'), [[('GROUP1', datetime(2020, 1, 2), 1.0)]])
+        self.assertEqual(self.saved_filenames(), [])
+        # Records are only counted once committed.
+        self.assertEqual(metrics.RECORDS.render(), before)
+
+
+class ShardedInsertTestCase(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        engines = [
+            db.create_shard_engine(Path(tmp_dir.name) / f'shard{i}') for i in range(3)
+        ]
+        writers = [db.ShardWriter(shard_engine) for shard_engine in engines]
+        for name, value in [('shard_engines', engines), ('shard_writers', writers)]:
+            patcher = patch.object(db, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for shard_engine in engines:
+            self.addCleanup(shard_engine.dispose)
+        self.filename = 'SHARDED.SMRT'
+        self.older_filename = 'SHARDED_OLDER.SMRT'
+        self.addCleanup(self.delete_file)
+
+    def delete_file(self):
+        with Session() as session:
+            session.execute(
+                delete(File).where(File.filename.in_([self.filename, self.older_filename]))
+            )
+            session.commit()
+
+    def make_file(self, filename=None, creation_time=None):
+        return File(
+            filename = filename or self.filename,
+            creation_time = creation_time or datetime.now(),
+            imported_time = datetime.now(),
+            gen_num = 'PV123456'
+        )
+
+    def test_records_written_to_meter_shard(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        meters = [f'METER{i}' for i in range(20)]
+        file_id = bulk_insert_file(
+            self.make_file(),
+            [[(meter, measurement_time, 1.0) for meter in meters]]
+        )
+
+        with Session() as session:
+            self.assertIsNotNone(session.get(File, file_id))
+        for index, shard_engine in enumerate(db.shard_engines):
+            with shard_engine.connect() as connection:
+                shard_meters = connection.execute(
+                    select(Record.meter_number).where(Record.file_id == file_id)
+                ).scalars().all()
+            self.assertEqual(
+                sorted(shard_meters),
+                sorted(meter for meter in meters if db.shard_index(meter) == index)
+            )
+
+        self.assertEqual(
+            [reading.meter_number for reading in readings()],
+            sorted(meters)
+        )
+        self.assertEqual(
+            readings('METER7'),
+            [Reading('METER7', measurement_time, 1.0, file_id)]
+        )
+
+    def test_older_file_does_not_overwrite_newer(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        meters = [f'METER{i}' for i in range(20)]
+        newer_id = bulk_insert_file(self.make_file(creation_time=datetime(2020, 1, 3)), [
+            [(meter, measurement_time, 2.0) for meter in meters[:10]]
+        ])
+
+        with metrics.file_records() as counts:
+            older_id = bulk_insert_file(
+                self.make_file(self.older_filename, datetime(2020, 1, 2)),
+                [[(meter, measurement_time, 1.0) for meter in meters]]
+            )
+
+        self.assertEqual(counts, {'inserted': 10, 'updated': 0, 'unchanged': 10})
+        self.assertEqual(
+            sorted((reading.meter_number, reading.file_id) for reading in readings()),
+            sorted((meter, newer_id if i < 10 else older_id) for i, meter in enumerate(meters))
+        )
+
+    def test_creation_times_copied_to_existing_shard(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+        file_id = bulk_insert_file(self.make_file(creation_time=datetime(2020, 1, 3)), [
+            [(f'METER{i}', measurement_time, 2.0) for i in range(20)]
+        ])
+
+        # As if the shard was created before creation times were stored.
+        shard_engine = db.shard_engines[0]
+        with shard_engine.begin() as connection:
+            connection.exec_driver_sql('DROP TABLE shard_file')
+        shard_engine.dispose()
+
+        shard_engine = db.create_shard_engine(shard_engine.url.database, db.engine)
+        self.addCleanup(shard_engine.dispose)
+        with shard_engine.connect() as connection:
+            self.assertEqual(
+                connection.exec_driver_sql('SELECT id, creation_time FROM shard_file').all(),
+                [(file_id, '2020-01-03 00:00:00.000000')]
+            )
+
+    def test_failed_file_rolled_back_in_all_shards(self):
+        measurement_time = datetime(2020, 1, 2, 0, 0)
+
+        def chunks():
+            yield [(f'METER{i}', measurement_time, 1.0) for i in range(20)]
+            raise DecodingError('incomplete file received')
+
+        with self.assertRaises(DecodingError):
+            bulk_insert_file(self.make_file(), chunks())
+        with Session() as session:
+            statement = select(File).where(File.filename == self.filename)
+            self.assertIsNone(session.execute(statement).scalar())
+        self.assertEqual(readings(), [])
+
+    def test_shard_records_deleted_if_file_row_not_committed(self):
+        commit = RootTransaction.commit
+
+        def commit_shards_only(transaction):
+            if transaction.connection.engine is db.engine:
+                raise OperationalError('COMMIT', (), Exception('disk I/O error'))
+            commit(transaction)
+
+        chunks = [[(f'METER{i}', datetime(2020, 1, 2, 0, 0), 1.0) for i in range(20)]]
+        with patch.object(RootTransaction, 'commit', autospec=True, side_effect=commit_shards_only):
+            with self.assertRaises(OperationalError):
+                bulk_insert_file(self.make_file(), chunks)
+        self.assertEqual(readings(), [])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,131 @@
+import csv
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import delete, select
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+
+from smrt_importer.db import bulk_insert_file, insert_file_resumable, Session
+from smrt_importer.export import _pyarrow, export_records, stream_readings
+from smrt_importer.models import DailyConsumption, File, ImportCheckpoint, Record
+
+
+METERS = {'meter_from': 'EXPORT1', 'meter_to': 'EXPORT2'}
+
+
+class ExportTestCase(TestCase):
+    filenames = ['EXPORT_A.SMRT', 'EXPORT_B.SMRT', 'EXPORT_C.SMRT']
+
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.dir = Path(self._tmp.name)
+        self.cleanup()
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        with Session() as session:
+            file_ids = select(File.id).where(File.filename.in_(self.filenames))
+            session.execute(delete(ImportCheckpoint).where(ImportCheckpoint.file_id.in_(file_ids)))
+            session.execute(delete(Record).where(Record.meter_number.in_(['EXPORT1', 'EXPORT2'])))
+            session.execute(delete(File).where(File.filename.in_(self.filenames)))
+            session.execute(delete(DailyConsumption).where(
+                DailyConsumption.meter_number.in_(['EXPORT1', 'EXPORT2'])
+            ))
+            session.commit()
+
+    def make_file(self, filename):
+        return File(
+            filename=filename,
+            creation_time=datetime(2021, 1, 1),
+            imported_time=datetime.now(),
+            gen_num='PN000001'
+        )
+
+    def insert(self, filename, rows):
+        file = self.make_file(filename)
+        bulk_insert_file(file, [rows])
+        return file
+
+    def read_csv(self, path):
+        with open(path, newline='') as f:
+            return [
+                (row['meter_number'], row['measurement_time'], float(row['consumption']))
+                for row in csv.DictReader(f)
+            ]
+
+    def test_filtered_export(self):
+        self.insert('EXPORT_A.SMRT', [
+            ('EXPORT2', datetime(2021, 1, 1, 0), 1.0),
+            ('EXPORT1', datetime(2021, 1, 1, 1), 2.0),
+            ('EXPORT1', datetime(2021, 1, 2, 0), 3.0),
+        ])
+
+        path = self.dir / 'export.csv'
+        result = export_records(path, end=datetime(2021, 1, 1, 23), batch_size=1, **METERS)
+        self.assertEqual(result.rows, 2)
+        self.assertEqual(self.read_csv(path), [
+            ('EXPORT1', '2021-01-01 01:00:00', 2.0),
+            ('EXPORT2', '2021-01-01 00:00:00', 1.0),
+        ])
+
+        readings = list(stream_readings(meter_from='EXPORT2', meter_to='EXPORT2'))
+        self.assertEqual([reading.consumption for reading in readings], [1.0])
+
+    def test_incremental_export(self):
+        first = self.insert('EXPORT_A.SMRT', [
+            ('EXPORT1', datetime(2021, 1, 1, 0), 1.0),
+            ('EXPORT1', datetime(2021, 1, 1, 1), 2.0),
+        ])
+        result = export_records(self.dir / 'first.csv', **METERS)
+        self.assertEqual(result.rows, 2)
+        self.assertGreaterEqual(result.imported_until, first.imported_time)
+
+        self.insert('EXPORT_B.SMRT', [
+            ('EXPORT1', datetime(2021, 1, 1, 1), 5.0),  # Overwritten.
+            ('EXPORT1', datetime(2021, 1, 1, 2), 6.0),
+        ])
+        # Still being imported, so left for the next export.
+        in_progress = self.make_file('EXPORT_C.SMRT')
+        with self.assertRaises(KeyboardInterrupt):
+            insert_file_resumable(
+                in_progress,
+                self.interrupted([('EXPORT2', datetime(2021, 1, 1), 9.0)]),
+                checkpoint_rows=1
+            )
+
+        path = self.dir / 'second.csv'
+        second = export_records(path, imported_since=result.imported_until, **METERS)
+        self.assertEqual(self.read_csv(path), [
+            ('EXPORT1', '2021-01-01 01:00:00', 5.0),
+            ('EXPORT1', '2021-01-01 02:00:00', 6.0),
+        ])
+        self.assertLess(second.imported_until, in_progress.imported_time)
+
+    def test_file_committed_after_export(self):
+        # Started loading before the first export, but committed after it.
+        slow = self.make_file('EXPORT_B.SMRT')
+        self.insert('EXPORT_A.SMRT', [('EXPORT1', datetime(2021, 1, 1), 1.0)])
+        result = export_records(self.dir / 'first.csv', **METERS)
+        bulk_insert_file(slow, [[('EXPORT2', datetime(2021, 1, 1), 2.0)]])
+
+        path = self.dir / 'second.csv'
+        export_records(path, imported_since=result.imported_until, **METERS)
+        self.assertEqual(self.read_csv(path), [('EXPORT2', '2021-01-01 00:00:00', 2.0)])
+
+    def interrupted(self, rows):
+        yield rows, 100
+        raise KeyboardInterrupt
+
+    @unittest.skipIf(_pyarrow() is None, 'pyarrow not installed')
+    def test_parquet_export(self):
+        self.insert('EXPORT_A.SMRT', [('EXPORT1', datetime(2021, 1, 1), 1.0)])
+        path = self.dir / 'export.parquet'
+        export_records(path, **METERS)
+        table = _pyarrow().parquet.read_table(path)
+        self.assertEqual(table.column('consumption').to_pylist(), [1.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,19 @@
+import bz2
 from datetime import datetime
+import gzip
+import hashlib
 from io import StringIO
+import lzma
+import pickle
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import unittest
 from unittest import TestCase
 from unittest.mock import Mock
 
-from smrt_importer.loader import SMRTLoader, DecodingError
+from smrt_importer.loader import (
+    COMPRESSION_SUFFIXES, CONSUMPTION_SCHEMA, logical_name, SMRTLoader, DecodingError
+)
 from smrt_importer.models import File, Record
 
 
@@ -15,6 +22,30 @@ VALID_CONSUMPTION = ['CONSU', '0000000001', '20201122', '0801', '1.23']
 VALID_TRAIL = ['TRAIL']
 
 
+class RecordSchemaTestCase(TestCase):
+    def test_valid_values(self):
+        self.assertEqual(CONSUMPTION_SCHEMA.validate(VALID_CONSUMPTION), VALID_CONSUMPTION)
+
+    def test_invalid_value_message(self):
+        values = VALID_CONSUMPTION.copy()
+        values[2] = '2020112'
+        with self.assertRaisesRegex(DecodingError, '^invalid date_str value: 2020112$'):
+            CONSUMPTION_SCHEMA.validate(values)
+
+    def test_invalid_number_of_fields_message(self):
+        with self.assertRaisesRegex(DecodingError, '^invalid number of fields$'):
+            CONSUMPTION_SCHEMA.validate(VALID_CONSUMPTION[:-1])
+
+    def test_value_containing_separator(self):
+        values = VALID_CONSUMPTION.copy()
+        values[1] = '0000\x00000001'
+        self.assertEqual(CONSUMPTION_SCHEMA.validate(values), values)
+
+        values[2] = '2020\x001122'
+        with self.assertRaises(DecodingError):
+            CONSUMPTION_SCHEMA.validate(values)
+
+
 class ProcessHeaderTestCase(TestCase):
     def test_not_enough_fields(self):
         loader = SMRTLoader()
@@ -56,6 +87,13 @@ class ProcessHeaderTestCase(TestCase):
         with self.assertRaises(DecodingError):
             loader.load_header(header)
 
+    def test_parse_invalid_timestamp_message(self):
+        loader = SMRTLoader()
+        header = VALID_HEADER.copy()
+        header[3] = '20210230'
+        with self.assertRaisesRegex(DecodingError, '^failed to parse timestamp: day is out of range for month$'):
+            loader.load_header(header)
+
     def test_parse_valid_gen_num(self):
         loader = SMRTLoader()
         loader.load_header(VALID_HEADER)
@@ -244,6 +282,56 @@ class ProcessCSVTestCase(TestCase):
         with self.assertRaises(DecodingError):
             loader.load_csv(f)
 
+    def test_error_line_number(self):
+        lines = [
+            '"HEADR","SMRT","GAZ","20191011","134942","PN007505"\n',
+            '"CONSU","0000000001","20190928","0000",0.00\n',
+            '"CONSU","0000000001","20190928","2500",1.52\n',
+            '"TRAIL"\n',
+        ]
+        with self.assertRaises(DecodingError) as cm:
+            SMRTLoader().load_csv(lines)
+        self.assertEqual(cm.exception.line, 3)
+        self.assertEqual(cm.exception.reason, 'failed to parse timestamp')
+
+        with self.assertRaises(DecodingError) as cm:
+            list(SMRTLoader().stream_csv(lines, 1))
+        self.assertEqual(cm.exception.line, 3)
+
+        # Kept when sent between processes.
+        self.assertEqual(pickle.loads(pickle.dumps(cm.exception)).line, 3)
+
+
+class StreamCSVTestCase(TestCase):
+    def test_valid_csv_chunks(self):
+        f = StringIO()
+        f.write('"HEADR","SMRT","GAZ","20191011","134942","PN007505"\n')
+        f.write('"CONSU","0000000001","20190928","0000",0.00\n')
+        f.write('"CONSU","0000000001","20190928","0100",1.52\n')
+        f.write('"CONSU","0000000001","20190928","0200",2.11\n')
+        f.write('"TRAIL"\n')
+        f.seek(0)
+
+        loader = SMRTLoader()
+        chunks = list(loader.stream_csv(f, 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(chunks[0][1], ('0000000001', datetime(2019, 9, 28, 1, 0), 1.52))
+        self.assertEqual(loader.data.records, [])
+        self.assertEqual(loader.data.gen_num, 'PN007505')
+
+    def test_no_trail(self):
+        f = StringIO()
+        f.write('"HEADR","SMRT","GAZ","20191011","134942","PN007505"\n')
+        f.write('"CONSU","0000000001","20190928","0000",0.00\n')
+        f.write('"CONSU","0000000001","20190928","0100",1.52\n')
+        f.seek(0)
+
+        loader = SMRTLoader()
+        chunks = loader.stream_csv(f, 1)
+        self.assertEqual(len(next(chunks)), 1)
+        with self.assertRaises(DecodingError):
+            list(chunks)
+
 
 class ProcessFileTestCase(TestCase):
     def test_process_file(self):
@@ -261,5 +349,118 @@ class ProcessFileTestCase(TestCase):
             self.assertEqual(loader.data.filename, 'test.csv')
 
 
+SMRT_TEXT = (
+    '"HEADR","SMRT","GAZ","20191011","134942","PN007505"\n'
+    '"CONSU","0000000001","20190928","0000",0.00\n'
+    '"CONSU","0000000001","20190928","0100",1.52\n'
+    '"TRAIL"\n'
+)
+
+
+class CompressedFileTestCase(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = Path(tmp_dir.name)
+
+    def test_compressed_by_suffix(self):
+        for module, suffix in [(gzip, '.gz'), (bz2, '.bz2'), (lzma, '.xz')]:
+            with self.subTest(suffix=suffix):
+                p = self.dir / f'test.SMRT{suffix}'
+                p.write_bytes(module.compress(SMRT_TEXT.encode()))
+
+                loader = SMRTLoader()
+                loader.load_file(p)
+                self.assertEqual(len(loader.data.records), 2)
+                self.assertEqual(loader.data.filename, 'test.SMRT')
+
+    def test_compressed_by_magic_bytes(self):
+        p = self.dir / 'test.SMRT'
+        p.write_bytes(gzip.compress(SMRT_TEXT.encode()))
+
+        loader = SMRTLoader()
+        chunks = list(loader.stream_file(p, 10))
+        self.assertEqual(len(chunks[0]), 2)
+        self.assertEqual(loader.data.filename, 'test.SMRT')
+
+    def test_truncated_compressed_file(self):
+        p = self.dir / 'test.SMRT.gz'
+        p.write_bytes(gzip.compress(SMRT_TEXT.encode())[:-10])
+
+        with self.assertRaises(DecodingError):
+            SMRTLoader().load_file(p)
+
+    def test_corrupt_compressed_file(self):
+        # Corrupts the gzip trailer CRC, the bzip2 block CRC, and xz data.
+        corrupt_offsets = {'.gz': -8, '.bz2': 10, '.xz': 32}
+        for suffix, module in COMPRESSION_SUFFIXES.items():
+            with self.subTest(suffix=suffix):
+                p = self.dir / f'test.SMRT{suffix}'
+                data = bytearray(module.compress(SMRT_TEXT.encode()))
+                data[corrupt_offsets[suffix]] ^= 0xff
+                p.write_bytes(data)
+
+                with self.assertRaisesRegex(DecodingError, 'decompressing'):
+                    SMRTLoader().load_file(p)
+
+    def test_memory_mapped(self):
+        p = self.dir / 'test.SMRT'
+        p.write_text(SMRT_TEXT)
+
+        loader = SMRTLoader(mmap_min_size=1)
+        loader.load_file(p)
+        self.assertEqual(
+            [record.consumption for record in loader.data.records], [0.0, 1.52]
+        )
+
+    def test_resume_from_offset(self):
+        p = self.dir / 'test.SMRT.gz'
+        p.write_bytes(gzip.compress(SMRT_TEXT.encode()))
+
+        loader = SMRTLoader()
+        chunks = list(loader.stream_file_resumable(p, 1))
+        self.assertEqual([len(chunk) for chunk, _ in chunks], [1, 1])
+        _, offset = chunks[0]
+        # Just after the header and first consumption record.
+        self.assertEqual(offset, len(''.join(SMRT_TEXT.splitlines(True)[:2])))
+
+        loader = SMRTLoader()
+        resumed = list(loader.stream_file_resumable(p, 1, offset, record_count=1))
+        self.assertEqual([chunk[0][2] for chunk, _ in resumed], [1.52])
+        self.assertEqual(loader.record_count, 2)
+        self.assertEqual(loader.data.gen_num, 'PN007505')
+
+    def test_content_hash(self):
+        # The raw bytes are hashed, however the file is read.
+        data = SMRT_TEXT.replace('\n', '\r\n').encode()
+        expected = hashlib.sha256(data).hexdigest()
+        plain = self.dir / 'test.SMRT'
+        plain.write_bytes(data)
+        compressed = self.dir / 'test.SMRT.gz'
+        compressed.write_bytes(gzip.compress(data))
+
+        for name, mmap_min_size, load in [
+            ('load_file', None, lambda loader: loader.load_file(plain)),
+            ('compressed', None, lambda loader: loader.load_file(compressed)),
+            ('memory_mapped', 1, lambda loader: loader.load_file(plain)),
+            ('stream_file', None, lambda loader: list(loader.stream_file(plain, 1))),
+            ('stream_file_resumable', None, lambda loader: list(loader.stream_file_resumable(compressed, 1))),
+        ]:
+            with self.subTest(name):
+                loader = SMRTLoader(mmap_min_size)
+                load(loader)
+                self.assertEqual(loader.data.content_hash, expected)
+
+        # The skipped part of a resumed file is not read, so can't be hashed.
+        _, offset = next(SMRTLoader().stream_file_resumable(plain, 1))
+        loader = SMRTLoader()
+        list(loader.stream_file_resumable(plain, 1, offset, record_count=1))
+        self.assertIsNone(loader.data.content_hash)
+
+    def test_logical_name(self):
+        self.assertEqual(logical_name('dir/test.SMRT.xz'), 'test.SMRT')
+        self.assertEqual(logical_name('dir/test.SMRT'), 'test.SMRT')
+
+
 if __name__ == '__main__':
     unittest.main()
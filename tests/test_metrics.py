@@ -0,0 +1,87 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+from urllib.request import urlopen
+
+from smrt_importer.metrics import (
+    add_stage_time, Counter, file_timings, Gauge, Histogram, Registry, serve, timed_iter,
+    write_textfile
+)
+
+
+class RenderTestCase(TestCase):
+    def test_counter(self):
+        counter = Counter('test_files', 'Files.', labels=('result',))
+        counter.inc(result='ok')
+        counter.inc(2, result='ok')
+        counter.inc(result='bad "one"')
+        self.assertEqual(counter.render(), (
+            '# HELP test_files Files.\n'
+            '# TYPE test_files counter\n'
+            r'test_files_total{result="bad \"one\""} 1' '\n'
+            'test_files_total{result="ok"} 3\n'
+        ))
+
+    def test_counter_requires_labels(self):
+        counter = Counter('test_files', 'Files.', labels=('result',))
+        with self.assertRaises(ValueError):
+            counter.inc()
+
+    def test_gauge_function(self):
+        gauge = Gauge('test_backlog', 'Backlog.')
+        gauge.set_function(lambda: 5)
+        self.assertIn('test_backlog 5\n', gauge.render())
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Seconds.', (1, 10))
+        histogram.observe(0.5)
+        histogram.observe(5)
+        histogram.observe(50)
+        self.assertEqual(histogram.render(), (
+            '# HELP test_seconds Seconds.\n'
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{le="1"} 1\n'
+            'test_seconds_bucket{le="10"} 2\n'
+            'test_seconds_bucket{le="+Inf"} 3\n'
+            'test_seconds_sum 55.5\n'
+            'test_seconds_count 3\n'
+        ))
+
+
+class StageTimingTestCase(TestCase):
+    def test_file_timings_totals_stages(self):
+        with file_timings() as timings:
+            add_stage_time('insert', 1.0)
+            add_stage_time('insert', 2.0)
+            self.assertEqual(list(timed_iter([1, 2], 'parse')), [1, 2])
+        self.assertEqual(timings['insert'], 3.0)
+        self.assertIn('parse', timings)
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.register(Counter('test_files', 'Files.')).inc()
+
+    def test_write_textfile(self):
+        with TemporaryDirectory() as d:
+            path = Path(d) / 'metrics.prom'
+            write_textfile(path, self.registry)
+            self.assertIn('test_files_total 1\n', path.read_text())
+            self.assertEqual(list(Path(d).iterdir()), [path])
+
+    def test_serve(self):
+        server = serve(0)
+        try:
+            port = server.server_address[1]
+            with urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                self.assertEqual(response.status, 200)
+                self.assertIn(b'# TYPE smrt_importer_stage_seconds histogram', response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,435 @@
+import asyncio
+import gc
+import gzip
+import logging
+from pathlib import Path
+import subprocess
+import sys
+from sqlalchemy import delete, select
+from sqlalchemy.exc import OperationalError
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from smrt_importer import db, metrics
+from smrt_importer.claim import Claimer
+from smrt_importer.config import config
+from smrt_importer.db import get_checkpoint, imported_filenames, Session
+from smrt_importer.models import File, Record
+from smrt_importer.profiling import Profiler
+from smrt_importer.processor import (
+    CommitGroup, create_claimer, ParserPool, process_dir, process_file, process_files, run_async
+)
+
+
+# Holds the DB's write lock, as another instance would whilst importing a
+# file, until its standard input is closed.
+LOCK_DB = '''
+import sqlite3, sys
+connection = sqlite3.connect(sys.argv[1], isolation_level=None)
+connection.execute('BEGIN IMMEDIATE')
+print('locked', flush=True)
+sys.stdin.read()
+'''
+
+
+def write_smrt(path, creation_time, rows, trail=True):
+    """Write a SMRT file. rows is a list of (meter_number, date, time, consumption)."""
+
+    with open(path, 'w') as f:
+        f.write(f'"HEADR","SMRT","GAZ","{creation_time[:8]}","{creation_time[8:]}","PN000001"\n')
+        for row in rows:
+            f.write('"CONSU","{}","{}","{}",{}\n'.format(*row))
+        if trail:
+            f.write('"TRAIL"\n')
+
+
+class ProcessorTestCase(TestCase):
+    """Base test case running the processor against temporary directories."""
+
+    filenames = []
+
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.dir = Path(self._tmp.name)
+        self.incoming = self.dir / 'incoming'
+        self.incoming.mkdir()
+        for name, value in [('processed_dir', self.dir / 'processed'), ('failed_dir', self.dir / 'failed')]:
+            patcher = patch.object(config, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        with Session() as session:
+            file_ids = select(File.id).where(File.filename.in_(self.filenames))
+            session.execute(delete(Record).where(Record.file_id.in_(file_ids)))
+            session.execute(delete(File).where(File.filename.in_(self.filenames)))
+            session.commit()
+        imported_filenames.load()
+        self._tmp.cleanup()
+
+
+class ProcessFileTestCase(ProcessorTestCase):
+    filenames = ['DUPLICATE.SMRT', 'COMPRESSED.SMRT', 'RESUMABLE.SMRT', 'ORIGINAL.SMRT', 'RESENT.SMRT']
+
+    def test_duplicate_skipped_before_parsing(self):
+        path = self.incoming / 'DUPLICATE.SMRT'
+        write_smrt(path, '20210101000000', [('DUPLICATE1', '20210101', '0000', 1.0)])
+        process_file(path)
+        self.assertTrue((config.processed_dir / 'DUPLICATE.SMRT').exists())
+
+        write_smrt(path, '20210101000000', [('DUPLICATE1', '20210101', '0000', 2.0)])
+        with patch('smrt_importer.processor._import_file') as import_file:
+            process_file(path)
+        import_file.assert_not_called()
+        self.assertTrue((config.failed_dir / 'DUPLICATE.SMRT').exists())
+
+    def test_compressed_duplicate_detected_by_logical_name(self):
+        path = self.incoming / 'COMPRESSED.SMRT'
+        write_smrt(path, '20210101000000', [('COMPRESSED1', '20210101', '0000', 1.0)])
+        compressed_path = self.incoming / 'COMPRESSED.SMRT.gz'
+        compressed_path.write_bytes(gzip.compress(path.read_bytes()))
+
+        process_file(compressed_path)
+        self.assertTrue((config.processed_dir / 'COMPRESSED.SMRT.gz').exists())
+
+        process_file(path)
+        self.assertTrue((config.failed_dir / 'COMPRESSED.SMRT').exists())
+
+    def test_resent_file_skipped_by_content(self):
+        rows = [('RESENT1', '20210101', '0000', 1.0)]
+        for stream in [False, True]:
+            with self.subTest(stream=stream), patch.object(config, 'stream', stream):
+                original = self.incoming / 'ORIGINAL.SMRT'
+                write_smrt(original, '20210101000000', rows)
+                process_file(original)
+                resent = self.incoming / 'RESENT.SMRT'
+                write_smrt(resent, '20210101000000', rows)
+                with self.assertLogs('smrt_importer.processor', 'WARNING') as logs:
+                    process_file(resent)
+
+                self.assertIn('reason=duplicate_content original=ORIGINAL.SMRT', logs.output[0])
+                self.assertTrue((config.failed_dir / 'RESENT.SMRT').exists())
+                with Session() as session:
+                    statement = select(File.filename).where(File.filename.in_(self.filenames[3:]))
+                    self.assertEqual(session.execute(statement).scalars().all(), ['ORIGINAL.SMRT'])
+                    session.execute(delete(Record).where(Record.meter_number == 'RESENT1'))
+                    session.execute(delete(File).where(File.filename == 'ORIGINAL.SMRT'))
+                    session.commit()
+                imported_filenames.load()
+
+    def test_profiled(self):
+        path = self.incoming / 'DUPLICATE.SMRT'
+        write_smrt(path, '20210101000000', [('DUPLICATE1', '20210101', '0000', 1.0)])
+        with patch('smrt_importer.profiling.profiler', Profiler()):
+            process_file(path)
+
+        self.assertEqual(
+            sorted(p.name for p in config.processed_dir.iterdir()),
+            ['DUPLICATE.SMRT', 'DUPLICATE.SMRT.alloc.txt', 'DUPLICATE.SMRT.prof']
+        )
+
+    def test_resumable_import(self):
+        path = self.incoming / 'RESUMABLE.SMRT'
+        write_smrt(path, '20210101000000', [
+            ('RESUMABLE1', '20210101', '0000', 1.0),
+            ('RESUMABLE1', '20210101', '0100', 2.0),
+            ('RESUMABLE1', '20210101', '0200', 3.0)
+        ])
+        settings = {'resumable': True, 'batch_size': 1, 'checkpoint_rows': 1}
+        with patch.multiple(config, **settings):
+            process_file(path)
+
+        self.assertTrue((config.processed_dir / 'RESUMABLE.SMRT').exists())
+        self.assertIsNone(get_checkpoint('RESUMABLE.SMRT'))
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == 'RESUMABLE1')
+            self.assertEqual(sorted(session.execute(statement).scalars()), [1.0, 2.0, 3.0])
+
+    def test_resumable_import_single_chunk(self):
+        path = self.incoming / 'RESUMABLE.SMRT'
+        write_smrt(path, '20210101000000', [
+            ('RESUMABLE1', '20210101', '0000', 1.0),
+            ('RESUMABLE1', '20210101', '0100', 2.0)
+        ])
+        with patch.multiple(config, resumable=True, batch_size=10000):
+            process_file(path)
+
+        self.assertTrue((config.processed_dir / 'RESUMABLE.SMRT').exists())
+        with Session() as session:
+            statement = select(File.content_hash).where(File.filename == 'RESUMABLE.SMRT')
+            self.assertIsNotNone(session.execute(statement).scalar())
+
+    def interrupt_import(self, path):
+        """Start importing a file resumably, interrupting it after two chunks."""
+
+        timed_iter = metrics.timed_iter
+
+        def interrupted(chunks, stage):
+            for i, chunk in enumerate(timed_iter(chunks, stage)):
+                if i == 2:
+                    raise KeyboardInterrupt
+                yield chunk
+
+        write_smrt(path, '20210101000000', [
+            ('RESUMABLE1', '20210101', f'0{i}00', float(i)) for i in range(4)
+        ])
+        with patch.object(metrics, 'timed_iter', interrupted), \
+                self.assertRaises(KeyboardInterrupt):
+            process_file(path)
+        self.assertTrue(path.exists())
+        self.assertEqual(get_checkpoint('RESUMABLE.SMRT').record_count, 2)
+
+    def assert_resumable_imported(self):
+        self.assertTrue((config.processed_dir / 'RESUMABLE.SMRT').exists())
+        self.assertIsNone(get_checkpoint('RESUMABLE.SMRT'))
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == 'RESUMABLE1')
+            self.assertEqual(sorted(session.execute(statement).scalars()), [0.0, 1.0, 2.0, 3.0])
+
+    def test_interrupted_import_resumed(self):
+        path = self.incoming / 'RESUMABLE.SMRT'
+        settings = {'resumable': True, 'batch_size': 1, 'checkpoint_rows': 1}
+        with patch.multiple(config, **settings):
+            self.interrupt_import(path)
+            with self.assertLogs('smrt_importer.processor') as logs:
+                process_file(path)
+
+        self.assertIn('resuming path=', logs.output[1])
+        self.assert_resumable_imported()
+
+    def test_interrupted_import_discarded_if_not_resumable(self):
+        path = self.incoming / 'RESUMABLE.SMRT'
+        settings = {'resumable': True, 'batch_size': 1, 'checkpoint_rows': 1}
+        with patch.multiple(config, **settings):
+            self.interrupt_import(path)
+        with self.assertLogs('smrt_importer.processor') as logs:
+            process_file(path)
+
+        self.assertIn('discarding partial import', logs.output[1])
+        self.assert_resumable_imported()
+
+
+class ProcessFilesParallelTestCase(ProcessorTestCase):
+    filenames = ['PARALLEL_A.SMRT', 'PARALLEL_B.SMRT', 'PARALLEL_C.SMRT']
+
+    def test_newer_file_overwrites_older(self):
+        # A is newest but sorts first by name, so must be saved last.
+        write_smrt(self.incoming / 'PARALLEL_A.SMRT', '20210102000000', [('PARALLEL1', '20210101', '0000', 3.0)])
+        write_smrt(self.incoming / 'PARALLEL_B.SMRT', '20210101000000', [('PARALLEL1', '20210101', '0000', 1.0)])
+        write_smrt(self.incoming / 'PARALLEL_C.SMRT', '20210101000000', [], trail=False)
+
+        pool = ParserPool(2)
+        try:
+            process_files(sorted(self.incoming.iterdir()), pool)
+        finally:
+            pool.shutdown()
+
+        self.assertEqual(sorted(p.name for p in config.processed_dir.iterdir()), self.filenames[:2])
+        self.assertEqual([p.name for p in config.failed_dir.iterdir()], ['PARALLEL_C.SMRT'])
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == 'PARALLEL1')
+            self.assertEqual(session.execute(statement).scalars().all(), [3.0])
+
+    def test_large_file_not_parsed_by_worker(self):
+        rows = [('PARALLEL2', '20210101', f'{i:04d}', 1.0) for i in range(10)]
+        write_smrt(self.incoming / 'PARALLEL_A.SMRT', '20210101000000', rows)
+        write_smrt(self.incoming / 'PARALLEL_B.SMRT', '20210101000000', rows[:1])
+
+        pool = ParserPool(2)
+        try:
+            with patch.object(config, 'worker_max_size', 200), \
+                    patch.object(pool, 'submit', wraps=pool.submit) as submit:
+                process_files(sorted(self.incoming.iterdir()), pool)
+        finally:
+            pool.shutdown()
+
+        submit.assert_called_once_with(self.incoming / 'PARALLEL_B.SMRT')
+        self.assertEqual(sorted(p.name for p in config.processed_dir.iterdir()), self.filenames[:2])
+
+
+class CommitGroupTestCase(ProcessorTestCase):
+    filenames = ['GROUP_A.SMRT', 'GROUP_B.SMRT', 'GROUP_C.SMRT']
+
+    def test_files_moved_after_commit(self):
+        write_smrt(self.incoming / 'GROUP_A.SMRT', '20210101000000', [('GROUPED1', '20210101', '0000', 1.0)])
+        write_smrt(self.incoming / 'GROUP_B.SMRT', '20210101000000', [], trail=False)
+        write_smrt(self.incoming / 'GROUP_C.SMRT', '20210101000000', [('GROUPED2', '20210101', '0000', 2.0)])
+
+        group = CommitGroup(max_files=10, max_seconds=60)
+        for path in sorted(self.incoming.iterdir()):
+            group.process_file(path)
+        self.assertEqual(len(list(self.incoming.iterdir())), 3)
+        self.assertIn(self.incoming / 'GROUP_A.SMRT', group)
+
+        group.commit()
+        self.assertEqual(list(self.incoming.iterdir()), [])
+        self.assertEqual(
+            sorted(p.name for p in config.processed_dir.iterdir()),
+            ['GROUP_A.SMRT', 'GROUP_C.SMRT']
+        )
+        self.assertEqual([p.name for p in config.failed_dir.iterdir()], ['GROUP_B.SMRT'])
+
+    def test_full_group_committed(self):
+        # Contents must differ, so they are not skipped as duplicates.
+        for i, name in enumerate(self.filenames):
+            write_smrt(self.incoming / name, f'2021010100000{i}', [])
+
+        group = CommitGroup(max_files=2, max_seconds=60)
+        process_files(sorted(self.incoming.iterdir()), group=group)
+        self.assertEqual([p.name for p in self.incoming.iterdir()], ['GROUP_C.SMRT'])
+
+        # Commits the remaining file.
+        process_dir(self.incoming, group=group)
+        self.assertEqual(list(self.incoming.iterdir()), [])
+        self.assertEqual(len(list(config.processed_dir.iterdir())), 3)
+
+    def test_failed_commit_retried_per_file(self):
+        write_smrt(self.incoming / 'GROUP_A.SMRT', '20210101000000', [('GROUPED1', '20210101', '0000', 1.0)])
+        write_smrt(self.incoming / 'GROUP_B.SMRT', '20210101000000', [], trail=False)
+
+        group = CommitGroup(max_files=10, max_seconds=60)
+        error = OperationalError('COMMIT', (), Exception('disk I/O error'))
+        with patch('smrt_importer.db.FileGroup.commit', side_effect=error):
+            process_dir(self.incoming, group=group)
+
+        self.assertEqual(list(self.incoming.iterdir()), [])
+        self.assertEqual([p.name for p in config.processed_dir.iterdir()], ['GROUP_A.SMRT'])
+        self.assertEqual([p.name for p in config.failed_dir.iterdir()], ['GROUP_B.SMRT'])
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == 'GROUPED1')
+            self.assertEqual(session.execute(statement).scalars().all(), [1.0])
+
+
+class ClaimTestCase(ProcessorTestCase):
+    filenames = ['CLAIM_A.SMRT', 'CLAIM_B.SMRT']
+
+    def test_only_unclaimed_files_imported(self):
+        for i, name in enumerate(self.filenames):
+            write_smrt(self.incoming / name, f'2021010100000{i}', [])
+        other = Claimer(self.incoming, 'other')
+        other.start()
+        self.addCleanup(other.stop)
+        other.claim(self.incoming / 'CLAIM_B.SMRT')
+
+        with patch.multiple(config, claim_files=True, worker_id='this'):
+            claimer = create_claimer(self.incoming)
+            process_dir(self.incoming, claimer=claimer)
+            claimer.stop()
+
+        self.assertEqual([p.name for p in config.processed_dir.iterdir()], ['CLAIM_A.SMRT'])
+        self.assertEqual([p.name for p in other.directory.iterdir()], ['CLAIM_B.SMRT'])
+        self.assertFalse(claimer.directory.exists())
+
+    def test_file_released_if_database_locked(self):
+        write_smrt(self.incoming / 'CLAIM_A.SMRT', '20210101000000', [('CLAIM1', '20210101', '0000', 1.0)])
+        db.get_engine()
+
+        other = subprocess.Popen(
+            [sys.executable, '-c', LOCK_DB, str(config.db_path)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True
+        )
+        self.addCleanup(other.wait)
+        self.addCleanup(other.stdin.close)
+        self.assertEqual(other.stdout.readline(), 'locked\n')
+
+        # A newly started instance can check for imported files whilst
+        # another holds the lock.
+        code = 'from smrt_importer.db import imported_filenames\n"CLAIM_A.SMRT" in imported_filenames\n'
+        subprocess.run([sys.executable, '-c', code], check=True, timeout=60)
+
+        self.addCleanup(db.engine.dispose)
+        with patch.dict(config.db_pragmas, busy_timeout='100'), \
+                patch.multiple(config, claim_files=True, worker_id='this'):
+            db.engine.dispose()
+            claimer = create_claimer(self.incoming)
+            deferred = process_dir(self.incoming, claimer=claimer)
+            self.assertEqual(deferred, [self.incoming / 'CLAIM_A.SMRT'])
+            self.assertEqual(list(claimer.directory.iterdir()), [])
+            claimer.stop()
+            db.engine.dispose()
+
+        self.assertEqual([p.name for p in self.incoming.glob('*.SMRT')], ['CLAIM_A.SMRT'])
+        self.assertEqual(list(config.failed_dir.iterdir()), [])
+
+        other.stdin.close()
+        other.wait()
+        self.assertTrue(process_file(self.incoming / 'CLAIM_A.SMRT'))
+        self.assertEqual([p.name for p in config.processed_dir.iterdir()], ['CLAIM_A.SMRT'])
+
+
+class ScheduleTestCase(ProcessorTestCase):
+    filenames = ['SCHEDULE_BACKFILL.SMRT', 'SCHEDULE_NEW.SMRT']
+
+    def test_smallest_first_keeps_newer_readings(self):
+        rows = [('SCHEDULE1', '20210101', f'{i // 60:02d}{i % 60:02d}', 1.0) for i in range(100)]
+        write_smrt(self.incoming / 'SCHEDULE_BACKFILL.SMRT', '20210101000000', rows)
+        write_smrt(self.incoming / 'SCHEDULE_NEW.SMRT', '20210102000000', [('SCHEDULE1', '20210101', '0000', 2.0)])
+
+        with patch.object(config, 'queue_policy', 'smallest'), \
+                self.assertLogs('smrt_importer.processor') as logs:
+            process_dir(self.incoming)
+
+        imported = [line for line in logs.output if 'imported path=' in line]
+        self.assertEqual(len(imported), 2)
+        self.assertIn('SCHEDULE_NEW.SMRT', imported[0])
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == 'SCHEDULE1') \
+                .order_by(Record.measurement_time).limit(2)
+            self.assertEqual(session.execute(statement).scalars().all(), [2.0, 1.0])
+
+
+class RunAsyncTestCase(ProcessorTestCase):
+    filenames = ['ASYNC_A.SMRT', 'ASYNC_B.SMRT', 'ASYNC_C.SMRT']
+
+    def test_files_routed_and_newer_file_overwrites_older(self):
+        write_smrt(self.incoming / 'ASYNC_A.SMRT', '20210102000000', [('ASYNC1', '20210101', '0000', 3.0)])
+        write_smrt(self.incoming / 'ASYNC_B.SMRT', '20210101000000', [('ASYNC1', '20210101', '0000', 1.0)])
+        write_smrt(self.incoming / 'ASYNC_C.SMRT', '20210101000000', [], trail=False)
+
+        asyncio.run(run_async(self.incoming, queue_size=1))
+
+        self.assertEqual(list(self.incoming.iterdir()), [])
+        self.assertEqual(sorted(p.name for p in config.processed_dir.iterdir()), self.filenames[:2])
+        self.assertEqual([p.name for p in config.failed_dir.iterdir()], ['ASYNC_C.SMRT'])
+        with Session() as session:
+            statement = select(Record.consumption).where(Record.meter_number == 'ASYNC1')
+            self.assertEqual(session.execute(statement).scalars().all(), [3.0])
+
+    def test_parse_failure_retrieved(self):
+        write_smrt(self.incoming / 'ASYNC_C.SMRT', '20210101000000', [], trail=False)
+        unhandled = []
+        # Logged records hold the exception, which would keep the future
+        # alive.
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        async def run():
+            asyncio.get_running_loop().set_exception_handler(
+                lambda loop, context: unhandled.append(context['message'])
+            )
+            await run_async(self.incoming)
+            # Unretrieved exceptions are reported when futures are freed.
+            gc.collect()
+
+        asyncio.run(run())
+        self.assertEqual([p.name for p in config.failed_dir.iterdir()], ['ASYNC_C.SMRT'])
+        self.assertEqual(unhandled, [])
+
+    def test_duplicate_not_parsed(self):
+        path = self.incoming / 'ASYNC_A.SMRT'
+        write_smrt(path, '20210101000000', [('ASYNC1', '20210101', '0000', 1.0)])
+        asyncio.run(run_async(self.incoming))
+
+        write_smrt(path, '20210101000000', [('ASYNC1', '20210101', '0000', 2.0)])
+        with patch('smrt_importer.processor.parse_file') as parse_file:
+            asyncio.run(run_async(self.incoming))
+        parse_file.assert_not_called()
+        self.assertEqual([p.name for p in config.failed_dir.iterdir()], ['ASYNC_A.SMRT'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+from pathlib import Path
+import pstats
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+
+from smrt_importer.loader import SMRTLoader
+from smrt_importer.profiling import Profiler
+
+
+class ProfilerTestCase(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = Path(tmp_dir.name)
+
+    def test_profile_saved_and_summarised(self):
+        profiler = Profiler(sample=1.0, top=5)
+        with profiler.profile() as result:
+            SMRTLoader().load_csv([
+                '"HEADR","SMRT","GAZ","20210101","000000","PN000001"\n',
+                '"CONSU","PROFILE1","20210101","0000",1.0\n',
+                '"TRAIL"\n'
+            ])
+
+        path = self.dir / 'PROFILE.SMRT'
+        result.save(path)
+        stats = pstats.Stats(f'{path}.prof')
+        self.assertTrue(any(name == 'load_csv' for _, _, name in stats.stats))
+        report = Path(f'{path}.alloc.txt').read_text()
+        self.assertTrue(report.startswith('peak='))
+
+        summary = profiler.summary()
+        self.assertIn('loader.py', summary)
+        self.assertIn('load_csv', summary)
+
+    def test_not_sampled(self):
+        profiler = Profiler(sample=0.0)
+        with profiler.profile() as result:
+            pass
+        self.assertIsNone(result)
+        self.assertIsNone(profiler.summary())
+
+    def test_nested_block_not_profiled(self):
+        profiler = Profiler()
+        with profiler.profile() as outer, profiler.profile() as inner:
+            pass
+        self.assertIsNotNone(outer)
+        self.assertIsNone(inner)
+
+
+if __name__ == '__main__':
+    unittest.main()
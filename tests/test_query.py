@@ -0,0 +1,84 @@
+from datetime import date, datetime
+from sqlalchemy import delete
+import unittest
+from unittest import TestCase
+
+from smrt_importer.db import bulk_insert_file, insert_file, rebuild_rollups, Session
+from smrt_importer.models import DailyConsumption, File, Record
+from smrt_importer.query import ConsumptionTotal, daily_totals, monthly_totals
+
+
+METER = 'ROLLUP_METER'
+
+
+class RollupTestCase(TestCase):
+    filenames = ['ROLLUP_A.SMRT', 'ROLLUP_B.SMRT']
+
+    def setUp(self):
+        self.cleanup()
+
+    def tearDown(self):
+        self.cleanup()
+
+    def cleanup(self):
+        with Session() as session:
+            session.execute(delete(Record).where(Record.meter_number == METER))
+            session.execute(delete(File).where(File.filename.in_(self.filenames)))
+            session.execute(delete(DailyConsumption).where(DailyConsumption.meter_number == METER))
+            session.commit()
+
+    def make_file(self, filename, rows):
+        return File(
+            filename=filename,
+            creation_time=datetime(2021, 1, 1),
+            imported_time=datetime.now(),
+            gen_num='PN000001',
+            records=[
+                Record(meter_number=METER, measurement_time=time, consumption=consumption)
+                for time, consumption in rows
+            ]
+        )
+
+    def insert_files(self, insert):
+        insert(self.make_file('ROLLUP_A.SMRT', [
+            (datetime(2021, 1, 1, 8), 1.0),
+            (datetime(2021, 1, 1, 9), 5.0),
+            (datetime(2021, 1, 2, 0), 2.0),
+        ]))
+        insert(self.make_file('ROLLUP_B.SMRT', [
+            (datetime(2021, 1, 1, 9), 3.0),  # Replaces the maximum.
+            (datetime(2021, 1, 1, 10), 0.5),
+            (datetime(2021, 1, 2, 0), 2.0),  # Unchanged.
+        ]))
+
+    def assert_totals(self):
+        self.assertEqual(daily_totals(METER), [
+            ConsumptionTotal(METER, date(2021, 1, 1), 4.5, 3, 0.5, 3.0),
+            ConsumptionTotal(METER, date(2021, 1, 2), 2.0, 1, 2.0, 2.0),
+        ])
+        self.assertEqual(daily_totals(METER, start=date(2021, 1, 2)), [
+            ConsumptionTotal(METER, date(2021, 1, 2), 2.0, 1, 2.0, 2.0),
+        ])
+        self.assertEqual(monthly_totals(METER), [
+            ConsumptionTotal(METER, date(2021, 1, 1), 6.5, 4, 0.5, 3.0),
+        ])
+
+    def test_bulk_insert_file(self):
+        self.insert_files(bulk_insert_file)
+        self.assert_totals()
+
+    def test_insert_file(self):
+        self.insert_files(insert_file)
+        self.assert_totals()
+
+    def test_rebuild_rollups(self):
+        self.insert_files(bulk_insert_file)
+        with Session() as session:
+            session.execute(delete(DailyConsumption).where(DailyConsumption.meter_number == METER))
+            session.commit()
+        rebuild_rollups()
+        self.assert_totals()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from smrt_importer import metrics
+from smrt_importer.schedule import IncomingQueue
+
+
+class IncomingQueueTestCase(TestCase):
+    def setUp(self):
+        self._tmp = TemporaryDirectory()
+        self.addCleanup(self._tmp.cleanup)
+        self.incoming = Path(self._tmp.name)
+
+    def write(self, name, creation_time, rows=0):
+        path = self.incoming / name
+        with open(path, 'w') as f:
+            f.write(f'"HEADR","SMRT","GAZ","{creation_time[:8]}","{creation_time[8:]}","PN000001"\n')
+            for i in range(rows):
+                f.write(f'"CONSU","0000000001","20210101","{i:04d}",1.0\n')
+            f.write('"TRAIL"\n')
+        return path
+
+    def write_files(self):
+        # A large backfill, then small near real time files.
+        self.write('BACKFILL.SMRT', '20210101000000', rows=100)
+        self.write('SMALL_B.SMRT', '20210103000000')
+        self.write('SMALL_A.SMRT', '20210102000000', rows=1)
+        self.write('LARGE.SMRT', '20210104000000', rows=100)
+
+    def drain(self, queue):
+        names = []
+        while (path := queue.pop()) is not None:
+            names.append(path.name)
+        return names
+
+    def make_queue(self, policy, **kwargs):
+        queue = IncomingQueue(policy, small_file_size=200, **kwargs)
+        self.assertEqual(queue.extend(sorted(self.incoming.iterdir())), 4)
+        return queue
+
+    def test_oldest(self):
+        self.write_files()
+        self.assertEqual(
+            self.drain(self.make_queue('oldest')),
+            ['BACKFILL.SMRT', 'SMALL_A.SMRT', 'SMALL_B.SMRT', 'LARGE.SMRT']
+        )
+
+    def test_smallest(self):
+        self.write_files()
+        self.assertEqual(
+            self.drain(self.make_queue('smallest')),
+            ['SMALL_B.SMRT', 'SMALL_A.SMRT', 'BACKFILL.SMRT', 'LARGE.SMRT']
+        )
+
+    def test_fair_alternates(self):
+        self.write_files()
+        self.assertEqual(
+            self.drain(self.make_queue('fair')),
+            ['SMALL_A.SMRT', 'BACKFILL.SMRT', 'SMALL_B.SMRT', 'LARGE.SMRT']
+        )
+
+    def test_fair_overdue_small_files_first(self):
+        self.write_files()
+        with patch('smrt_importer.schedule.monotonic') as monotonic:
+            monotonic.return_value = 100
+            queue = self.make_queue('fair', small_file_slo=10)
+            self.assertEqual(queue.pop().name, 'SMALL_A.SMRT')
+            monotonic.return_value = 110
+            self.assertEqual(queue.pop().name, 'SMALL_B.SMRT')
+
+        self.assertEqual(self.drain(queue), ['BACKFILL.SMRT', 'LARGE.SMRT'])
+
+    def test_queued_once(self):
+        path = self.write('SMALL_A.SMRT', '20210102000000')
+        queue = IncomingQueue()
+        self.assertTrue(queue.add(path))
+        self.assertFalse(queue.add(path))
+        self.assertFalse(queue.add(self.incoming / 'MISSING.SMRT'))
+        self.assertEqual(len(queue), 1)
+        self.assertIn(path, queue)
+
+    def test_metrics(self):
+        self.write_files()
+        queue = self.make_queue('oldest')
+        self.assertIn('smrt_importer_queued_files{size="small"} 2', metrics.QUEUED_FILES.render())
+        self.assertIn('smrt_importer_queued_files{size="large"} 2', metrics.QUEUED_FILES.render())
+
+        before = metrics.QUEUE_WAIT_SECONDS.render()
+        self.drain(queue)
+        self.assertIn('smrt_importer_queued_files{size="small"} 0', metrics.QUEUED_FILES.render())
+        self.assertNotEqual(metrics.QUEUE_WAIT_SECONDS.render(), before)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            IncomingQueue('random')
+
+
+if __name__ == '__main__':
+    unittest.main()
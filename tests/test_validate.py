@@ -0,0 +1,59 @@
+import json
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from smrt_importer.cli import main
+from smrt_importer.validate import validate_dir
+
+
+HEADER = '"HEADR","SMRT","GAZ","20210101","000000","PN000001"\n'
+CONSUMPTION = '"CONSU","VALIDATE1","20210101","0000",1.0\n'
+TRAIL = '"TRAIL"\n'
+
+
+class ValidateDirTestCase(TestCase):
+    def setUp(self):
+        tmp_dir = TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = Path(tmp_dir.name)
+        (self.dir / 'A_VALID.SMRT').write_text(HEADER + CONSUMPTION + TRAIL)
+        (self.dir / 'B_INVALID.SMRT').write_text(
+            HEADER + CONSUMPTION + '"CONSU","VALIDATE1","20210101","0000",x\n' + TRAIL
+        )
+        (self.dir / 'C_INCOMPLETE.SMRT').write_text(HEADER + CONSUMPTION)
+
+    def test_report(self):
+        for workers in [1, 2]:
+            with self.subTest(workers=workers):
+                report = validate_dir(self.dir, workers)
+                self.assertEqual((report['files'], report['valid'], report['invalid']), (3, 1, 2))
+                self.assertEqual(report['rows'], 3)
+                self.assertEqual(report['reasons'], {
+                    'failed to parse consumption value': 1,
+                    'incomplete file received': 1,
+                })
+                self.assertEqual(
+                    [(Path(f['file']).name, f['line'], f['reason']) for f in report['failures']],
+                    [
+                        ('B_INVALID.SMRT', 3, 'failed to parse consumption value'),
+                        ('C_INCOMPLETE.SMRT', 2, 'incomplete file received'),
+                    ]
+                )
+
+        # Files are left where they are.
+        self.assertEqual(len(list(self.dir.iterdir())), 3)
+
+    def test_cli(self):
+        output = self.dir / 'report.json'
+        with self.assertRaises(SystemExit) as cm, patch('smrt_importer.db.get_engine') as get_engine:
+            main(['validate', str(self.dir), '--workers', '1', '--output', str(output)])
+        self.assertEqual(cm.exception.code, 1)
+        get_engine.assert_not_called()
+        self.assertEqual(json.loads(output.read_text())['invalid'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
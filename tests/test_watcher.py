@@ -0,0 +1,63 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest import TestCase
+from unittest.mock import patch
+
+from smrt_importer.watcher import create_watcher, InotifyWatcher, PollingWatcher, _load_libc
+
+
+class PollingWatcherTestCase(TestCase):
+    def test_finds_matching_files(self):
+        with TemporaryDirectory() as d:
+            (Path(d) / 'A.SMRT').touch()
+            (Path(d) / 'B.txt').touch()
+            watcher = PollingWatcher(d, ('*.SMRT',))
+            self.assertEqual(watcher.wait(), [Path(d) / 'A.SMRT'])
+
+    @patch('smrt_importer.watcher.sleep')
+    def test_backs_off_when_empty(self, sleep):
+        with TemporaryDirectory() as d:
+            watcher = PollingWatcher(d, ('*.SMRT',), min_interval=0.5, max_interval=1.5)
+            for _ in range(4):
+                self.assertEqual(watcher.wait(), [])
+            self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.5, 1.0, 1.5, 1.5])
+
+            # Interval resets once a file is found.
+            (Path(d) / 'A.SMRT').touch()
+            watcher.wait()
+            (Path(d) / 'A.SMRT').unlink()
+            watcher.wait()
+            self.assertEqual(sleep.call_args.args[0], 0.5)
+
+
+@unittest.skipIf(_load_libc() is None, 'inotify not available')
+class InotifyWatcherTestCase(TestCase):
+    def test_reports_written_and_moved_files(self):
+        with TemporaryDirectory() as d, TemporaryDirectory() as other:
+            with InotifyWatcher(d, ('*.SMRT',)) as watcher:
+                with open(Path(d) / 'A.SMRT', 'w') as f:
+                    f.write('foo')
+                (Path(d) / 'B.txt').touch()
+                (Path(other) / 'C.SMRT').touch()
+                (Path(other) / 'C.SMRT').rename(Path(d) / 'C.SMRT')
+
+                self.assertEqual(watcher.wait(1), [Path(d) / 'A.SMRT', Path(d) / 'C.SMRT'])
+                self.assertEqual(watcher.wait(0), [])
+
+
+class CreateWatcherTestCase(TestCase):
+    def test_poll_backend(self):
+        with TemporaryDirectory() as d:
+            self.assertIsInstance(create_watcher(d, ('*.SMRT',), 'poll'), PollingWatcher)
+
+    @patch('smrt_importer.watcher._load_libc', return_value=None)
+    def test_auto_falls_back_to_polling(self, _):
+        with TemporaryDirectory() as d:
+            self.assertIsInstance(create_watcher(d, ('*.SMRT',)), PollingWatcher)
+            with self.assertRaises(OSError):
+                create_watcher(d, ('*.SMRT',), 'inotify')
+
+
+if __name__ == '__main__':
+    unittest.main()